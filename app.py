@@ -1,14 +1,30 @@
 import streamlit as st
-import numpy as np
-import pandas as pd
-from openai import AzureOpenAI
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import time
 import base64
+import csv
 import random
 import re
 import os
+import html
+import logging
+import uuid
+import zlib
+import hashlib
+import heapq
+import itertools
+import math
+import json
+import sqlite3
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
 from io import BytesIO
 
+logger = logging.getLogger("eatwise")
+
 # ==================== CONFIGURATION (Backend) ====================
 # Load Azure OpenAI credentials from Streamlit secrets or environment variables
 # For local development, create .streamlit/secrets.toml with your credentials
@@ -26,6 +42,158 @@ except (FileNotFoundError, AttributeError):
 if not AZURE_API_KEY:
     st.error("❌ Error: AZURE_API_KEY is not configured. Please set it in .streamlit/secrets.toml or as an environment variable.")
     st.stop()
+
+
+# Read an optional tuning setting from secrets or the environment, cast to the type of its default
+def get_setting(name, default=None):
+    try:
+        value = st.secrets.get(name)
+    except (FileNotFoundError, AttributeError):
+        value = None
+    if value is None:
+        value = os.getenv(name)
+    if value is None:
+        return default
+    if isinstance(default, bool):
+        return str(value).strip().lower() in ("1", "true", "yes", "on")
+    if isinstance(default, int):
+        return int(value)
+    if isinstance(default, float):
+        return float(value)
+    return value
+
+
+# Local state (caches, stores) lives here; point several replicas at a shared volume to share it
+DATA_DIR = get_setting("EATWISE_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".eatwise"))
+
+# Response cache: in-process LRU in front of an on-disk SQLite store
+RESPONSE_CACHE_ENABLED = get_setting("RESPONSE_CACHE_ENABLED", True)
+RESPONSE_CACHE_TTL_SECONDS = get_setting("RESPONSE_CACHE_TTL_SECONDS", 24 * 60 * 60)
+RESPONSE_CACHE_MAX_ENTRIES = get_setting("RESPONSE_CACHE_MAX_ENTRIES", 512)
+RESPONSE_CACHE_DB_PATH = get_setting("RESPONSE_CACHE_DB_PATH", os.path.join(DATA_DIR, "response_cache.sqlite3"))
+
+# Cacheable mode pins the sampling parameters so a cached answer is one the model would give again.
+# It makes answers deterministic (the same question always gets the same answer), so operators opt
+# in; without it answers are sampled at temperature 0.7 and nothing is cached.
+CACHEABLE_MODE = get_setting("CACHEABLE_MODE", False)
+CACHEABLE_TEMPERATURE = get_setting("CACHEABLE_TEMPERATURE", 0.0)
+LLM_SEED = get_setting("LLM_SEED", 42)
+# Shared HTTP connection pool used by the process-wide Azure OpenAI client
+OPENAI_MAX_CONNECTIONS = get_setting("OPENAI_MAX_CONNECTIONS", 20)
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = get_setting("OPENAI_MAX_KEEPALIVE_CONNECTIONS", 10)
+OPENAI_KEEPALIVE_EXPIRY = get_setting("OPENAI_KEEPALIVE_EXPIRY", 30.0)
+OPENAI_CONNECT_TIMEOUT = get_setting("OPENAI_CONNECT_TIMEOUT", 5.0)
+OPENAI_READ_TIMEOUT = get_setting("OPENAI_READ_TIMEOUT", 60.0)
+
+# Stream completions token by token and show each result card as soon as its section is complete
+STREAMING_ENABLED = get_setting("STREAMING_ENABLED", True)
+
+# Photos are downscaled and re-encoded (without EXIF) before upload; vision cost scales with size
+IMAGE_MAX_EDGE = get_setting("IMAGE_MAX_EDGE", 1024)
+IMAGE_JPEG_QUALITY = get_setting("IMAGE_JPEG_QUALITY", 85)
+
+# Ask for analyses as JSON (json_schema response format) and render them as a table.
+# Needs an API version with structured outputs, e.g. 2024-08-01-preview or later.
+STRUCTURED_OUTPUT = get_setting("STRUCTURED_OUTPUT", False)
+
+# Per-session history retention (oldest entries are dropped first) and pagination
+HISTORY_MAX_ENTRIES = get_setting("HISTORY_MAX_ENTRIES", 50)
+HISTORY_MAX_BYTES = get_setting("HISTORY_MAX_BYTES", 2 * 1024 * 1024)
+HISTORY_PAGE_SIZE = get_setting("HISTORY_PAGE_SIZE", 10)
+
+# History is stored in SQLite ("sqlite") so it survives reconnects and restarts, or kept in
+# the Streamlit session only ("memory"). SQLite is used for signed-in users (Streamlit
+# authentication). Anonymous visitors keep session-only history unless HISTORY_URL_SESSIONS is on:
+# their history is then stored under a `sid` parameter in the page URL, and anyone with the URL
+# (shared links, browser history, proxy logs) can read it, so it is opt-in.
+HISTORY_BACKEND = get_setting("HISTORY_BACKEND", "sqlite")
+HISTORY_URL_SESSIONS = get_setting("HISTORY_URL_SESSIONS", False)
+HISTORY_DB_PATH = get_setting("HISTORY_DB_PATH", os.path.join(DATA_DIR, "history.sqlite3"))
+HISTORY_RETENTION_DAYS = get_setting("HISTORY_RETENTION_DAYS", 30)
+
+# Photos in a batch are analysed concurrently, at most this many at a time
+MAX_CONCURRENT_ANALYSES = get_setting("MAX_CONCURRENT_ANALYSES", 4)
+
+# Image analyses are keyed on a digest of the image bytes; perceptual-hash mode also matches
+# re-uploads of the same photo after recompression or resizing
+IMAGE_PHASH_ENABLED = get_setting("IMAGE_PHASH_ENABLED", False)
+IMAGE_PHASH_MAX_DISTANCE = get_setting("IMAGE_PHASH_MAX_DISTANCE", 6)
+
+# Client-side rate limiting against the Azure deployment's quota (0 = no limit). Requests that
+# would exceed it wait in a queue shared fairly across sessions, for at most RATE_LIMIT_MAX_WAIT_SECONDS
+RATE_LIMIT_TPM = get_setting("RATE_LIMIT_TPM", 0)
+RATE_LIMIT_RPM = get_setting("RATE_LIMIT_RPM", 0)
+RATE_LIMIT_MAX_WAIT_SECONDS = get_setting("RATE_LIMIT_MAX_WAIT_SECONDS", 30.0)
+
+# Each LLM call must finish within LLM_TIMEOUT_SECONDS, retries included. Rate limits (429),
+# server errors and timeouts are retried with exponential backoff and full jitter.
+LLM_TIMEOUT_SECONDS = get_setting("LLM_TIMEOUT_SECONDS", 60.0)
+LLM_MAX_RETRIES = get_setting("LLM_MAX_RETRIES", 3)
+LLM_RETRY_BASE_DELAY = get_setting("LLM_RETRY_BASE_DELAY", 0.5)
+LLM_RETRY_MAX_DELAY = get_setting("LLM_RETRY_MAX_DELAY", 8.0)
+# Hedging sends a duplicate of a slow non-streamed request once it takes longer than the p95
+# latency seen so far (LLM_HEDGE_DELAY_SECONDS until enough calls were timed) and keeps whichever
+# answer arrives first. Duplicates cost tokens, so they are only sent when there is spare quota.
+LLM_HEDGING_ENABLED = get_setting("LLM_HEDGING_ENABLED", False)
+LLM_HEDGE_DELAY_SECONDS = get_setting("LLM_HEDGE_DELAY_SECONDS", 10.0)
+
+# Semantic cache: paraphrased questions and food descriptions (same goal, restrictions and other
+# preferences) reuse an earlier answer. Queries are embedded with an Azure embeddings deployment,
+# or offline with a hashing vectorizer when EMBEDDINGS_DEPLOYMENT is not set.
+SEMANTIC_CACHE_ENABLED = get_setting("SEMANTIC_CACHE_ENABLED", False)
+SEMANTIC_CACHE_MIN_SIMILARITY = get_setting("SEMANTIC_CACHE_MIN_SIMILARITY", 0.9)
+SEMANTIC_CACHE_MAX_ENTRIES = get_setting("SEMANTIC_CACHE_MAX_ENTRIES", 200000)
+SEMANTIC_CACHE_PATH = get_setting("SEMANTIC_CACHE_PATH", os.path.join(DATA_DIR, "semantic_index"))
+SEMANTIC_CACHE_DIM = get_setting("SEMANTIC_CACHE_DIM", 256)
+EMBEDDINGS_DEPLOYMENT = get_setting("EMBEDDINGS_DEPLOYMENT", "")
+
+# Simple text descriptions ("one banana and a glass of milk") are answered from the bundled
+# food-composition table without a model call when every item is in it
+LOCAL_NUTRITION_ENABLED = get_setting("LOCAL_NUTRITION_ENABLED", True)
+FOOD_TABLE_PATH = get_setting("FOOD_TABLE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "foods.csv"))
+# Extra names for foods in the table (abbreviations, regional names). A misspelled single word
+# ("brocoli") matches a name with trigram similarity of at least FOOD_MATCH_MIN_SCORE (0-1) that
+# starts with the same letter and is one or two edits away. Matches scoring FOOD_MATCH_LOCAL_SCORE
+# or more are answered locally, saying how the word was read; weaker ones are given to the model
+# as hints
+FOOD_ALIASES_PATH = get_setting("FOOD_ALIASES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "food_aliases.csv"))
+FOOD_MATCH_MIN_SCORE = get_setting("FOOD_MATCH_MIN_SCORE", 0.5)
+FOOD_MATCH_LOCAL_SCORE = get_setting("FOOD_MATCH_LOCAL_SCORE", 0.6)
+
+# Keep the answers to the quick-suggestion pills (with the default preferences) warm in the
+# response cache, refreshed every PREWARM_INTERVAL_SECONDS by a background job. Costs about
+# 30 requests per refresh.
+PREWARM_ENABLED = get_setting("PREWARM_ENABLED", False)
+PREWARM_INTERVAL_SECONDS = get_setting("PREWARM_INTERVAL_SECONDS", 6 * 60 * 60)
+PREWARM_CONCURRENCY = get_setting("PREWARM_CONCURRENCY", 2)
+
+# Instrumentation: latencies, token usage and cache hit rates are counted in memory per process.
+# They are served in Prometheus text format on METRICS_PORT (0 = off), appended as JSON lines to
+# METRICS_LOG_PATH every METRICS_FLUSH_SECONDS, and shown in the sidebar with METRICS_PANEL_ENABLED.
+METRICS_ENABLED = get_setting("METRICS_ENABLED", True)
+METRICS_PORT = get_setting("METRICS_PORT", 0)
+METRICS_LOG_PATH = get_setting("METRICS_LOG_PATH", "")
+METRICS_FLUSH_SECONDS = get_setting("METRICS_FLUSH_SECONDS", 60.0)
+METRICS_PANEL_ENABLED = get_setting("METRICS_PANEL_ENABLED", False)
+# USD per 1000 tokens for the cost counters (gpt-4o list prices)
+LLM_PROMPT_COST_PER_1K = get_setting("LLM_PROMPT_COST_PER_1K", 0.0025)
+LLM_COMPLETION_COST_PER_1K = get_setting("LLM_COMPLETION_COST_PER_1K", 0.01)
+# Ask for token usage at the end of streamed answers (needs API version 2024-09-01-preview or
+# later); without it the usage of streamed answers is estimated from their length
+STREAM_USAGE_ENABLED = get_setting("STREAM_USAGE_ENABLED", False)
+
+# Prompt budgets: max_tokens is sized to the answer asked for (number of recommendations,
+# sections of an analysis) from the completion tokens recent answers of that kind used, up to
+# LLM_MAX_TOKENS, instead of always LLM_MAX_TOKENS. PROMPT_STYLE
+# "compact" sends shorter instructions than "full". Tokens are counted with tiktoken when it is
+# installed (TOKENIZER "auto") and estimated from the text length otherwise ("heuristic").
+ADAPTIVE_MAX_TOKENS = get_setting("ADAPTIVE_MAX_TOKENS", True)
+LLM_MAX_TOKENS = get_setting("LLM_MAX_TOKENS", 1500)
+PROMPT_STYLE = get_setting("PROMPT_STYLE", "full")
+TOKENIZER = get_setting("TOKENIZER", "auto")
+
+# Bump when a prompt template changes so old cached answers are not served for the new prompt
+PROMPT_VERSION = 1
 # =================================================================
 
 # Page configuration
@@ -35,485 +203,37 @@ st.set_page_config(
     layout="wide"
 )
 
-# Fix sidebar selectboxes only
-st.markdown("""
-<style>
-    /* Sidebar select boxes - white bg, dark text */
-    .stSidebar [data-baseweb="select"] > div {
-        background-color: #FFFFFF !important;
-        border-radius: 10px !important;
-    }
-    
-    .stSidebar [data-baseweb="select"] span,
-    .stSidebar [data-baseweb="select"] div {
-        color: #0D2818 !important;
-    }
-    
-    /* Dropdown menus (global) */
-    [role="listbox"] {
-        background-color: #FFFFFF !important;
-    }
-    
-    [role="listbox"] li {
-        background-color: #FFFFFF !important;
-        color: #0D2818 !important;
-    }
-    
-    [role="listbox"] li:hover {
-        background-color: #E8F5E9 !important;
-    }
-</style>
-""", unsafe_allow_html=True)
-
-# Custom CSS for better styling (green-themed nutrition advisor)
-st.markdown("""
-<style>
-    @import url('https://fonts.googleapis.com/css2?family=Inter:wght@300;400;600;700&family=Poppins:wght@600;700;800&display=swap');
-
-    :root{
-        --primary-dark: #1B5E20;    /* deep forest green */
-        --primary: #2E7D32;         /* vibrant green */
-        --primary-light: #4CAF50;   /* lighter green */
-        --accent: #66BB6A;          /* soft green accent */
-        --text-light: #E8F5E9;      /* light text for dark bg */
-        --text-muted: #C8E6C9;      /* muted light text */
-        --bg-dark: #0D3B0D;         /* dark background */
-        --bg-dark-alt: #1B5E20;     /* alternate dark bg */
-        --card-dark: #1B3A1B;       /* dark card background */
-        --success: #43A047;         /* success green */
-    }
-
-    /* FORCE DARK MODE */
-    html, body, [class*='stApp'] {
-        font-family: 'Inter', system-ui, -apple-system, 'Segoe UI', Roboto, 'Helvetica Neue', Arial;
-        background: linear-gradient(135deg, #0D3B0D 0%, #1B5E20 50%, #0D3B0D 100%) !important;
-        color: #E8F5E9 !important;
-    }
-
-    /* Sidebar base styling */
-    .stSidebar {
-        background: linear-gradient(180deg, #1B5E20 0%, #2E7D32 50%, #1B5E20 100%) !important;
-    }
-    .stSidebar [data-testid="stSidebarContent"] {
-        background: linear-gradient(180deg, #1B5E20 0%, #2E7D32 50%, #1B5E20 100%) !important;
-    }
-
-    /* Sidebar text colors - WHITE for high contrast */
-    .stSidebar h1, .stSidebar h2, .stSidebar h3, .stSidebar label, .stSidebar .stMarkdown {
-        color: #FFFFFF !important;
-        font-weight: 600 !important;
-        margin: 0.18rem 0 0.22rem 0 !important;
-        font-size: 1rem !important;
-        text-shadow: 0 1px 2px rgba(0,0,0,0.2) !important;
-    }
-
-    .stSidebar .stMarkdown p, .stSidebar .stCaption {
-        color: #E8F5E9 !important;
-        font-size: 0.78rem !important;
-        margin: 0.18rem 0 0.18rem 0 !important;
-    }
-
-    /* FIXED: Sidebar dropdowns - no white edges, proper border-radius */
-    .stSidebar [data-baseweb="select"] > div {
-        background-color: #FFFFFF !important;
-        border: 2px solid #4CAF50 !important;
-        border-radius: 10px !important;
-        overflow: hidden !important;
-    }
-
-    .stSidebar [data-baseweb="select"] > div > div {
-        background-color: #FFFFFF !important;
-        color: #0D2818 !important;
-        border-radius: 10px !important;
-    }
-
-    /* Select dropdown text */
-    .stSidebar [data-baseweb="select"] span {
-        color: #0D2818 !important;
-    }
-
-    /* Multiselect boxes */
-    .stSidebar [data-baseweb="tag"] {
-        background-color: #4CAF50 !important;
-        color: #FFFFFF !important;
-        border-radius: 6px !important;
-    }
-
-    /* Text inputs in sidebar */
-    .stSidebar [data-baseweb="input"], 
-    .stSidebar [data-baseweb="textarea"] {
-        background-color: #FFFFFF !important;
-        border: 2px solid #4CAF50 !important;
-        border-radius: 10px !important;
-        overflow: hidden !important;
-    }
-
-    .stSidebar [data-baseweb="base-input"] input,
-    .stSidebar textarea {
-        background-color: #FFFFFF !important;
-        color: #0D2818 !important;
-        border-radius: 10px !important;
-    }
-
-    /* Hero header - dark mode style */
-    .header-container{
-        max-width: 1100px;
-        margin: 1.2rem auto 0.8rem auto;
-        padding: 1.5rem 1.6rem;
-        border-radius: 16px;
-        background: linear-gradient(135deg, rgba(76,175,80,0.2), rgba(102,187,106,0.12));
-        border: 2px solid rgba(76,175,80,0.25);
-        display: flex;
-        align-items: center;
-        gap: 1.2rem;
-        box-shadow: 0 8px 24px rgba(27,94,32,0.25);
-    }
-
-    .hero-icon{
-        font-size: 2.8rem;
-        background: linear-gradient(135deg, rgba(76,175,80,0.25), rgba(102,187,106,0.15));
-        padding: 0.8rem;
-        border-radius: 14px;
-        border: 2px solid rgba(76,175,80,0.2);
-        display: inline-flex;
-        align-items: center;
-        justify-content: center;
-    }
-
-    .main-header{
-        font-family: 'Poppins', 'Inter', sans-serif;
-        font-weight: 700;
-        font-size: 2.1rem;
-        color: #E8F5E9 !important;
-        margin: 0;
-        line-height: 1.05;
-    }
-
-    .sub-header{
-        margin: 0.2rem 0 0 0;
-        font-size: 0.95rem;
-        color: #C8E6C9 !important;
-        font-weight: 500;
-    }
-
-    /* Card styles for responses - Dark mode */
-    .recommendation-box, .nutrition-analysis-box{
-        background: #1B3A1B !important;
-        color: #E8F5E9 !important;
-        padding: 1.5rem;
-        border-radius: 14px;
-        border: 2px solid rgba(76,175,80,0.25);
-        border-left: 6px solid var(--primary);
-        box-shadow: 0 10px 28px rgba(27,94,32,0.25);
-        margin: 1.2rem 0;
-        transition: all 0.24s cubic-bezier(0.4, 0, 0.2, 1);
-        background: linear-gradient(to right, rgba(76,175,80,0.1), #1B3A1B) !important;
-    }
-    .recommendation-box:hover, .nutrition-analysis-box:hover{
-        transform: translateY(-6px);
-        box-shadow: 0 16px 40px rgba(27,94,32,0.35);
-        border-color: rgba(76,175,80,0.35);
-    }
-
-    .recommendation-box { border-left-color: var(--primary-light); }
-    .nutrition-analysis-box { border-left-color: var(--success); }
-
-    /* Result presentation - Dark mode */
-    .result-header {
-        font-family: 'Poppins', 'Inter', sans-serif;
-        font-size: 1.15rem;
-        font-weight: 700;
-        color: #C8E6C9 !important;
-        margin-bottom: 0.8rem;
-        border-bottom: 3px solid var(--primary-light);
-        padding-bottom: 0.6rem;
-    }
-
-    .result-item {
-        background: linear-gradient(90deg, rgba(76,175,80,0.12), rgba(102,187,106,0.08));
-        padding: 1rem 1.2rem;
-        margin: 0.8rem 0;
-        border-radius: 10px;
-        border-left: 4px solid var(--primary-light);
-        transition: all 0.2s ease;
-    }
-    .result-item:hover {
-        background: linear-gradient(90deg, rgba(76,175,80,0.18), rgba(102,187,106,0.12));
-        transform: translateX(4px);
-    }
-
-    .result-label {
-        color: #A5D6A7 !important;
-        font-weight: 700;
-        font-size: 0.95rem;
-        text-transform: uppercase;
-        letter-spacing: 0.5px;
-        margin-bottom: 0.3rem;
-    }
-
-    .result-value {
-        color: #E8F5E9 !important;
-        font-size: 1rem;
-        line-height: 1.6;
-        margin-top: 0.4rem;
-    }
-
-    /* Ensure text inside result-value is light */
-    .result-value p, .result-value li, .result-value strong, .result-value em {
-        color: #E8F5E9 !important;
-    }
-
-    /* Button styling */
-    .stButton>button{
-        background: linear-gradient(180deg, var(--primary-light), var(--primary));
-        color: white !important;
-        border: none;
-        padding: 10px 16px;
-        border-radius: 10px;
-        font-weight: 600;
-        box-shadow: 0 8px 20px rgba(27,94,32,0.3);
-        transition: all 0.24s ease;
-    }
-    .stButton>button:hover {
-        box-shadow: 0 12px 28px rgba(27,94,32,0.4);
-        transform: translateY(-2px);
-        background: linear-gradient(180deg, #66BB6A, var(--primary-light));
-    }
-    .stButton>button[disabled]{
-        opacity: 0.5;
-        box-shadow: none;
-        cursor: not-allowed;
-    }
-
-    /* Main content area inputs - Dark mode */
-    textarea, input[type='text'], [data-baseweb="base-input"] input {
-        border-radius: 10px !important;
-        border: 2px solid rgba(76,175,80,0.4) !important;
-        background-color: #1B3A1B !important;
-        color: #E8F5E9 !important;
-        padding: 11px 12px !important;
-        transition: all 0.2s ease !important;
-    }
-    textarea:focus, input[type='text']:focus, [data-baseweb="base-input"] input:focus {
-        border-color: var(--primary-light) !important;
-        box-shadow: 0 0 0 3px rgba(76,175,80,0.2) !important;
-    }
-
-    /* Placeholder text - Dark mode */
-    textarea::placeholder, input::placeholder {
-        color: #A5D6A7 !important;
-        opacity: 0.7 !important;
-    }
-
-    /* Slider styling */
-    .stSlider [data-baseweb="slider"] {
-        background: linear-gradient(90deg, var(--primary-light), var(--success)) !important;
-    }
-
-    /* Tabs - Dark mode */
-    .stTabs [data-baseweb="tab-list"] { gap: 1.4rem; }
-    .stTabs [data-baseweb="tab"] {
-        color: #A5D6A7 !important;
-        border-bottom: 3px solid transparent !important;
-        font-weight: 600 !important;
-    }
-    .stTabs [aria-selected="true"] {
-        color: #C8E6C9 !important;
-        border-bottom-color: var(--primary-light) !important;
-    }
-
-    /* Info/Alert boxes - Dark mode */
-    .stInfo {
-        background: linear-gradient(135deg, rgba(76,175,80,0.2), rgba(46,125,50,0.12)) !important;
-        border-left: 5px solid var(--success) !important;
-        border-radius: 10px !important;
-        padding: 1rem 1.2rem !important;
-        color: #E8F5E9 !important;
-    }
-
-    .stAlert {
-        border-radius: 10px !important;
-    }
-
-    .stSuccess {
-        background: linear-gradient(135deg, rgba(67,160,71,0.2), rgba(46,125,50,0.12)) !important;
-        border-left: 5px solid var(--success) !important;
-        color: #E8F5E9 !important;
-    }
-
-    .stWarning {
-        background: linear-gradient(135deg, rgba(251,192,45,0.2), rgba(251,140,0,0.15)) !important;
-        border-left: 5px solid #FB8C00 !important;
-        color: #FFF3E0 !important;
-    }
-
-    /* Expander - Dark mode */
-    .stExpander {
-        border: 2px solid rgba(76,175,80,0.25) !important;
-        border-radius: 10px !important;
-        background: rgba(27,58,27,0.5) !important;
-    }
-    
-    .stExpander summary {
-        color: #E8F5E9 !important;
-        font-weight: 600 !important;
-    }
-
-    /* Divider */
-    .stDivider {
-        background: linear-gradient(90deg, transparent, var(--primary-light), transparent) !important;
-        height: 3px !important;
-    }
-
-    /* Metric Cards - Dark mode */
-    .metric-card {
-        background: linear-gradient(135deg, rgba(76,175,80,0.2), rgba(46,125,50,0.12));
-        border: 2px solid rgba(76,175,80,0.3);
-        border-radius: 12px;
-        padding: 1rem;
-        margin: 0.6rem 0;
-        text-align: center;
-        transition: all 0.2s ease;
-    }
-    .metric-card:hover {
-        transform: translateY(-3px);
-        box-shadow: 0 8px 20px rgba(46,125,50,0.25);
-    }
-    .metric-value {
-        font-size: 1.8rem;
-        font-weight: 700;
-        color: #C8E6C9;
-        margin: 0;
-    }
-    .metric-label {
-        font-size: 0.8rem;
-        color: #A5D6A7;
-        text-transform: uppercase;
-        letter-spacing: 0.5px;
-        margin-top: 0.3rem;
-    }
-
-    /* Quick Action Pills */
-    .quick-pill {
-        display: inline-block;
-        background: linear-gradient(135deg, var(--primary-light), var(--accent));
-        color: white !important;
-        padding: 0.6rem 1rem;
-        border-radius: 20px;
-        margin: 0.4rem 0.4rem 0.4rem 0;
-        font-size: 0.85rem;
-        font-weight: 600;
-        border: none;
-        cursor: pointer;
-        box-shadow: 0 4px 12px rgba(46,125,50,0.3);
-        transition: all 0.2s ease;
-    }
-    .quick-pill:hover {
-        transform: translateY(-2px);
-        box-shadow: 0 6px 16px rgba(46,125,50,0.4);
-    }
-    
-    /* Pill-style headers */
-    .pill-header {
-        display: inline-flex;
-        align-items: center;
-        gap: 0.5rem;
-        background: linear-gradient(90deg, var(--primary), var(--primary-light));
-        color: #FFFFFF !important;
-        padding: 12px 18px;
-        border-radius: 999px;
-        font-weight: 800;
-        margin-bottom: 0.8rem;
-        box-shadow: 0 10px 30px rgba(27,94,32,0.3);
-        font-size: 1.18rem;
-        border: 1px solid rgba(255,255,255,0.1);
-        text-shadow: 0 1px 2px rgba(0,0,0,0.2);
-    }
-
-    /* History section headers - match pill header size */
-    h2, .stMarkdown h2 {
-        font-size: 1.18rem !important;
-        font-weight: 700 !important;
-        color: #E8F5E9 !important;
-        margin-top: 1.5rem !important;
-        margin-bottom: 1rem !important;
-    }
-            
-    /* Tips Widget */
-    .tips-widget {
-        background: linear-gradient(135deg, rgba(102,187,106,0.2), rgba(76,175,80,0.15));
-        border-left: 4px solid var(--primary-light);
-        border-radius: 8px;
-        padding: 0.6rem;
-        margin: 0.6rem 0;
-        font-size: 0.82rem;
-        line-height: 1.5;
-        color: #FFFFFF !important;
-    }
-    .tips-widget .tip-title {
-        font-weight: 700;
-        color: #FFFFFF !important;
-        margin-bottom: 0.25rem;
-        display: flex;
-        align-items: center;
-        gap: 0.4rem;
-        font-size: 0.95rem;
-    }
-    .tips-widget .daily-label {
-        display: inline-block;
-        background: linear-gradient(90deg, #FFFFFF, #E8F5E9);
-        color: #1B5E20 !important;
-        padding: 6px 10px;
-        border-radius: 999px;
-        font-weight: 700;
-        margin-bottom: 0.45rem;
-        box-shadow: 0 4px 12px rgba(0,0,0,0.2);
-        font-size: 0.95rem;
-    }
-
-    /* Footer */
-    .app-footer{ 
-        text-align: center; 
-        color: #A5D6A7 !important;
-        padding: 1.5rem 0;
-        border-top: 2px solid rgba(76,175,80,0.25);
-    }
-
-    /* Force all Streamlit text elements to light color */
-    .stMarkdown, .stText, p, span, div {
-        color: #E8F5E9 !important;
-    }
-
-    /* Radio buttons and checkboxes labels */
-    .stRadio label, .stCheckbox label {
-        color: #E8F5E9 !important;
-        font-weight: 500 !important;
-    }
-
-    /* File uploader */
-    .stFileUploader {
-        background: #1B3A1B !important;
-        border: 2px dashed rgba(76,175,80,0.4) !important;
-        border-radius: 10px !important;
-    }
-
-    .stFileUploader label {
-        color: #E8F5E9 !important;
-    }
-
-    /* Download button */
-    .stDownloadButton button {
-        background: linear-gradient(180deg, var(--primary-light), var(--primary)) !important;
-        color: white !important;
-    }
-
-    /* Ensure selectbox dropdowns are visible */
-    [data-baseweb="popover"] {
-        background-color: #FFFFFF !important;
-    }
-         
-</style>
-""", unsafe_allow_html=True)
+# Theme CSS and fonts are served as static files (server.enableStaticServing), so a rerun only
+# re-sends a couple of <link> tags and the browser fetches and caches the stylesheet once
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+THEME_CSS_FILE = os.path.join(STATIC_DIR, "eatwise.css")
+PRELOAD_FONTS = ["inter-latin-400-normal.woff2", "poppins-latin-700-normal.woff2"]
+
+
+@st.cache_resource
+def get_theme_html():
+    with open(THEME_CSS_FILE, encoding="utf-8") as f:
+        css = f.read()
+    inline_html = f"<style>\n{css}</style>"
+    if not st.get_option("server.enableStaticServing"):
+        # Static serving is off (e.g. a different config.toml); inline the stylesheet as before
+        return inline_html, 0
+
+    version = hashlib.sha256(css.encode("utf-8")).hexdigest()[:12]
+    links = [
+        f'<link rel="preload" href="app/static/fonts/{name}" as="font" type="font/woff2" crossorigin>'
+        for name in PRELOAD_FONTS
+        if os.path.exists(os.path.join(STATIC_DIR, "fonts", name))
+    ]
+    links.append(f'<link rel="stylesheet" href="app/static/eatwise.css?v={version}">')
+    link_html = "\n".join(links)
+    bytes_saved = len(inline_html.encode("utf-8")) - len(link_html.encode("utf-8"))
+    logger.info("Theme served as a static file: %d bytes saved per rerun", bytes_saved)
+    return link_html, bytes_saved
+
+
+theme_html, THEME_BYTES_SAVED_PER_RERUN = get_theme_html()
+st.markdown(theme_html, unsafe_allow_html=True)
 
 # App header (hero)
 st.markdown(
@@ -546,104 +266,165 @@ st.markdown("""
 </div>
 """, unsafe_allow_html=True)
 
-# Initialize session state
-if 'recommendation_history' not in st.session_state:
-    st.session_state.recommendation_history = []
-if 'analysis_history' not in st.session_state:
-    st.session_state.analysis_history = []
-
-# Nutritionist tips database
-NUTRITIONIST_TIPS = [
-    {
-        "emoji": "💧",
-        "title": "Hydration Matters",
-        "tip": "Drink at least 8 glasses of water daily. Proper hydration improves energy, metabolism, and skin health."
-    },
-    {
-        "emoji": "🥗",
-        "title": "Eat the Rainbow",
-        "tip": "Include colorful vegetables in your diet. Different colors provide different nutrients and antioxidants."
-    },
-    {
-        "emoji": "🥚",
-        "title": "Protein Power",
-        "tip": "Include protein at every meal. It helps with satiety, muscle building, and maintaining stable energy levels."
-    },
-    {
-        "emoji": "🌾",
-        "title": "Whole Grains Win",
-        "tip": "Choose whole grains over refined grains. They provide more fiber and nutrients for better digestion."
-    },
-    {
-        "emoji": "🥑",
-        "title": "Healthy Fats",
-        "tip": "Don't fear fats! Include sources like avocados, nuts, and olive oil for brain and heart health."
-    },
-    {
-        "emoji": "🍎",
-        "title": "Snack Smart",
-        "tip": "Plan healthy snacks like fruits, nuts, or yogurt. It prevents overeating at main meals."
-    },
-    {
-        "emoji": "⏰",
-        "title": "Meal Timing",
-        "tip": "Eat breakfast within 1-2 hours of waking. It kickstarts metabolism and improves concentration."
-    },
-    {
-        "emoji": "🧘",
-        "title": "Mindful Eating",
-        "tip": "Eat slowly and without distractions. Chew thoroughly to aid digestion and increase satisfaction."
-    },
-]
+# Nutritionist tips database (built once per process)
+@st.cache_resource
+def get_nutritionist_tips():
+    return [
+        {
+            "emoji": "💧",
+            "title": "Hydration Matters",
+            "tip": "Drink at least 8 glasses of water daily. Proper hydration improves energy, metabolism, and skin health."
+        },
+        {
+            "emoji": "🥗",
+            "title": "Eat the Rainbow",
+            "tip": "Include colorful vegetables in your diet. Different colors provide different nutrients and antioxidants."
+        },
+        {
+            "emoji": "🥚",
+            "title": "Protein Power",
+            "tip": "Include protein at every meal. It helps with satiety, muscle building, and maintaining stable energy levels."
+        },
+        {
+            "emoji": "🌾",
+            "title": "Whole Grains Win",
+            "tip": "Choose whole grains over refined grains. They provide more fiber and nutrients for better digestion."
+        },
+        {
+            "emoji": "🥑",
+            "title": "Healthy Fats",
+            "tip": "Don't fear fats! Include sources like avocados, nuts, and olive oil for brain and heart health."
+        },
+        {
+            "emoji": "🍎",
+            "title": "Snack Smart",
+            "tip": "Plan healthy snacks like fruits, nuts, or yogurt. It prevents overeating at main meals."
+        },
+        {
+            "emoji": "⏰",
+            "title": "Meal Timing",
+            "tip": "Eat breakfast within 1-2 hours of waking. It kickstarts metabolism and improves concentration."
+        },
+        {
+            "emoji": "🧘",
+            "title": "Mindful Eating",
+            "tip": "Eat slowly and without distractions. Chew thoroughly to aid digestion and increase satisfaction."
+        },
+    ]
+
+
+# Default sidebar preferences (also what the quick suggestions are pre-warmed with)
+DEFAULT_NUM_RECOMMENDATIONS = 5
+
+# Quick-suggestion pills per health goal: (label, question). Built once per process.
+@st.cache_resource
+def get_quick_suggestions():
+    return {
+        "Weight Loss": [
+            ("🥗 Low-Cal Meals", "What are filling but low-calorie meals for weight loss?"),
+            ("🍎 Smart Snacks", "What snacks won't sabotage my weight loss goals?"),
+            ("🔥 Metabolism Boost", "What foods help boost metabolism for weight loss?"),
+        ],
+        "Muscle Building": [
+            ("💪 Protein Power", "What are the best high-protein meals for muscle gain?"),
+            ("🏋️ Post-Workout", "What's the ideal post-workout meal for recovery?"),
+            ("🥚 Breakfast Gains", "What's a protein-rich breakfast for muscle building?"),
+        ],
+        "Keep Fit/Maintenance": [
+            ("⚖️ Balanced Meals", "What are well-balanced meals for maintenance?"),
+            ("🏃 Active Lifestyle", "What should I eat to support an active lifestyle?"),
+            ("🍱 Meal Prep", "Suggest easy meal prep ideas for the week"),
+        ],
+        "Heart Health": [
+            ("❤️ Heart-Healthy Fats", "What are the best heart-healthy fats to include?"),
+            ("🧂 Low Sodium", "Suggest flavorful low-sodium meal options"),
+            ("🐟 Omega-3 Sources", "What are good omega-3 rich foods besides fish?"),
+        ],
+        "Energy Boost": [
+            ("⚡ Morning Energy", "What breakfast gives sustained energy all morning?"),
+            ("😴 Beat Afternoon Slump", "What should I eat to avoid the 3pm energy crash?"),
+            ("🔋 Pre-Workout Fuel", "What should I eat before a workout for energy?"),
+        ],
+        "Diabetes Management": [
+            ("📉 Blood Sugar Control", "What meals help stabilize blood sugar levels?"),
+            ("🍞 Low-GI Options", "What are good low-glycemic index food choices?"),
+            ("🥗 Balanced Carbs", "How should I balance carbs in my meals?"),
+        ],
+        "High Protein Diet": [
+            ("🥩 Protein Variety", "What are diverse protein sources beyond meat?"),
+            ("🌱 Plant Protein", "What are the best plant-based protein options?"),
+            ("🍳 High-Protein Breakfast", "What's a high-protein breakfast under 400 calories?"),
+        ],
+        "Vegetarian/Vegan": [
+            ("🌱 Protein Sources", "What are the best plant-based protein options?"),
+            ("💊 Nutrient Coverage", "How do I ensure I get B12, iron, and omega-3?"),
+            ("🥗 Complete Meals", "What are balanced vegan meal ideas?"),
+        ],
+        "Low Carb Diet": [
+            ("🥑 Keto-Friendly", "What are satisfying low-carb, high-fat meals?"),
+            ("🍞 Carb Substitutes", "What are good alternatives to bread, rice, and pasta?"),
+            ("🥗 Low-Carb Veggies", "What vegetables are lowest in carbs?"),
+        ],
+        "General Healthy Eating": [
+            ("🥞 Breakfast Ideas", "What are some nutritious breakfast options?"),
+            ("🍱 Quick Lunches", "Suggest quick and healthy lunch ideas"),
+            ("🍴 Dinner Recipes", "What are some balanced dinner recipes?"),
+        ],
+    }
+
 
 # Sidebar for preferences
 with st.sidebar:
-    st.header("🎯 Your Health Goal")
-    health_goal = st.selectbox(
-        "Select your primary goal:",
-        [
-            "General Healthy Eating",
-            "Weight Loss",
-            "Muscle Building",
-            "Keep Fit/Maintenance",
-            "Heart Health",
-            "Energy Boost",
-            "Diabetes Management",
-            "High Protein Diet",
-            "Vegetarian/Vegan",
-            "Low Carb Diet"
-        ]
-    )
+    # Preferences are applied together, so tweaking them does not rerun the app on every change
+    with st.form("preferences_form", border=False):
+        st.header("🎯 Your Health Goal")
+        health_goal = st.selectbox(
+            "Select your primary goal:",
+            [
+                "General Healthy Eating",
+                "Weight Loss",
+                "Muscle Building",
+                "Keep Fit/Maintenance",
+                "Heart Health",
+                "Energy Boost",
+                "Diabetes Management",
+                "High Protein Diet",
+                "Vegetarian/Vegan",
+                "Low Carb Diet"
+            ]
+        )
 
-    st.divider()
+        st.divider()
 
-    # Additional preferences
-    st.header("🍽️ Preferences")
+        # Additional preferences
+        st.header("🍽️ Preferences")
 
-    meal_type = st.multiselect(
-        "Meal Type (optional):",
-        ["Breakfast", "Lunch", "Dinner", "Snack", "Pre-workout", "Post-workout"],
-        default=[]
-    )
+        meal_type = st.multiselect(
+            "Meal Type (optional):",
+            ["Breakfast", "Lunch", "Dinner", "Snack", "Pre-workout", "Post-workout"],
+            default=[]
+        )
 
-    num_recommendations = st.selectbox(
-        "Number of recommendations:",
-        options=list(range(1, 11)),
-        index=4,
-        help="How many food suggestions would you like?"
-    )
+        num_recommendations = st.selectbox(
+            "Number of recommendations:",
+            options=list(range(1, 11)),
+            index=DEFAULT_NUM_RECOMMENDATIONS - 1,
+            help="How many food suggestions would you like?"
+        )
 
-    dietary_restrictions = st.multiselect(
-        "Dietary Restrictions (optional):",
-        ["Dairy-free", "Gluten-free", "Nut-free", "Vegetarian", "Vegan", "Halal", "Kosher"],
-        default=[]
-    )
+        dietary_restrictions = st.multiselect(
+            "Dietary Restrictions (optional):",
+            ["Dairy-free", "Gluten-free", "Nut-free", "Vegetarian", "Vegan", "Halal", "Kosher"],
+            default=[]
+        )
+
+        st.form_submit_button("✅ Apply Preferences", use_container_width=True)
 
     st.divider()
     st.caption("💡 Tip: Be specific in your questions for better recommendations!")
 
     # Nutritionist Tips Widget (inline) - show 'Daily Tip' label inside the box
-    tip = random.choice(NUTRITIONIST_TIPS)
+    tip = random.choice(get_nutritionist_tips())
     st.markdown(
         f"""
         <div class="tips-widget">
@@ -655,15 +436,255 @@ with st.sidebar:
         unsafe_allow_html=True
     )
 
+# One Azure OpenAI client per process, shared across sessions and reruns so connections
+# (and their TLS sessions) are kept alive and reused
+@st.cache_resource
+def get_shared_openai_client():
+    # The SDK is only needed once a request is made; importing it lazily keeps cold starts fast
+    import httpx
+    from openai import AzureOpenAI
+
+    http_client = httpx.Client(
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(OPENAI_READ_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+    )
+    return AzureOpenAI(
+        api_key=AZURE_API_KEY,
+        api_version=AZURE_API_VERSION,
+        azure_endpoint=AZURE_ENDPOINT,
+        http_client=http_client,
+        # Retries are done by run_chat_completion, which knows the deadline and the request queue
+        max_retries=0
+    )
+
+
+# Show an error on the page, or log it when running outside a session (e.g. background jobs)
+def report_error(message):
+    if get_script_run_ctx() is None:
+        logger.warning(message)
+    else:
+        st.error(message)
+
+
+# Value at percentile `pct` of sorted samples
+def percentile_of(samples, pct):
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+# In-process metrics. Counters and timings are keyed by name plus labels (helper, goal, cache...);
+# timings keep their count and sum plus a window of recent samples for percentiles. Gauges are
+# read from a callback when a snapshot is taken.
+class Metrics:
+    def __init__(self, window=1000):
+        self.window = window
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+        self.gauges = {}
+
+    def inc(self, name, value=1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            timing = self.timings.get(key)
+            if timing is None:
+                timing = self.timings[key] = [0, 0.0, deque(maxlen=self.window)]
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2].append(seconds)
+
+    # Time a block of code: `with metrics.span("parse", helper="text_analysis"): ...`
+    @contextmanager
+    def span(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def gauge(self, name, read):
+        with self.lock:
+            self.gauges[name] = read
+
+    def snapshot(self):
+        with self.lock:
+            counters = [(name, dict(labels), value) for (name, labels), value in self.counters.items()]
+            timings = [
+                (name, dict(labels), count, total, sorted(samples))
+                for (name, labels), (count, total, samples) in self.timings.items()
+            ]
+            gauges = list(self.gauges.items())
+        return {
+            "time": time.time(),
+            "counters": [{"name": name, "labels": labels, "value": value} for name, labels, value in counters],
+            "timings": [
+                {
+                    "name": name, "labels": labels, "count": count, "sum": total,
+                    "p50": percentile_of(samples, 50), "p95": percentile_of(samples, 95), "p99": percentile_of(samples, 99),
+                }
+                for name, labels, count, total, samples in timings
+            ],
+            "gauges": [{"name": name, "value": read()} for name, read in gauges],
+        }
+
+
+@st.cache_resource
+def get_metrics():
+    return Metrics()
+
+
+def format_prometheus_labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in sorted(labels.items()):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+# A sample value at full precision (":g" keeps 6 digits, so large counters would move in steps)
+def format_prometheus_value(value):
+    if isinstance(value, int):
+        return str(int(value))
+    value = float(value)
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+# A metrics snapshot in the Prometheus text exposition format. Counters get a _total suffix
+# and timings are exported as summaries in seconds.
+def format_prometheus(snapshot):
+    lines = []
+    declared = set()
+
+    def declare(name, kind):
+        if name not in declared:
+            declared.add(name)
+            lines.append(f"# TYPE {name} {kind}")
+
+    for counter in sorted(snapshot["counters"], key=lambda c: c["name"]):
+        name = f"eatwise_{counter['name']}_total"
+        declare(name, "counter")
+        lines.append(f"{name}{format_prometheus_labels(counter['labels'])} {format_prometheus_value(counter['value'])}")
+    for timing in sorted(snapshot["timings"], key=lambda t: t["name"]):
+        name = f"eatwise_{timing['name']}_seconds"
+        declare(name, "summary")
+        for quantile, key in (("0.5", "p50"), ("0.95", "p95"), ("0.99", "p99")):
+            labels = {**timing["labels"], "quantile": quantile}
+            lines.append(f"{name}{format_prometheus_labels(labels)} {timing[key]:.6f}")
+        lines.append(f"{name}_sum{format_prometheus_labels(timing['labels'])} {timing['sum']:.6f}")
+        lines.append(f"{name}_count{format_prometheus_labels(timing['labels'])} {timing['count']}")
+    for gauge in snapshot["gauges"]:
+        name = f"eatwise_{gauge['name']}"
+        declare(name, "gauge")
+        lines.append(f"{name} {format_prometheus_value(gauge['value'])}")
+    return "\n".join(lines) + "\n"
+
+
+# Serve the metrics for Prometheus to scrape at http://<host>:<port>/metrics
+def start_metrics_server(metrics, port):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = format_prometheus(metrics.snapshot()).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # Every scrape would otherwise be printed to stderr
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="eatwise-metrics", daemon=True).start()
+    return server
+
+
+# Append a snapshot of the metrics (cumulative since start) to a JSON-lines file every `interval`
+def flush_metrics_periodically(metrics, path, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(metrics.snapshot()) + "\n")
+        except OSError as e:
+            logger.warning("Could not write metrics to %s: %s", path, e)
+
+
+# Started once per process, by the first script run
+@st.cache_resource
+def start_metrics_exporters():
+    metrics = get_metrics()
+    if METRICS_PORT:
+        try:
+            start_metrics_server(metrics, METRICS_PORT)
+        except OSError as e:
+            # E.g. another replica on this host already serves the port
+            logger.warning("Could not serve metrics on port %d: %s", METRICS_PORT, e)
+    if METRICS_LOG_PATH:
+        threading.Thread(
+            target=flush_metrics_periodically,
+            args=(metrics, METRICS_LOG_PATH, METRICS_FLUSH_SECONDS),
+            name="eatwise-metrics-flush",
+            daemon=True
+        ).start()
+    return metrics
+
+
+# Compare the local prompt estimate and the max_tokens budget with the usage the API reported,
+# and flag answers that were cut off by max_tokens
+def record_token_budget(messages, max_tokens, usage, finish_reason, labels):
+    metrics = get_metrics()
+    metrics.inc("llm_max_tokens", max_tokens, **labels)
+    if usage is not None:
+        estimated = estimate_prompt_tokens(messages)
+        metrics.inc("llm_prompt_tokens_estimated", estimated, **labels)
+        logger.info(
+            "%s: %d prompt tokens (estimated %d), %d of max_tokens %d used",
+            labels.get("helper", "LLM call"), usage.prompt_tokens, estimated, usage.completion_tokens, max_tokens
+        )
+    if finish_reason == "length":
+        metrics.inc("llm_truncated", **labels)
+        logger.warning("%s: answer cut off at max_tokens %d", labels.get("helper", "LLM call"), max_tokens)
+
+
+# Count the tokens and cost of one model call
+def record_token_usage(prompt_tokens, completion_tokens, labels):
+    metrics = get_metrics()
+    metrics.inc("llm_prompt_tokens", prompt_tokens, **labels)
+    metrics.inc("llm_completion_tokens", completion_tokens, **labels)
+    cost = prompt_tokens / 1000 * LLM_PROMPT_COST_PER_1K + completion_tokens / 1000 * LLM_COMPLETION_COST_PER_1K
+    metrics.inc("llm_cost_usd", cost, **labels)
+
+
 # Function to create OpenAI client
 def create_openai_client():
     try:
-        client = AzureOpenAI(
-            api_key=AZURE_API_KEY,
-            api_version=AZURE_API_VERSION,
-            azure_endpoint=AZURE_ENDPOINT
-        )
-        return client
+        with get_metrics().span("client_create"):
+            return get_shared_openai_client()
     except Exception as e:
         st.error(f"Error creating OpenAI client: {str(e)}")
         return None
@@ -673,43 +694,2380 @@ def encode_image(image_bytes):
     return base64.b64encode(image_bytes).decode('utf-8')
 
 
-# Small helper to convert basic markdown (bold, italics, bullet lists) to HTML
+# Two-tier response cache: a per-process LRU with TTL backed by a SQLite file replicas can share
+class ResponseCache:
+    def __init__(self, db_path=None, max_entries=512, ttl_seconds=86400):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.db_path = db_path
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._writes = 0
+        if self.db_path:
+            try:
+                os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+                with self._connect() as conn:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.execute(
+                        "CREATE TABLE IF NOT EXISTS responses ("
+                        "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+                    )
+            except sqlite3.Error:
+                # The cache is an optimisation; fall back to memory only
+                self.db_path = None
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=5)
+
+    def _remember(self, key, value, expires_at):
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    return entry[1]
+                del self._entries[key]
+        if not self.db_path:
+            return None
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT value, expires_at FROM responses WHERE key = ? AND expires_at > ?", (key, now)
+                ).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        self._remember(key, row[0], row[1])
+        return row[0]
+
+    # When the cached answer for `key` expires, or None if there is none
+    def expires_at(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                return entry[0]
+        if not self.db_path:
+            return None
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT expires_at FROM responses WHERE key = ? AND expires_at > ?", (key, time.time())
+                ).fetchone()
+        except sqlite3.Error:
+            return None
+        return row[0] if row else None
+
+    def set(self, key, value):
+        expires_at = time.time() + self.ttl_seconds
+        self._remember(key, value, expires_at)
+        if not self.db_path:
+            return
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, value, expires_at),
+                )
+                self._writes += 1
+                if self._writes % 100 == 0:
+                    conn.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+        except sqlite3.Error:
+            pass
+
+
+@st.cache_resource
+def get_response_cache():
+    return ResponseCache(RESPONSE_CACHE_DB_PATH, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL_SECONDS)
+
+
+# Answers are only cached when the sampling parameters are pinned
+def response_cache_enabled():
+    return RESPONSE_CACHE_ENABLED and CACHEABLE_MODE
+
+
+def get_sampling_params():
+    if CACHEABLE_MODE:
+        return {"temperature": CACHEABLE_TEMPERATURE, "seed": LLM_SEED}
+    return {"temperature": 0.7}
+
+
+def normalize_text(text):
+    return " ".join(str(text or "").lower().split())
+
+
+# Build a stable cache key from normalized prompt inputs plus everything else that shapes the answer
+def make_cache_key(kind, **fields):
+    payload = {
+        "kind": kind,
+        "prompt_version": PROMPT_VERSION,
+        "prompt_style": PROMPT_STYLE,
+        "model": "gpt-4o",
+        "sampling": get_sampling_params(),
+    }
+    for name, value in fields.items():
+        if isinstance(value, (list, tuple, set)):
+            payload[name] = sorted(normalize_text(v) for v in value)
+        elif isinstance(value, str):
+            payload[name] = normalize_text(value)
+        else:
+            payload[name] = value
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def get_cached_response(cache_key):
+    if not response_cache_enabled():
+        return None
+    return get_response_cache().get(cache_key)
+
+
+# Prompt tokens an image counts for: gpt-4o bills 85 + 170 per 512px tile, and photos are at most
+# IMAGE_MAX_EDGE (1024) pixels, which the API scales into four tiles
+IMAGE_PROMPT_TOKENS = 765
+
+
+# Offline tokenizer: tiktoken's o200k_base (the gpt-4o encoding) when it is installed, else None
+@st.cache_resource
+def get_tokenizer():
+    if TOKENIZER != "auto":
+        return None
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        # Not installed, or its vocabulary is neither cached (TIKTOKEN_CACHE_DIR) nor downloadable
+        logger.info("Estimating token counts from text length; tiktoken is not available (%s)", e)
+        return None
+
+
+def count_tokens(text):
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        # About 4 characters per token in English
+        return (len(text) + 3) // 4
+    return len(tokenizer.encode(text, disallowed_special=()))
+
+
+# Prompt size in tokens (plus a few per message for the chat format), used to account requests
+# against the quota and to check the estimate against the usage the API reports
+def estimate_prompt_tokens(messages):
+    tokens = 0
+    for message in messages:
+        tokens += 4
+        content = message["content"]
+        if isinstance(content, str):
+            tokens += count_tokens(content)
+            continue
+        for part in content:
+            if part["type"] == "text":
+                tokens += count_tokens(part["text"])
+            else:
+                tokens += IMAGE_PROMPT_TOKENS
+    return tokens
+
+
+# Completion tokens an answer needs, with headroom, per prompt style: per recommendation, per
+# analysis section, and for the intro and closing lines. Used until enough answers of a shape
+# were seen to size it from them.
+COMPLETION_BUDGETS = {
+    "full": {"recommendation": 140, "section": 160, "overhead": 100},
+    "compact": {"recommendation": 80, "section": 90, "overhead": 60},
+}
+# JSON analyses (STRUCTURED_OUTPUT) list every food; enough for about ten items
+STRUCTURED_ANALYSIS_TOKENS = 900
+# Observed budgets are this much above the p95 completion tokens of their shape
+COMPLETION_BUDGET_HEADROOM = 1.2
+
+
+# What an answer's size depends on: prompt style, JSON or text, and the number of
+# recommendations or analysis sections asked for
+def answer_shape(recommendations=0, sections=0, structured=False):
+    return (PROMPT_STYLE, "json" if structured else "text", recommendations, sections)
+
+
+# max_tokens for an answer of this shape, at most LLM_MAX_TOKENS: the p95 completion tokens of
+# recent answers of the shape with headroom, or COMPLETION_BUDGETS until enough were seen.
+# A smaller budget also takes less of the quota: Azure counts max_tokens against it up front.
+def completion_budget(shape):
+    if not ADAPTIVE_MAX_TOKENS:
+        return LLM_MAX_TOKENS
+    style, kind, recommendations, sections = shape
+    if kind == "json":
+        fallback = STRUCTURED_ANALYSIS_TOKENS
+    else:
+        budget = COMPLETION_BUDGETS.get(style, COMPLETION_BUDGETS["full"])
+        fallback = budget["overhead"] + recommendations * budget["recommendation"] + sections * budget["section"]
+    observed = get_completion_sizes().percentile(shape, 95)
+    tokens = fallback if observed is None else math.ceil(observed * COMPLETION_BUDGET_HEADROOM)
+    return min(LLM_MAX_TOKENS, tokens)
+
+
+# A JSON answer cut off by max_tokens even at LLM_MAX_TOKENS; it cannot be parsed
+class TruncatedAnswerError(RuntimeError):
+    pass
+
+
+class RequestQueueTimeout(RuntimeError):
+    pass
+
+
+# Token buckets for the deployment's TPM and RPM quota in front of a fair queue. Like Azure, a
+# request is charged its estimated prompt tokens plus max_tokens when it is sent. Waiting requests
+# are served in start-time fair queuing order (tags advance by each request's cost), so a session
+# sending many or large requests cannot starve the others. Sessions whose tag the virtual time
+# has passed are forgotten; they would start at the virtual time anyway.
+class RequestScheduler:
+    # Azure evaluates quotas over short windows, so the buckets only hold 10 seconds' worth
+    BURST_SECONDS = 10.0
+
+    def __init__(self, tokens_per_minute, requests_per_minute):
+        self.token_rate = tokens_per_minute / 60.0
+        self.request_rate = requests_per_minute / 60.0
+        self.token_capacity = self.token_rate * self.BURST_SECONDS
+        self.request_capacity = max(1.0, self.request_rate * self.BURST_SECONDS)
+        self.tokens = self.token_capacity
+        self.requests = self.request_capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.virtual_time = 0.0
+        self.finish_tags = {}
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.cond = threading.Condition()
+
+    @property
+    def enabled(self):
+        return self.token_rate > 0 or self.request_rate > 0
+
+    def queue_length(self):
+        with self.cond:
+            return len(self.waiting)
+
+    # Stop sending for a while, e.g. after a 429 with a Retry-After header
+    def pause(self, seconds):
+        with self.cond:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+        self.tokens = min(self.token_capacity, self.tokens + elapsed * self.token_rate)
+        self.requests = min(self.request_capacity, self.requests + elapsed * self.request_rate)
+
+    # Seconds until the buckets can take a request of `cost` tokens. A request larger than the
+    # bucket goes once the bucket is full and leaves it in debt.
+    def _delay(self, cost, now):
+        delay = self.paused_until - now
+        if self.token_rate > 0:
+            delay = max(delay, (min(cost, self.token_capacity) - self.tokens) / self.token_rate)
+        if self.request_rate > 0:
+            delay = max(delay, (1.0 - self.requests) / self.request_rate)
+        return delay
+
+    def _forget_finished_sessions(self):
+        self.finish_tags = {
+            session_id: tag for session_id, tag in self.finish_tags.items() if tag > self.virtual_time
+        }
+
+    def _discard(self, ticket):
+        if ticket in self.waiting:
+            self.waiting.remove(ticket)
+            heapq.heapify(self.waiting)
+        self.cond.notify_all()
+
+    # Take quota only if it is available right now and nobody is waiting for it
+    def try_acquire(self, cost):
+        if not self.enabled:
+            return True
+        with self.cond:
+            now = time.monotonic()
+            self._refill(now)
+            if self.waiting or self._delay(cost, now) > 0:
+                return False
+            self.tokens -= cost
+            self.requests -= 1.0
+            return True
+
+    # Block until the request may be sent. `on_wait(position)` is called whenever the caller's
+    # place in the queue changes. Returns the seconds waited.
+    def acquire(self, session_id, cost, on_wait=None, max_wait=RATE_LIMIT_MAX_WAIT_SECONDS):
+        if not self.enabled:
+            return 0.0
+        started = time.monotonic()
+        with self.cond:
+            previous_tag = self.finish_tags.get(session_id)
+            start_tag = max(self.virtual_time, previous_tag or 0.0)
+            self.finish_tags[session_id] = start_tag + cost
+            ticket = (start_tag, next(self.sequence))
+            heapq.heappush(self.waiting, ticket)
+
+        reported = None
+        try:
+            while True:
+                with self.cond:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if self.waiting[0] == ticket:
+                        delay = self._delay(cost, now)
+                        if delay <= 0:
+                            heapq.heappop(self.waiting)
+                            self.tokens -= cost
+                            self.requests -= 1.0
+                            # Virtual time is the start tag in service, or once the queue is
+                            # empty the finish tag of the last request sent
+                            self.virtual_time = start_tag if self.waiting else max(start_tag + cost, self.virtual_time)
+                            self._forget_finished_sessions()
+                            self.cond.notify_all()
+                            return now - started
+                    else:
+                        delay = None
+                    position = 1 + sum(1 for waiting in self.waiting if waiting < ticket)
+                    if position == reported or on_wait is None:
+                        remaining = started + max_wait - now
+                        if remaining <= 0:
+                            raise RequestQueueTimeout(
+                                "The service is busy right now. Please try again in a minute."
+                            )
+                        self.cond.wait(remaining if delay is None else min(delay, remaining))
+                        continue
+                reported = position
+                on_wait(position)
+        except BaseException:
+            with self.cond:
+                self._discard(ticket)
+                # A request that was never sent is not charged to its session (unless a later
+                # request of the session already queued behind it)
+                if self.finish_tags.get(session_id) == start_tag + cost:
+                    if previous_tag is None:
+                        del self.finish_tags[session_id]
+                    else:
+                        self.finish_tags[session_id] = previous_tag
+            raise
+
+
+@st.cache_resource
+def get_request_scheduler():
+    scheduler = RequestScheduler(RATE_LIMIT_TPM, RATE_LIMIT_RPM)
+    get_metrics().gauge("request_queue_length", scheduler.queue_length)
+    return scheduler
+
+
+# Requests are queued fairly per browser session; work outside a session shares one queue
+def get_scheduler_session_id():
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx is not None else "background"
+
+
+# Seconds to back off after a 429, from the Retry-After headers Azure sends with it
+def get_retry_after(error, default=1.0):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000.0
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return default
+
+
+# Rate limits, server errors, timeouts and dropped connections are worth another attempt
+def is_retryable_error(error):
+    import openai
+
+    if isinstance(error, (TimeoutError, openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    status = getattr(error, "status_code", None)
+    return status == 429 or (status is not None and status >= 500)
+
+
+# Delay before retry number `attempt` (0-based): exponential backoff with full jitter, but at
+# least as long as a 429's Retry-After asks for
+def get_retry_delay(attempt, error):
+    delay = random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2 ** attempt))
+    if getattr(error, "status_code", None) == 429:
+        delay = max(delay, get_retry_after(error))
+    return delay
+
+
+# Recent latencies of non-streamed requests, used to pick the hedging delay
+class LatencyTracker:
+    MIN_SAMPLES = 20
+
+    def __init__(self, window=200):
+        self.samples = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, pct, default=None):
+        with self.lock:
+            samples = sorted(self.samples)
+        if len(samples) < self.MIN_SAMPLES:
+            return default
+        return percentile_of(samples, pct)
+
+
+@st.cache_resource
+def get_latency_tracker():
+    return LatencyTracker()
+
+
+# Completion tokens of recent answers, one window per answer shape (see answer_shape)
+class CompletionSizeTracker:
+    def __init__(self, window=200):
+        self.window = window
+        self.trackers = {}
+        self.lock = threading.Lock()
+
+    def tracker(self, shape):
+        with self.lock:
+            if shape not in self.trackers:
+                self.trackers[shape] = LatencyTracker(self.window)
+            return self.trackers[shape]
+
+    def record(self, shape, tokens):
+        self.tracker(shape).record(tokens)
+
+    def percentile(self, shape, pct, default=None):
+        return self.tracker(shape).percentile(pct, default)
+
+
+@st.cache_resource
+def get_completion_sizes():
+    return CompletionSizeTracker()
+
+
+# Threads for hedged requests; a losing request runs to completion in the background
+@st.cache_resource
+def get_hedge_executor():
+    return ThreadPoolExecutor(max_workers=OPENAI_MAX_CONNECTIONS, thread_name_prefix="eatwise-hedge")
+
+
+# Send `send(timeout)`, and if it has not answered after `hedge_after` seconds and `can_hedge()`
+# allows, send it again with what is left of `timeout`, so both finish by the same deadline. The
+# first successful answer wins; if both fail, the first error is raised.
+def run_hedged(send, hedge_after, can_hedge, timeout):
+    executor = get_hedge_executor()
+    deadline = time.monotonic() + timeout
+    futures = [executor.submit(send, timeout)]
+    done, _ = wait(futures, timeout=hedge_after)
+    if not done:
+        hedge_timeout = deadline - time.monotonic()
+        if hedge_timeout > 0 and can_hedge():
+            futures.append(executor.submit(send, hedge_timeout))
+    error = None
+    for future in as_completed(futures):
+        if future.exception() is None:
+            return future.result()
+        error = error or future.exception()
+    raise error
+
+
+# Send one chat completion request and return its text and finish reason ("length" when max_tokens
+# cut it off), streaming the text into `on_delta` when given. The whole request, streamed or not,
+# must finish within `timeout` seconds. Its latency and token usage are counted under `labels`
+# (helper and goal).
+def request_chat_completion(client, messages, max_tokens, timeout, on_delta=None, response_format=None, labels=None):
+    labels = labels or {}
+    metrics = get_metrics()
+    started = time.perf_counter()
+    if on_delta is not None:
+        deadline = time.monotonic() + timeout
+        extra_params = {"stream_options": {"include_usage": True}} if STREAM_USAGE_ENABLED else {}
+        stream = client.chat.completions.create(
+            model="gpt-4o",
+            messages=messages,
+            max_tokens=max_tokens,
+            stream=True,
+            timeout=timeout,
+            **get_sampling_params(),
+            **extra_params
+        )
+        pieces = []
+        usage = None
+        finish_reason = None
+        try:
+            for chunk in stream:
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"No complete answer within {LLM_TIMEOUT_SECONDS:.0f} seconds")
+                # The last chunk carries the usage when it was asked for
+                usage = getattr(chunk, "usage", None) or usage
+                # Azure sends a leading chunk without choices (content filter results)
+                if not chunk.choices:
+                    continue
+                finish_reason = getattr(chunk.choices[0], "finish_reason", None) or finish_reason
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if not pieces:
+                        metrics.observe("llm_first_token", time.perf_counter() - started, **labels)
+                    pieces.append(delta)
+                    on_delta("".join(pieces))
+        finally:
+            # Give the connection back to the pool even when the stream is abandoned
+            if hasattr(stream, "close"):
+                stream.close()
+        content = "".join(pieces)
+        metrics.observe("llm_request", time.perf_counter() - started, streamed="true", **labels)
+        if usage is not None:
+            record_token_usage(usage.prompt_tokens, usage.completion_tokens, labels)
+        else:
+            record_token_usage(estimate_prompt_tokens(messages), count_tokens(content), labels)
+        record_token_budget(messages, max_tokens, usage, finish_reason, labels)
+        return content, finish_reason
+
+    extra_params = {"response_format": response_format} if response_format else {}
+    response = client.chat.completions.create(
+        model="gpt-4o",
+        messages=messages,
+        max_tokens=max_tokens,
+        timeout=timeout,
+        **get_sampling_params(),
+        **extra_params
+    )
+    metrics.observe("llm_request", time.perf_counter() - started, streamed="false", **labels)
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        record_token_usage(usage.prompt_tokens, usage.completion_tokens, labels)
+    finish_reason = getattr(response.choices[0], "finish_reason", None)
+    record_token_budget(messages, max_tokens, usage, finish_reason, labels)
+    return response.choices[0].message.content, finish_reason
+
+
+# A request being answered, shared by every identical request that arrives meanwhile
+class InFlightCall:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.text = ""
+        self.finished = False
+        self.abandoned = False
+        self.result = None
+        self.error = None
+
+    # Streamed text received so far by the leader
+    def publish(self, text):
+        with self.cond:
+            self.text = text
+            self.cond.notify_all()
+
+    def finish(self, result=None, error=None, abandoned=False):
+        with self.cond:
+            self.finished = True
+            self.result = result
+            self.error = error
+            self.abandoned = abandoned
+            self.cond.notify_all()
+
+    # Wait for the leader's answer, passing its streamed text on to `on_delta` as it arrives.
+    # Streamlit calls happen here, in the follower's own thread.
+    def follow(self, on_delta=None):
+        seen = ""
+        while True:
+            with self.cond:
+                while not self.finished and (on_delta is None or self.text == seen):
+                    self.cond.wait()
+                if self.finished:
+                    if self.error is not None:
+                        raise self.error
+                    return self.result
+                seen = self.text
+            on_delta(seen)
+
+
+# Single-flight: identical requests in flight at the same time (same cache key) share one
+# upstream call and its answer, e.g. when many sessions click the same quick suggestion
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    # Run `fn(publish)` unless an identical call is already running. `publish(text)` forwards the
+    # leader's streamed text to the followers.
+    def run(self, key, fn, on_delta=None):
+        while True:
+            with self.lock:
+                call = self.calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self.calls[key] = InFlightCall()
+            if leader:
+                break
+            result = call.follow(on_delta)
+            # The leader's session stopped (e.g. it reran) before the answer was in; try again
+            if not call.abandoned:
+                return result
+
+        try:
+            result = fn(call.publish)
+        except Exception as e:
+            call.finish(error=e)
+            raise
+        except BaseException:
+            call.finish(abandoned=True)
+            raise
+        else:
+            call.finish(result=result)
+            return result
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+
+
+@st.cache_resource
+def get_single_flight():
+    return SingleFlight()
+
+
+# Run a chat completion, serving and storing the answer through the response cache.
+# `messages` may be a callable so expensive payloads are only built on a cache miss.
+# When `on_delta` is given the completion is streamed and it receives the text received so far.
+# Identical requests already in flight are joined rather than sent again.
+# With `refresh` a new answer is fetched and cached even if there is a cached one. Answers cut off
+# by max_tokens are not cached.
+# `labels` (helper, and goal for recommendations) break the metrics down by caller.
+# With a `shape` (see answer_shape), max_tokens is sized by completion_budget and the answer's
+# length is recorded for later budgets.
+def run_chat_completion(client, cache_key, messages, max_tokens=LLM_MAX_TOKENS, on_delta=None, response_format=None, on_queue=None, refresh=False, labels=None, shape=None):
+    labels = labels or {}
+    metrics = get_metrics()
+    cache = get_response_cache() if response_cache_enabled() else None
+    if cache is not None and not refresh:
+        cached = cache.get(cache_key)
+        metrics.inc("cache_lookups", cache="response", result="miss" if cached is None else "hit", **labels)
+        if cached is not None:
+            return cached
+
+    led = []
+
+    def complete(publish):
+        led.append(True)
+
+        def forward_delta(text):
+            publish(text)
+            on_delta(text)
+
+        content, finish_reason = complete_with_retries(
+            client,
+            messages,
+            completion_budget(shape) if shape is not None else max_tokens,
+            on_delta=forward_delta if on_delta is not None else None,
+            response_format=response_format,
+            on_queue=on_queue,
+            labels=labels
+        )
+        if shape is not None and content:
+            get_completion_sizes().record(shape, count_tokens(content))
+        if cache is not None and content and finish_reason != "length":
+            cache.set(cache_key, content)
+        return content
+
+    started = time.perf_counter()
+    try:
+        return get_single_flight().run(cache_key, complete, on_delta)
+    except Exception as e:
+        metrics.inc("llm_failures", error=type(e).__name__, **labels)
+        raise
+    finally:
+        metrics.observe("llm_call", time.perf_counter() - started, **labels)
+        # Requests that joined an identical one in flight
+        metrics.inc("cache_lookups", cache="single_flight", result="hit" if not led else "miss", **labels)
+
+
+# Send a chat completion once there is quota for it and return its text and finish reason.
+# Requests wait in the RequestScheduler queue; `on_queue(position)` reports their place. Failed
+# attempts are retried until LLM_TIMEOUT_SECONDS after the first one was sent. A text answer cut
+# off by an adaptive max_tokens is continued, with the rest of LLM_MAX_TOKENS, where it stopped;
+# a JSON answer is asked for again with LLM_MAX_TOKENS, and raises TruncatedAnswerError if it is
+# still cut off.
+def complete_with_retries(client, messages, max_tokens, on_delta=None, response_format=None, on_queue=None, labels=None):
+    labels = labels or {}
+    metrics = get_metrics()
+    if callable(messages):
+        with metrics.span("build_messages", **labels):
+            messages = messages()
+    content, finish_reason = send_with_retries(client, messages, max_tokens, on_delta, response_format, on_queue, labels)
+    if finish_reason == "length" and max_tokens < LLM_MAX_TOKENS and response_format:
+        metrics.inc("llm_length_retries", **labels)
+        logger.warning("%s: asking again with max_tokens %d", labels.get("helper", "LLM call"), LLM_MAX_TOKENS)
+        content, finish_reason = send_with_retries(client, messages, LLM_MAX_TOKENS, on_delta, response_format, on_queue, labels)
+    elif finish_reason == "length" and max_tokens < LLM_MAX_TOKENS:
+        metrics.inc("llm_length_retries", **labels)
+        logger.warning("%s: continuing with max_tokens %d", labels.get("helper", "LLM call"), LLM_MAX_TOKENS - max_tokens)
+        partial = content
+        continuation = messages + [
+            {"role": "assistant", "content": partial},
+            {"role": "user", "content": "Continue exactly where you stopped, without repeating anything."},
+        ]
+        # What is already on screen stays, and the rest is streamed after it
+        on_rest = (lambda text: on_delta(partial + text)) if on_delta is not None else None
+        rest, finish_reason = send_with_retries(
+            client, continuation, LLM_MAX_TOKENS - max_tokens, on_rest, response_format, on_queue, labels
+        )
+        content = partial + (rest or "")
+    if finish_reason == "length" and response_format:
+        raise TruncatedAnswerError(f"The answer did not fit in {LLM_MAX_TOKENS} tokens")
+    return content, finish_reason
+
+
+# One answer from complete_with_retries at a fixed max_tokens
+def send_with_retries(client, messages, max_tokens, on_delta, response_format, on_queue, labels):
+    metrics = get_metrics()
+    scheduler = get_request_scheduler()
+    session_id = get_scheduler_session_id()
+    cost = estimate_prompt_tokens(messages) + max_tokens
+
+    # Partial JSON cannot be split into cards, so structured answers are never streamed
+    streaming = on_delta is not None and STREAMING_ENABLED and not response_format
+    streamed = []
+
+    def forward_delta(text):
+        streamed.append(True)
+        on_delta(text)
+
+    deadline = None
+    for attempt in itertools.count():
+        with metrics.span("queue_wait", **labels):
+            scheduler.acquire(session_id, cost, on_queue)
+        if deadline is None:
+            deadline = time.monotonic() + LLM_TIMEOUT_SECONDS
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"No answer within {LLM_TIMEOUT_SECONDS:.0f} seconds")
+        try:
+            if streaming:
+                result = request_chat_completion(client, messages, max_tokens, remaining, forward_delta, labels=labels)
+            else:
+                def send(timeout):
+                    started = time.monotonic()
+                    answer = request_chat_completion(
+                        client, messages, max_tokens, timeout, response_format=response_format, labels=labels
+                    )
+                    get_latency_tracker().record(time.monotonic() - started)
+                    return answer
+
+                if LLM_HEDGING_ENABLED:
+                    hedge_after = get_latency_tracker().percentile(95, LLM_HEDGE_DELAY_SECONDS)
+                    result = run_hedged(send, hedge_after, lambda: scheduler.try_acquire(cost), remaining)
+                else:
+                    result = send(remaining)
+            break
+        except Exception as e:
+            metrics.inc("llm_request_errors", error=type(e).__name__, **labels)
+            # Over quota anyway (e.g. other clients share the deployment): hold back everyone's requests
+            if getattr(e, "status_code", None) == 429:
+                scheduler.pause(get_retry_after(e))
+            # Once part of an answer is on screen it is not started over
+            if attempt >= LLM_MAX_RETRIES or streamed or not is_retryable_error(e):
+                raise
+            delay = get_retry_delay(attempt, e)
+            if time.monotonic() + delay >= deadline:
+                raise
+            metrics.inc("llm_retries", **labels)
+            logger.warning("LLM request failed (%s), retrying in %.1fs", e, delay)
+            time.sleep(delay)
+    return result
+
+
+# Detect the real image type from its magic bytes (uploads are not always JPEG)
+def detect_image_mime(image_bytes):
+    if image_bytes.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if image_bytes.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if image_bytes[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if image_bytes[:4] == b"RIFF" and image_bytes[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/jpeg"
+
+
+# Downscale to IMAGE_MAX_EDGE, re-encode and strip EXIF before the photo is base64-encoded.
+# Returns the bytes to upload, their MIME type and how many bytes were saved.
+@st.cache_data(max_entries=32, show_spinner=False)
+def preprocess_image(image_bytes, max_edge=IMAGE_MAX_EDGE, quality=IMAGE_JPEG_QUALITY):
+    result = {
+        "bytes": image_bytes,
+        "mime": detect_image_mime(image_bytes),
+        "original_size": len(image_bytes),
+        "size": len(image_bytes),
+        "bytes_saved": 0,
+    }
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return result
+
+    try:
+        with Image.open(BytesIO(image_bytes)) as img:
+            had_exif = bool(img.info.get("exif"))
+            # Bake the EXIF orientation into the pixels before the metadata is dropped
+            img = ImageOps.exif_transpose(img)
+            resized = max(img.size) > max_edge
+            if resized:
+                img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+            has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+            out = BytesIO()
+            if has_alpha:
+                img.save(out, format="PNG", optimize=True)
+                mime = "image/png"
+            else:
+                img.convert("RGB").save(out, format="JPEG", quality=quality, optimize=True)
+                mime = "image/jpeg"
+    except Exception:
+        return result
+
+    processed = out.getvalue()
+    # Re-encoding a small, already-compressed photo can make it bigger; keep the original then
+    if len(processed) >= len(image_bytes) and not resized and not had_exif:
+        return result
+    result.update(
+        bytes=processed,
+        mime=mime,
+        size=len(processed),
+        bytes_saved=len(image_bytes) - len(processed),
+    )
+    return result
+
+
+# 64-bit difference hash of an image; stable across recompression and resizing
+def compute_image_phash(image_bytes):
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    try:
+        with Image.open(BytesIO(image_bytes)) as img:
+            pixels = list(img.convert("L").resize((9, 8)).getdata())
+    except Exception:
+        return None
+    phash = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            phash = (phash << 1) | (1 if left > right else 0)
+    return phash
+
+
+# Maps perceptual hashes of analysed images to their response-cache keys. Entries expire with the
+# answers they point to (the response-cache TTL), and lookups scan at most MAX_ENTRIES of the newest.
+class ImageHashIndex:
+    MAX_ENTRIES = 5000
+
+    def __init__(self, db_path=None, ttl_seconds=86400):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        # (phash, context, cache_key, created_at), used when there is no database
+        self._entries = deque(maxlen=self.MAX_ENTRIES)
+        self._lock = threading.Lock()
+        self._writes = 0
+        if self.db_path:
+            try:
+                os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+                with sqlite3.connect(self.db_path, timeout=5) as conn:
+                    conn.execute(
+                        "CREATE TABLE IF NOT EXISTS image_hashes ("
+                        "phash TEXT NOT NULL, context TEXT NOT NULL, cache_key TEXT NOT NULL, created_at REAL NOT NULL)"
+                    )
+                    conn.execute("CREATE INDEX IF NOT EXISTS idx_image_hashes_context ON image_hashes (context)")
+            except sqlite3.Error:
+                self.db_path = None
+
+    def _candidates(self, context):
+        cutoff = time.time() - self.ttl_seconds
+        if not self.db_path:
+            with self._lock:
+                while self._entries and self._entries[0][3] <= cutoff:
+                    self._entries.popleft()
+                return [(p, k) for p, c, k, _ in self._entries if c == context]
+        try:
+            with sqlite3.connect(self.db_path, timeout=5) as conn:
+                rows = conn.execute(
+                    "SELECT phash, cache_key FROM image_hashes WHERE context = ? AND created_at > ? "
+                    "ORDER BY created_at DESC LIMIT ?",
+                    (context, cutoff, self.MAX_ENTRIES),
+                ).fetchall()
+        except sqlite3.Error:
+            return []
+        return [(int(p, 16), k) for p, k in rows]
+
+    def find(self, phash, context, max_distance):
+        best_key, best_distance = None, max_distance + 1
+        for candidate, cache_key in self._candidates(context):
+            distance = bin(candidate ^ phash).count("1")
+            if distance < best_distance:
+                best_key, best_distance = cache_key, distance
+        return best_key
+
+    def add(self, phash, context, cache_key):
+        if not self.db_path:
+            with self._lock:
+                self._entries.append((phash, context, cache_key, time.time()))
+            return
+        try:
+            with sqlite3.connect(self.db_path, timeout=5) as conn:
+                conn.execute(
+                    "INSERT INTO image_hashes (phash, context, cache_key, created_at) VALUES (?, ?, ?, ?)",
+                    (f"{phash:016x}", context, cache_key, time.time()),
+                )
+                self._writes += 1
+                if self._writes % 100 == 0:
+                    conn.execute("DELETE FROM image_hashes WHERE created_at <= ?", (time.time() - self.ttl_seconds,))
+        except sqlite3.Error:
+            pass
+
+
+@st.cache_resource
+def get_image_hash_index():
+    return ImageHashIndex(RESPONSE_CACHE_DB_PATH, RESPONSE_CACHE_TTL_SECONDS)
+
+
+# Words that carry no meaning for matching queries, and synonyms folded into one form, so the
+# local vectorizer matches common paraphrases ("nutritious breakfast options" ~ "healthy breakfast ideas")
+SEMANTIC_STOPWORDS = frozenset(
+    "a an and are for from i in is it me my of on or please some that the to what which with "
+    "can could would should give show suggest recommend tell good best any".split()
+)
+SEMANTIC_SYNONYMS = {
+    "nutritious": "healthy", "wholesome": "healthy", "healthier": "healthy",
+    "option": "idea", "suggestion": "idea", "choice": "idea", "recommendation": "idea",
+    "dish": "meal", "food": "meal", "recipe": "meal",
+    "snacking": "snack", "protein-rich": "protein", "high-protein": "protein",
+    "low-calorie": "low-cal", "lunchtime": "lunch", "supper": "dinner", "morning": "breakfast",
+}
+
+
+# Stable bucket and sign for a feature (Python's hash() changes per process)
+def semantic_feature_hash(feature):
+    value = zlib.crc32(feature.encode("utf-8"))
+    return value >> 1, value & 1
+
+
+# Local, offline text embedding: hashed word unigrams and bigrams after stopword removal,
+# naive plural stripping and synonym folding, L2-normalised
+class HashingVectorizer:
+    def __init__(self, dim=256):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def terms(self, text):
+        words = []
+        for word in re.findall(r"[a-z0-9][a-z0-9\-]*", normalize_text(text)):
+            if word in SEMANTIC_STOPWORDS:
+                continue
+            word = SEMANTIC_SYNONYMS.get(word, word)
+            if len(word) > 3 and word.endswith("s") and not word.endswith(("ss", "us", "is")):
+                word = SEMANTIC_SYNONYMS.get(word[:-1], word[:-1])
+            words.append(word)
+        return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+    def embed(self, text):
+        import numpy as np
+
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for term in self.terms(text):
+            bucket, sign = semantic_feature_hash(term)
+            vector[bucket % self.dim] += 1.0 if sign else -1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+# Embeddings from an Azure OpenAI embeddings deployment
+class AzureEmbedder:
+    def __init__(self, deployment, dim):
+        self.deployment = deployment
+        self.dim = dim
+        self.name = f"azure-{deployment}-{dim}"
+
+    def embed(self, text):
+        import numpy as np
+
+        response = get_shared_openai_client().embeddings.create(
+            model=self.deployment, input=normalize_text(text), dimensions=self.dim
+        )
+        vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+# Query embeddings in memory-mapped files (float32 vectors, a scope id per row and the
+# response-cache key each row points to), searched with one matrix-vector product.
+# Grows by doubling up to `max_entries`, then overwrites the oldest rows. Several processes
+# (replicas sharing EATWISE_DATA_DIR) can use the same files: every search and add holds a
+# lock on the directory's `lock` file and picks up rows other processes added from meta.json.
+class SemanticIndex:
+    def __init__(self, path, dim, embedder_name, max_entries=200000):
+        self.path = path
+        self.dim = dim
+        self.max_entries = max_entries
+        self.embedder_name = embedder_name
+        self._lock = threading.Lock()
+        self.count = 0
+        self.next_row = 0
+        self.capacity = 0
+        self.vectors = self.scopes = self.keys = None
+        os.makedirs(self.path, exist_ok=True)
+        with self._locked():
+            meta = self._read_meta()
+            # Vectors from another embedder or size are not comparable; start over
+            if meta.get("embedder") == embedder_name and meta.get("dim") == dim:
+                self._load_meta(meta)
+            else:
+                self._open(min(1024, max_entries))
+                self._write_meta()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    # Hold the thread lock and an exclusive (or shared) lock on the index files for other
+    # processes. Without fcntl (Windows) only this process's threads are kept apart.
+    @contextmanager
+    def _locked(self, shared=False):
+        with self._lock:
+            try:
+                import fcntl
+            except ImportError:
+                yield
+                return
+            with open(self._file("lock"), "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_meta(self):
+        try:
+            with open(self._file("meta.json"), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _load_meta(self, meta):
+        if meta["capacity"] != self.capacity:
+            self._open(meta["capacity"])
+        self.count = meta["count"]
+        self.next_row = meta["next_row"]
+
+    # Catch up with rows other processes added (meta.json is small; reading it costs far less
+    # than a search)
+    def _refresh(self):
+        meta = self._read_meta()
+        if meta.get("embedder") == self.embedder_name and meta.get("dim") == self.dim:
+            self._load_meta(meta)
+
+    def _write_meta(self):
+        meta = {
+            "embedder": self.embedder_name, "dim": self.dim, "count": self.count,
+            "next_row": self.next_row, "capacity": self.capacity,
+        }
+        tmp_path = self._file("meta.json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self._file("meta.json"))
+
+    # (Re)map the files at `capacity` rows; files are extended in place and existing rows kept
+    def _open(self, capacity):
+        import numpy as np
+
+        def mapped(name, dtype, shape):
+            path = self._file(name)
+            size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            with open(path, "ab") as f:
+                if f.tell() < size:
+                    f.truncate(size)
+            return np.memmap(path, dtype=dtype, mode="r+", shape=shape)
+
+        self.capacity = capacity
+        self.vectors = mapped("vectors.f32", np.float32, (capacity, self.dim))
+        self.scopes = mapped("scopes.u64", np.uint64, (capacity,))
+        self.keys = mapped("keys.s64", "S64", (capacity,))
+
+    def search(self, vector, scope, k=1):
+        import numpy as np
+
+        with self._locked(shared=True):
+            self._refresh()
+            rows = np.flatnonzero(self.scopes[:self.count] == np.uint64(scope))
+            if not len(rows):
+                return []
+            # Gathering many rows costs more than scoring the whole contiguous block
+            if len(rows) * 4 > self.count:
+                sims = (self.vectors[:self.count] @ vector)[rows]
+            else:
+                sims = self.vectors[rows] @ vector
+            top = np.argpartition(-sims, k - 1)[:k] if len(sims) > k else np.arange(len(sims))
+            top = top[np.argsort(-sims[top])]
+            return [(float(sims[i]), self.keys[rows[i]].decode("ascii")) for i in top]
+
+    def add(self, vector, scope, cache_key):
+        with self._locked():
+            self._refresh()
+            key = cache_key.encode("ascii")
+            if (self.keys[:self.count] == key).any():
+                return
+            if self.next_row >= self.capacity:
+                if self.capacity < self.max_entries:
+                    self._open(min(self.capacity * 2, self.max_entries))
+                else:
+                    self.next_row = 0
+            row = self.next_row
+            self.vectors[row] = vector
+            self.scopes[row] = scope
+            self.keys[row] = key
+            # Rows reach the files before meta.json counts them
+            for array in (self.vectors, self.scopes, self.keys):
+                array.flush()
+            self.next_row += 1
+            self.count = max(self.count, self.next_row)
+            self._write_meta()
+
+    def __len__(self):
+        return self.count
+
+
+# Semantic cache in front of the response cache: a query that paraphrases an earlier one with
+# the same scope (health goal, restrictions and every other prompt input) is answered with that
+# query's cached response
+class SemanticCache:
+    def __init__(self, embedder, index, min_similarity):
+        self.embedder = embedder
+        self.index = index
+        self.min_similarity = min_similarity
+
+    def find(self, text, scope):
+        try:
+            vector = self.embedder.embed(text)
+        except Exception as e:
+            logger.warning("Could not embed query for the semantic cache: %s", e)
+            return None
+        for similarity, cache_key in self.index.search(vector, scope, k=3):
+            if similarity < self.min_similarity:
+                break
+            # The answer may have expired from the response cache since it was indexed
+            cached = get_cached_response(cache_key)
+            if cached is not None:
+                return cached
+        return None
+
+    def add(self, text, scope, cache_key):
+        try:
+            self.index.add(self.embedder.embed(text), scope, cache_key)
+        except Exception as e:
+            logger.warning("Could not add query to the semantic cache: %s", e)
+
+
+@st.cache_resource
+def get_semantic_cache():
+    if EMBEDDINGS_DEPLOYMENT:
+        embedder = AzureEmbedder(EMBEDDINGS_DEPLOYMENT, SEMANTIC_CACHE_DIM)
+    else:
+        embedder = HashingVectorizer(SEMANTIC_CACHE_DIM)
+    index = SemanticIndex(SEMANTIC_CACHE_PATH, embedder.dim, embedder.name, SEMANTIC_CACHE_MAX_ENTRIES)
+    return SemanticCache(embedder, index, SEMANTIC_CACHE_MIN_SIMILARITY)
+
+
+def semantic_cache_enabled():
+    return SEMANTIC_CACHE_ENABLED and response_cache_enabled()
+
+
+# Scope of a query: everything besides the query text that shapes the answer, as a 64-bit id
+def make_semantic_scope(kind, **fields):
+    return int(make_cache_key(kind, **fields)[:16], 16)
+
+
+# Cached answer to a paraphrase of `text` in the same scope. Only looked up when the exact
+# cache key misses; exact hits are served by run_chat_completion.
+def find_semantic_response(cache_key, text, scope, labels=None):
+    if get_cached_response(cache_key) is not None:
+        return None
+    similar = get_semantic_cache().find(text, scope)
+    get_metrics().inc("cache_lookups", cache="semantic", result="miss" if similar is None else "hit", **(labels or {}))
+    return similar
+
+
+# Markdown subset used by the model's answers, compiled once. Block syntax is recognised per line:
+# headings, bullets (-, *, +) and numbered items, nested by indentation, and horizontal rules.
+_MD_BLOCK_RE = re.compile(
+    r'^(?P<indent>[ \t]*)(?:'
+    r'(?P<heading>#{1,6})\s+(?P<heading_text>.*?)\s*#*'
+    r'|(?P<bullet>[-*+])\s+(?P<bullet_text>.*)'
+    r'|(?P<number>\d{1,9})[.)]\s+(?P<number_text>.*)'
+    r'|(?P<rule>(?:-\s*){3,}|(?:\*\s*){3,}|(?:_\s*){3,})'
+    r')$'
+)
+_MD_BLOCK_START = frozenset('#-*+_0123456789')
+# Inline formatting, applied in one scan of the escaped text: ***bold italic***, **bold**,
+# __bold__, *italic*, _italic_ and `code`. Starting with a character class lets the scanner skip
+# plain text quickly. **bold** may contain *italic*, which is formatted when the bold text is.
+# Asterisks next to a digit outside the marked text are arithmetic ("5*3 = 15 and 2*4"), not
+# emphasis.
+_MD_INLINE_RE = re.compile(
+    r'[*_`](?:'
+    r'(?<=\*)(?<!\d\*)\*\*([^\s*][^*\n]*?)(?<!\s)\*\*\*(?!\d)'
+    r'|(?<=\*)(?<!\d\*)\*([^\n]+?)\*\*(?!\d)'
+    r'|(?<=_)_([^_\n]+)__'
+    r'|(?<=\*)(?<![\d*]\*)([^\s*][^*\n]*?)(?<!\s)\*(?!\d)'
+    r'|(?<=_)(?<!\w_)([^\s_][^_\n]*)(?<!\s)_(?!\w)'
+    r'|(?<=`)([^`\n]+)`'
+    r')'
+)
+# Opening/closing tags by the number of the group that matched
+_MD_INLINE_TAGS = (
+    None,
+    ('<strong><em>', '</em></strong>'),
+    ('<strong>', '</strong>'),
+    ('<strong>', '</strong>'),
+    ('<em>', '</em>'),
+    ('<em>', '</em>'),
+    ('<code>', '</code>'),
+)
+
+
+def _md_inline_sub(match):
+    group = match.lastindex
+    open_tag, close_tag = _MD_INLINE_TAGS[group]
+    inner = match.group(group)
+    if group == 2 and '*' in inner:
+        inner = _MD_INLINE_RE.sub(_md_inline_sub, inner)
+    return open_tag + inner + close_tag
+
+
+# Escape untrusted text and apply inline formatting
+def md_inline_to_html(text: str) -> str:
+    text = html.escape(text, quote=False)
+    if '*' not in text and '_' not in text and '`' not in text:
+        return text
+    return _MD_INLINE_RE.sub(_md_inline_sub, text)
+
+
+# Convert the markdown subset used by model answers to HTML in one pass over the lines.
+# Model output is untrusted, so all text is HTML-escaped.
 def md_to_html(md_text: str) -> str:
     if not md_text:
         return ""
-    lines = md_text.splitlines()
     out = []
-    in_ul = False
-    for raw in lines:
-        line = raw.rstrip()
+    lists = []  # open lists, innermost last: [indent, tag]
+    block_match = _MD_BLOCK_RE.match
+    block_start = _MD_BLOCK_START
+
+    def close_lists():
+        while lists:
+            out.append(f'</li></{lists.pop()[1]}>')
+
+    for line in md_inline_to_html(md_text).splitlines():
         stripped = line.strip()
-        # bullet list
-        if stripped.startswith('- '):
-            if not in_ul:
-                in_ul = True
-                out.append('<ul>')
-            item = stripped[2:].strip()
-            # inline formatting
-            item = re.sub(r'\*\*(.+?)\*\*', r'<strong>\1</strong>', item)
-            item = re.sub(r'\*(.+?)\*', r'<em>\1</em>', item)
-            out.append(f'<li>{item}</li>')
+        if not stripped:
+            # Blank lines between list items do not end the list
+            continue
+        m = block_match(line) if stripped[0] in block_start else None
+        if m is None:
+            close_lists()
+            out.append(f'<p>{stripped}</p>')
+            continue
+        if m.group('heading'):
+            close_lists()
+            level = min(len(m.group('heading')) + 2, 6)
+            out.append(f'<h{level}>{m.group("heading_text")}</h{level}>')
+            continue
+        if m.group('rule'):
+            close_lists()
+            out.append('<hr>')
+            continue
+
+        indent = len(m.group('indent').expandtabs(4))
+        if m.group('bullet'):
+            tag, text, start = 'ul', m.group('bullet_text'), None
+        else:
+            tag, text, start = 'ol', m.group('number_text'), int(m.group('number'))
+        # Close deeper lists, and a list of the other kind at the same depth
+        while lists and (lists[-1][0] > indent or (lists[-1][0] == indent and lists[-1][1] != tag)):
+            out.append(f'</li></{lists.pop()[1]}>')
+        if lists and lists[-1][0] == indent:
+            out.append(f'</li><li>{text.strip()}')
+        else:
+            lists.append([indent, tag])
+            opening = f'<ol start="{start}">' if tag == 'ol' and start != 1 else f'<{tag}>'
+            out.append(f'{opening}<li>{text.strip()}')
+    close_lists()
+    return '\n'.join(out)
+
+# Split a recommendation response into its numbered items, dropping the chatty intro sentence
+def split_recommendation_parts(resp_text):
+    # Split by numbered items (1. 2. 3. etc.)
+    parts = re.split(r'\n(?=\d+\.\s+\*\*)', resp_text)
+    parts = [p.strip() for p in parts if p.strip()]
+
+    # Filter out only the INTRO sentence (not "Why it fits")
+    intro_keywords = ['certainly', 'here are', 'sure thing', 'of course',
+                    'glad to help', "i'd be happy", 'let me suggest']
+
+    filtered_parts = []
+    for part in parts:
+        # Skip only if it's a short intro sentence at the start
+        is_intro = (
+            len(part.split()) < 30 and
+            any(kw in part.lower() for kw in intro_keywords) and
+            not part.strip().startswith('**') and  # Not a titled section
+            not re.match(r'^\d+\.', part.strip())  # Not a numbered item
+        )
+        if not is_intro:
+            filtered_parts.append(part)
+
+    # Fallback if everything was filtered
+    if not filtered_parts:
+        filtered_parts = parts
+    return filtered_parts
+
+
+def recommendation_card_html(part):
+    lines = part.splitlines()
+
+    # Extract title (first line, remove numbering)
+    title = lines[0].strip() if lines else "Recommendation"
+    title_clean = re.sub(r'^\d+\.\s*', '', title)  # Remove "1. "
+    title_clean = md_inline_to_html(title_clean.strip('*').strip())   # Remove markdown stars
+
+    # Extract body (everything after first line)
+    body = "\n".join(lines[1:]).strip() if len(lines) > 1 else ""
+
+    # Convert to HTML (preserves "Why it fits" since it's in the body)
+    body_html = md_to_html(body)
+
+    return f'''<div class="recommendation-box">
+                                <div class="result-label">{title_clean}</div>
+                                <div class="result-value">{body_html}</div>
+                            </div>'''
+
+
+# Split an analysis into sections by numbered headings or markdown headings (e.g., '1.' or '###')
+def split_analysis_sections(analysis_text):
+    sections = re.split(r"\n(?=\s*(?:\d+\.|#{1,6}\s))", "\n" + analysis_text)
+    return [s.strip() for s in sections if s and s.strip()]
+
+
+def analysis_card_html(section):
+    # determine title and body
+    lines = section.splitlines()
+    first = lines[0].strip() if lines else ''
+    # if first line looks like a heading (starts with digits or #), extract label
+    m = re.match(r'^(?:#{1,6}\s*)?(\d+\.?\s*)(.*)', first)
+    if m:
+        title = m.group(2).strip() if m.group(2) else f"Section {m.group(1).strip()}"
+    else:
+        # remove leading markdown hashes if present
+        title = re.sub(r'^#{1,6}\s*', '', first).strip()
+    title_clean = md_inline_to_html(title.strip().strip('*').strip())
+    body = '\n'.join(lines[1:]).strip() if len(lines) > 1 else ''
+    body_html = md_to_html(body)
+    return f'<div class="nutrition-analysis-box"><div class="result-label">{title_clean}</div><div class="result-value">{body_html}</div></div>'
+
+
+# JSON schema for structured nutrition analyses (response_format="json_schema")
+_MACRO_FIELDS = ("calories", "protein_g", "carbs_g", "fat_g")
+
+NUTRITION_ANALYSIS_SCHEMA = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "nutrition_analysis",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "summary": {"type": "string"},
+                "items": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "name": {"type": "string"},
+                            "portion": {"type": "string"},
+                            "calories": {"type": "number"},
+                            "protein_g": {"type": "number"},
+                            "carbs_g": {"type": "number"},
+                            "fat_g": {"type": "number"},
+                        },
+                        "required": ["name", "portion", *_MACRO_FIELDS],
+                        "additionalProperties": False,
+                    },
+                },
+                "key_nutrients": {"type": "array", "items": {"type": "string"}},
+                "health_assessment": {"type": "string"},
+                "recommendations": {"type": "array", "items": {"type": "string"}},
+                "suitable_for": {"type": "array", "items": {"type": "string"}},
+            },
+            "required": ["summary", "items", "key_nutrients", "health_assessment", "recommendations", "suitable_for"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+STRUCTURED_OUTPUT_INSTRUCTION = (
+    "Return the analysis as JSON matching the provided schema. Give one entry in `items` per food "
+    "with numeric calories and macronutrients in grams; use `key_nutrients` for vitamins and minerals."
+)
+
+
+@dataclass
+class FoodItem:
+    name: str
+    portion: str = ""
+    calories: float = 0.0
+    protein_g: float = 0.0
+    carbs_g: float = 0.0
+    fat_g: float = 0.0
+
+
+@dataclass
+class NutritionAnalysis:
+    summary: str = ""
+    items: list = field(default_factory=list)
+    key_nutrients: list = field(default_factory=list)
+    health_assessment: str = ""
+    recommendations: list = field(default_factory=list)
+    suitable_for: list = field(default_factory=list)
+
+    @classmethod
+    def from_dict(cls, data):
+        items = []
+        for item in data.get("items") or []:
+            values = {name: float(item.get(name) or 0) for name in _MACRO_FIELDS}
+            items.append(FoodItem(name=str(item.get("name", "")), portion=str(item.get("portion", "")), **values))
+        return cls(
+            summary=str(data.get("summary", "")),
+            items=items,
+            key_nutrients=[str(n) for n in data.get("key_nutrients") or []],
+            health_assessment=str(data.get("health_assessment", "")),
+            recommendations=[str(r) for r in data.get("recommendations") or []],
+            suitable_for=[str(g) for g in data.get("suitable_for") or []],
+        )
+
+    def totals(self):
+        return {name: sum(getattr(item, name) for item in self.items) for name in _MACRO_FIELDS}
+
+    def to_dataframe(self):
+        import pandas as pd
+
+        df = pd.DataFrame([asdict(item) for item in self.items], columns=["name", "portion", *_MACRO_FIELDS])
+        return df.rename(columns={
+            "name": "Food",
+            "portion": "Portion",
+            "calories": "Calories",
+            "protein_g": "Protein (g)",
+            "carbs_g": "Carbs (g)",
+            "fat_g": "Fat (g)",
+        })
+
+
+# Parse a structured (JSON) analysis; returns None for free-text answers or malformed JSON
+def parse_nutrition_analysis(analysis_text):
+    if not analysis_text or not analysis_text.lstrip().startswith("{"):
+        return None
+    try:
+        return NutritionAnalysis.from_dict(json.loads(analysis_text))
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
+# Card HTML for the non-tabular parts of a structured analysis: (summary card, remaining cards)
+def structured_analysis_html(analysis):
+    summary_html = f'<div class="nutrition-analysis-box"><div class="result-label">Food/Meal Summary</div><div class="result-value">{md_to_html(analysis.summary)}</div></div>'
+    sections = [
+        ("Key Vitamins and Minerals", analysis.key_nutrients),
+        ("Health Assessment", analysis.health_assessment),
+        ("Recommendations", analysis.recommendations),
+        ("Suitable For", analysis.suitable_for),
+    ]
+    cards = []
+    for title, content in sections:
+        if not content:
+            continue
+        body = content if isinstance(content, str) else "\n".join(f"- {line}" for line in content)
+        cards.append(f'<div class="nutrition-analysis-box"><div class="result-label">{title}</div><div class="result-value">{md_to_html(body)}</div></div>')
+    return summary_html, "\n".join(cards)
+
+
+def render_structured_analysis(analysis, summary_html, cards_html):
+    st.markdown(summary_html, unsafe_allow_html=True)
+    if analysis.items:
+        st.dataframe(analysis.to_dataframe(), hide_index=True, use_container_width=True)
+        totals = analysis.totals()
+        metric_cols = st.columns(4)
+        metric_cols[0].metric("Calories", f"{totals['calories']:.0f} kcal")
+        metric_cols[1].metric("Protein", f"{totals['protein_g']:.0f} g")
+        metric_cols[2].metric("Carbs", f"{totals['carbs_g']:.0f} g")
+        metric_cols[3].metric("Fat", f"{totals['fat_g']:.0f} g")
+    if cards_html:
+        st.markdown(cards_html, unsafe_allow_html=True)
+
+
+# Words that describe preparation rather than the food; dropped before looking a name up
+FOOD_NAME_FILLER = frozenset(
+    "grilled steamed baked boiled roasted cooked raw fresh plain organic homemade sliced chopped "
+    "poached scrambled toasted ripe hot cold some".split()
+)
+
+# Amounts and the units they are given in; count units mean the table's serving for that food
+QUANTITY_WORDS = {
+    "a": 1, "an": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7,
+    "eight": 8, "nine": 9, "ten": 10, "eleven": 11, "twelve": 12, "half": 0.5, "dozen": 12,
+    "couple": 2, "few": 3,
+}
+MASS_UNITS = {
+    "g": 1.0, "gram": 1.0, "grams": 1.0, "kg": 1000.0, "oz": 28.35, "ounce": 28.35, "ounces": 28.35,
+    "lb": 453.6, "lbs": 453.6, "pound": 453.6, "pounds": 453.6,
+    # Volumes, with the density of water (close enough for drinks, soups and yogurt)
+    "ml": 1.0, "l": 1000.0, "liter": 1000.0, "liters": 1000.0, "litre": 1000.0, "litres": 1000.0,
+}
+PORTION_UNITS = {
+    "cup": "cup", "cups": "cup", "glass": "glass", "glasses": "glass", "bowl": "bowl", "bowls": "bowl",
+    "plate": "plate", "plates": "plate", "tbsp": "tbsp", "tablespoon": "tbsp", "tablespoons": "tbsp",
+    "tsp": "tsp", "teaspoon": "tsp", "teaspoons": "tsp", "handful": "handful", "handfuls": "handful",
+    "scoop": "scoop", "scoops": "scoop", "slice": "slice", "slices": "slice", "piece": "piece",
+    "pieces": "piece", "serving": "serving", "servings": "serving", "portion": "serving",
+    "portions": "serving", "can": "can", "cans": "can", "bottle": "bottle", "bottles": "bottle",
+    "fillet": "fillet", "fillets": "fillet", "bag": "bag", "bags": "bag", "square": "square",
+    "squares": "square", "strip": "slice", "strips": "slice", "rasher": "slice", "rashers": "slice",
+}
+# Servings that are a measure rather than one item: "12 almonds" cannot be counted in handfuls
+MEASURE_SERVINGS = frozenset("cup glass bowl plate tbsp tsp handful scoop serving can bottle bag".split())
+# Grams per unit when the food's own serving is not in that unit (cups use the food's cup weight)
+UNIT_GRAMS = {"glass": 250.0, "tbsp": 15.0, "tsp": 5.0, "handful": 28.0, "scoop": 66.0}
+SIZE_FACTORS = {"small": 0.7, "medium": 1.0, "large": 1.3, "big": 1.3}
+
+_MEAL_SPLIT_RE = re.compile(r"\s*(?:,|;|\+|&|\band\b|\bplus\b)\s*")
+# "coffee with milk", "eggs on toast": what follows is added to the item, not a meal of its own
+_MEAL_MODIFIER_RE = re.compile(r"\s+(?:with|on)\s+")
+_MASS_RE = re.compile(r"\(?\b(\d+(?:\.\d+)?)\s*(" + "|".join(sorted(MASS_UNITS, key=len, reverse=True)) + r")\b\)?")
+_NUMBER_RE = re.compile(r"^(\d+(?:\.\d+)?)(?:\s+(\d+)/(\d+))?$|^(\d+)/(\d+)$")
+# Descriptions with negations ("no sugar", "without cheese") are left to the model
+_NEGATION_RE = re.compile(r"\b(?:no|without|minus|except)\b")
+
+
+# Canonical form of a food name: lowercase, no preparation words (unless `preparation`), last
+# word singular
+def normalize_food_name(name, preparation=False):
+    words = [
+        w for w in re.findall(r"[a-z]+", name.lower().replace("-", " "))
+        if preparation or w not in FOOD_NAME_FILLER
+    ]
+    if words:
+        last = words[-1]
+        if len(last) > 4 and last.endswith("ies"):
+            words[-1] = last[:-3] + "y"
+        elif len(last) > 3 and last.endswith("s") and not last.endswith(("ss", "us", "is")):
+            words[-1] = last[:-1]
+    return " ".join(words)
+
+
+def plural(word, count):
+    if count <= 1 or word in SIZE_FACTORS or word in ("tbsp", "tsp"):
+        return word
+    if word.endswith(("s", "sh", "ch")):
+        return word + "es"
+    return word + "s"
+
+
+# Edit distance with adjacent transpositions ("brocolli" -> "broccoli" is 2, "yuogurt" -> "yougurt" 1)
+def edit_distance(a, b):
+    previous, current = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        before, previous, current = previous, current, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+    return current[len(b)]
+
+
+# Whether `query` is plausibly a misspelling of `name`: both single words with the same first
+# letter, one edit apart (two for words of 8 letters or more). Looser trigram matches pair up
+# different foods ("cheesecake" and "cheese", "beef stew" and "beef steak").
+def is_typo_of(query, name):
+    if " " in query or " " in name or query[:1] != name[:1]:
+        return False
+    return edit_distance(query, name) <= (2 if min(len(query), len(name)) >= 8 else 1)
+
+
+# Character trigrams of a name, padded so word starts and ends count too
+def name_trigrams(name):
+    padded = f" {name} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+# Character-trigram inverted index over food names for typo-tolerant lookups ("brocoli").
+# Postings (entry ids per trigram) are stored CSR-style in NumPy arrays, and candidates
+# are scored together by Dice similarity of their trigram sets.
+class FoodNameIndex:
+    def __init__(self, names, targets):
+        import numpy as np
+
+        self.names = list(names)
+        self.targets = np.asarray(targets, dtype=np.int64)
+        self.vocabulary = {}
+        gram_ids, entry_ids, sizes = [], [], []
+        for entry, name in enumerate(self.names):
+            grams = name_trigrams(name)
+            sizes.append(len(grams))
+            # Postings are keyed by word count too: only names as long as the query can match
+            words = name.count(" ") + 1
+            for gram in grams:
+                gram_ids.append(self.vocabulary.setdefault((words, gram), len(self.vocabulary)))
+                entry_ids.append(entry)
+        gram_ids = np.asarray(gram_ids, dtype=np.int64)
+        order = np.argsort(gram_ids, kind="stable")
+        self.postings = np.asarray(entry_ids, dtype=np.int32)[order]
+        self.offsets = np.zeros(len(self.vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(gram_ids, minlength=len(self.vocabulary)), out=self.offsets[1:])
+        self.sizes = np.asarray(sizes, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.names)
+
+    # Best matches as (score, name, target), highest first. Only names with as many words as the
+    # query qualify, so "chicken curry" does not resolve to "chicken".
+    def search(self, query, k=5, min_score=0.0):
+        import numpy as np
+
+        query_grams = name_trigrams(query)
+        words = query.count(" ") + 1
+        grams = [self.vocabulary[words, g] for g in query_grams if (words, g) in self.vocabulary]
+        if not grams:
+            return []
+        # Every name sharing a trigram appears once per shared trigram: sort the gathered postings
+        # and the run lengths are the overlaps (cheaper than np.unique or a table-sized bincount)
+        hits = np.sort(np.concatenate([self.postings[self.offsets[g]:self.offsets[g + 1]] for g in grams]))
+        starts = np.flatnonzero(np.concatenate(([True], hits[1:] != hits[:-1])))
+        counts = np.diff(np.append(starts, len(hits))).astype(np.float32)
+        candidates = hits[starts]
+        # Dice >= min_score needs at least min_score / (2 - min_score) of the query's trigrams
+        keep = counts >= min_score / (2 - min_score) * len(query_grams) - 1e-6
+        candidates, counts = candidates[keep], counts[keep]
+        scores = 2.0 * counts / (len(query_grams) + self.sizes[candidates])
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
         else:
-            if in_ul:
-                out.append('</ul>')
-                in_ul = False
-            if stripped == '':
-                out.append('')
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [
+            (float(scores[i]), self.names[candidates[i]], int(self.targets[candidates[i]]))
+            for i in top if scores[i] >= min_score
+        ]
+
+
+# Bundled food-composition table (per 100 g or 100 ml) held as columnar NumPy arrays.
+# Names resolve by exact (normalized) name or alias first, then through the trigram index
+# for misspelled single words.
+class FoodTable:
+    def __init__(self, path, aliases_path=None):
+        import numpy as np
+
+        with open(path, newline="", encoding="utf-8") as f:
+            rows = list(csv.DictReader(f))
+        self.names = [row["name"] for row in rows]
+        self.aliases = [[a for a in row["aliases"].split(";") if a] for row in rows]
+        self.macros = np.array(
+            [[float(row["kcal"]), float(row["protein_g"]), float(row["carbs_g"]), float(row["fat_g"])] for row in rows],
+            dtype=np.float32,
+        )
+        self.serving_g = np.array([float(row["serving_g"]) for row in rows], dtype=np.float32)
+        self.cup_g = np.array([float(row["cup_g"] or 240) for row in rows], dtype=np.float32)
+        self.servings = [row["serving"] for row in rows]
+        self.categories = [row["category"] for row in rows]
+        self.tags = [frozenset(t for t in row["tags"].split(";") if t) for row in rows]
+        self.key_nutrients = [[n for n in row["key_nutrients"].split(";") if n] for row in rows]
+        names = [(name, idx) for idx, row in enumerate(rows) for name in [row["name"], *self.aliases[idx]]]
+        if aliases_path and os.path.exists(aliases_path):
+            rows_by_name = {name: idx for idx, name in enumerate(self.names)}
+            with open(aliases_path, newline="", encoding="utf-8") as f:
+                for alias in csv.DictReader(f):
+                    if alias["food"] in rows_by_name:
+                        names.append((alias["alias"], rows_by_name[alias["food"]]))
+                    else:
+                        logger.warning("Food alias %r points to unknown food %r", alias["alias"], alias["food"])
+        # Names are registered with their preparation words first, so "cooked oats" (oatmeal)
+        # does not take "oats" from rolled oats when the word is dropped
+        self.lookup = {}
+        for preparation in (True, False):
+            for name, idx in names:
+                self.lookup.setdefault(normalize_food_name(name, preparation), idx)
+        self.name_index = FoodNameIndex(list(self.lookup), list(self.lookup.values()))
+
+    def __len__(self):
+        return len(self.names)
+
+    # (row, score) for a food name, or (None, 0.0). `score` is 1.0 for a known name and the
+    # trigram similarity for a misspelling matched through the index.
+    def find(self, name, min_score=FOOD_MATCH_MIN_SCORE):
+        row = self.lookup.get(normalize_food_name(name, preparation=True))
+        if row is not None:
+            return row, 1.0
+        name = normalize_food_name(name)
+        row = self.lookup.get(name)
+        if row is not None:
+            return row, 1.0
+        if len(name) >= 3 and " " not in name:
+            for score, match, row in self.name_index.search(name, k=5, min_score=min_score):
+                if is_typo_of(name, match):
+                    return row, score
+        return None, 0.0
+
+
+# Built once per process, with its name index
+@st.cache_resource
+def get_food_table():
+    return FoodTable(FOOD_TABLE_PATH, FOOD_ALIASES_PATH)
+
+
+# Parse a leading amount: "2", "1.5", "1 1/2", "1/2", "a", "two", "half a", "a couple of"
+def parse_quantity(words):
+    quantity, used = None, 0
+    while used < len(words):
+        word = words[used]
+        number = _NUMBER_RE.match(word)
+        if number and quantity is None:
+            if number.group(4):
+                quantity = int(number.group(4)) / int(number.group(5))
             else:
-                line_html = re.sub(r'\*\*(.+?)\*\*', r'<strong>\1</strong>', line)
-                line_html = re.sub(r'\*(.+?)\*', r'<em>\1</em>', line_html)
-                out.append(f'<p>{line_html}</p>')
-    if in_ul:
-        out.append('</ul>')
-    return '\n'.join([o for o in out if o is not None])
+                quantity = float(number.group(1))
+                # Mixed fraction written as two words: "1 1/2"
+                if used + 1 < len(words) and re.fullmatch(r"\d+/\d+", words[used + 1]):
+                    num, den = words[used + 1].split("/")
+                    quantity += int(num) / int(den)
+                    used += 1
+        elif word in QUANTITY_WORDS:
+            value = QUANTITY_WORDS[word]
+            # "a dozen", "a couple", "half a": the last word gives the amount
+            quantity = value if quantity is None or value != 1 else quantity
+        elif word == "of" and quantity is not None:
+            pass
+        else:
+            break
+        used += 1
+    return quantity, used
+
+
+# Parse one food item: amount, size, unit and food name. Returns (table row, grams, portion, name,
+# score) or None, where `name` is the food as written and `score` is below 1 when it was a
+# misspelling (see FoodTable.find). A `modifier` ("with milk") without
+# an amount is only estimated when the food's serving is a spoonful, like butter or honey.
+def parse_food_item(text, table, modifier=False):
+    text = text.strip().lower()
+    grams, portion = None, None
+    mass = _MASS_RE.search(text)
+    if mass:
+        amount, unit = float(mass.group(1)), mass.group(2)
+        grams = amount * MASS_UNITS[unit]
+        portion = f"{amount:g} {unit}"
+        text = (text[:mass.start()] + " " + text[mass.end():]).strip()
+
+    words = text.replace("-", " - ").split()
+    words = [w for w in words if w != "-"]
+    quantity, used = parse_quantity(words)
+    words = words[used:]
+    # "0 eggs" is not a portion the table can estimate
+    if quantity == 0 or grams == 0:
+        return None
+    size = None
+    if words and words[0] in SIZE_FACTORS:
+        size = words.pop(0)
+    unit = None
+    if words and words[0] in PORTION_UNITS:
+        unit = PORTION_UNITS[words.pop(0)]
+        if words and words[0] == "of":
+            words.pop(0)
+    if not words:
+        return None
+    name = " ".join(words)
+    row, score = table.find(name)
+    if row is None:
+        return None
+    if grams is not None:
+        return row, grams, portion, name, score
+
+    serving = table.servings[row]
+    if unit is None and serving in MEASURE_SERVINGS and quantity not in (None, 0.5, 1):
+        return None
+    if modifier and quantity is None and unit is None and serving not in ("tbsp", "tsp"):
+        return None
+    if quantity is None:
+        quantity = 1.0
+    if unit is None or unit == serving:
+        per_unit = float(table.serving_g[row])
+        label = serving
+    elif unit == "cup":
+        per_unit, label = float(table.cup_g[row]), unit
+    elif unit == "bowl":
+        per_unit, label = float(table.cup_g[row]) * 1.5, unit
+    elif unit == "plate":
+        per_unit, label = float(table.cup_g[row]) * 2, unit
+    elif unit in UNIT_GRAMS:
+        per_unit, label = UNIT_GRAMS[unit], unit
+    else:
+        # Pieces, slices, servings, cans...: one of the food's usual servings
+        per_unit, label = float(table.serving_g[row]), unit
+    if size and size != serving:
+        per_unit *= SIZE_FACTORS[size]
+        label = f"{size} {label}" if label not in SIZE_FACTORS else size
+    grams = quantity * per_unit
+    measure = "ml" if table.categories[row] == "drink" or label in ("glass", "bottle") else "g"
+    return row, grams, f"{quantity:g} {plural(label, quantity)} ({grams:.0f} {measure})", name, score
+
+
+# "on a plate", "with a glass": a portion unit with no food, which adds nothing to the meal
+def is_serving_vessel(text):
+    words = text.lower().split()
+    _, used = parse_quantity(words)
+    return len(words) == used + 1 and words[used] in PORTION_UNITS
+
+
+# What the local food table makes of a meal description. Close misspellings are kept as
+# (written, food name) pairs in `interpreted`; weaker matches are listed in `inexact`, and the
+# model double-checks those, so the estimate is not complete.
+@dataclass
+class LocalMealEstimate:
+    items: list = field(default_factory=list)
+    rows: list = field(default_factory=list)
+    unresolved: list = field(default_factory=list)
+    inexact: list = field(default_factory=list)
+    interpreted: list = field(default_factory=list)
+
+    @property
+    def complete(self):
+        return bool(self.items) and not self.unresolved and not self.inexact
+
+
+# Split a meal description into items and estimate each one the table knows, computing all
+# macros in one vectorized step
+def estimate_meal_locally(description, table=None):
+    import numpy as np
+
+    table = table or get_food_table()
+    estimate = LocalMealEstimate()
+    if not description or _NEGATION_RE.search(description.lower()):
+        estimate.unresolved.append(description)
+        return estimate
+    parsed = []
+    for item in _MEAL_SPLIT_RE.split(description.strip().rstrip(".!")):
+        if not item:
+            continue
+        food, *modifiers = _MEAL_MODIFIER_RE.split(item)
+        for part, modifier in [(food, False), *((m, True) for m in modifiers)]:
+            result = parse_food_item(part, table, modifier)
+            if result is None:
+                if not (modifier and is_serving_vessel(part)):
+                    estimate.unresolved.append(part)
+                continue
+            row, _, _, name, score = result
+            parsed.append(result[:3])
+            if score >= FOOD_MATCH_LOCAL_SCORE and score < 1:
+                estimate.interpreted.append((normalize_food_name(name), table.names[row].capitalize()))
+            elif score < 1:
+                estimate.inexact.append(part)
+    if not parsed:
+        return estimate
+
+    rows = np.array([row for row, _, _ in parsed])
+    grams = np.array([g for _, g, _ in parsed], dtype=np.float64)
+    values = table.macros[rows].astype(np.float64) * (grams / 100.0)[:, None]
+    for (row, _, portion), (calories, protein, carbs, fat) in zip(parsed, values.round(1).tolist()):
+        estimate.items.append(FoodItem(
+            name=table.names[row].capitalize(), portion=portion,
+            calories=calories, protein_g=protein, carbs_g=carbs, fat_g=fat
+        ))
+        estimate.rows.append(row)
+    return estimate
+
+
+# Build a full analysis of a meal the table fully resolved, with a rule-based assessment
+def local_nutrition_analysis(estimate, table=None):
+    table = table or get_food_table()
+    analysis = NutritionAnalysis(items=estimate.items)
+    totals = analysis.totals()
+    kcal = max(totals["calories"], 1.0)
+    protein_share = totals["protein_g"] * 4 / kcal
+    carbs_share = totals["carbs_g"] * 4 / kcal
+    fat_share = totals["fat_g"] * 9 / kcal
+    categories = {table.categories[row] for row in estimate.rows}
+    tags = set().union(*(table.tags[row] for row in estimate.rows))
+    has_produce = bool(categories & {"fruit", "vegetable"})
+
+    names = [item.name.lower() for item in estimate.items]
+    meal = names[0] if len(names) == 1 else ", ".join(names[:-1]) + " and " + names[-1]
+    analysis.summary = f"{meal.capitalize()}, estimated from EatWise's food-composition table."
+    if estimate.interpreted:
+        analysis.summary += " Interpreted " + ", ".join(
+            f"'{written}' as {name}" for written, name in estimate.interpreted
+        ) + "."
+    nutrients = []
+    for row in estimate.rows:
+        nutrients += [n for n in table.key_nutrients[row] if n not in nutrients]
+    analysis.key_nutrients = nutrients[:6]
+
+    assessment = [
+        f"About {totals['calories']:.0f} kcal, with {protein_share:.0%} of the energy from protein, "
+        f"{carbs_share:.0%} from carbohydrates and {fat_share:.0%} from fat."
+    ]
+    if totals["calories"] < 300:
+        assessment.append("It is a light meal or snack.")
+    elif totals["calories"] > 900:
+        assessment.append("It is a large meal; keep the rest of the day's portions in mind.")
+    if protein_share >= 0.25:
+        assessment.append("It is high in protein.")
+    elif totals["protein_g"] < 10:
+        assessment.append("It is low in protein.")
+    if fat_share > 0.4:
+        assessment.append("Much of its energy comes from fat.")
+    if has_produce:
+        assessment.append("It includes fruit or vegetables.")
+    analysis.health_assessment = " ".join(assessment)
+
+    if totals["protein_g"] < 15:
+        analysis.recommendations.append("Add a protein source such as eggs, Greek yogurt, tofu or lean meat.")
+    if not has_produce:
+        analysis.recommendations.append("Add a portion of vegetables or fruit for fiber, vitamins and minerals.")
+    if fat_share > 0.4:
+        analysis.recommendations.append("Swap some of the fat-rich foods for lean protein or whole grains.")
+    if not analysis.recommendations:
+        analysis.recommendations.append("A balanced combination; keep portions in line with your energy needs.")
+
+    if protein_share >= 0.25 or totals["protein_g"] >= 25:
+        analysis.suitable_for += ["High Protein Diet", "Muscle Building"]
+    if carbs_share < 0.26:
+        analysis.suitable_for.append("Low Carb Diet")
+    if totals["calories"] <= 500 and fat_share <= 0.35:
+        analysis.suitable_for.append("Weight Loss")
+    if carbs_share >= 0.45 and totals["calories"] >= 250:
+        analysis.suitable_for.append("Energy Boost")
+    if not tags & {"meat", "fish", "shellfish", "pork"}:
+        analysis.suitable_for.append("Vegetarian/Vegan")
+    if has_produce and fat_share <= 0.35:
+        analysis.suitable_for.append("General Healthy Eating")
+    return analysis
+
+
+# Food-table tags that rule a food out for each dietary restriction in the sidebar
+RESTRICTION_TAGS = {
+    "Dairy-free": {"dairy"},
+    "Gluten-free": {"gluten"},
+    "Nut-free": {"nuts", "peanuts"},
+    "Vegetarian": {"meat", "pork", "fish", "shellfish"},
+    "Vegan": {"animal", "dairy", "egg", "meat", "pork", "fish", "shellfish"},
+    "Halal": {"pork", "alcohol"},
+    "Kosher": {"pork", "shellfish"},
+}
+
+
+# Foods in a meal estimate that conflict with the selected restrictions, as (restriction, food
+# name) pairs. Only foods the table resolves are checked.
+def find_restriction_conflicts(estimate, restrictions, table=None):
+    if not restrictions:
+        return []
+    table = table or get_food_table()
+    conflicts = []
+    for restriction in restrictions:
+        for row in estimate.rows:
+            if table.tags[row] & RESTRICTION_TAGS.get(restriction, set()):
+                conflicts.append((restriction, table.names[row]))
+    return conflicts
+
+
+# Table values for the items the table knows, given to the model as reference for the rest
+def local_nutrition_hints(estimate):
+    return "\n".join(
+        f"- {item.name}, {item.portion}: {item.calories:.0f} kcal, {item.protein_g:.1f} g protein, "
+        f"{item.carbs_g:.1f} g carbs, {item.fat_g:.1f} g fat"
+        for item in estimate.items
+    )
+
+
+# All cards of a recommendation response as one HTML string
+def build_recommendation_cards(resp_text):
+    filtered_parts = split_recommendation_parts(resp_text)
+    if not filtered_parts:
+        # Absolute fallback: show whole response
+        return f'<div class="recommendation-box"><div class="result-value">{md_to_html(resp_text)}</div></div>'
+    return "\n".join(recommendation_card_html(part) for part in filtered_parts)
+
+
+# All cards of a free-text analysis as one HTML string
+def build_analysis_cards(analysis_text):
+    sections = split_analysis_sections(analysis_text)
+    if not sections:
+        # fallback: show whole analysis
+        return f'<div class="nutrition-analysis-box"><div class="result-value">{md_to_html(analysis_text)}</div></div>'
+    return "\n".join(analysis_card_html(section) for section in sections)
+
+
+# History entries are parsed and rendered once, when they are stored, so a rerun only
+# re-sends the stored HTML no matter how long the history is
+def make_recommendation_entry(query, goal, response):
+    with get_metrics().span("render", entry="recommendation"):
+        cards_html = build_recommendation_cards(response or "")
+    return {
+        'id': uuid.uuid4().hex,
+        'query': query,
+        'goal': goal,
+        'response': response,
+        'cards_html': cards_html,
+        'timestamp': time.strftime("%Y-%m-%d %H:%M:%S")
+    }
+
+
+# Build an analysis-history entry; structured answers are stored as compact records, not text
+def make_analysis_entry(method, analysis, **fields):
+    entry = {'id': uuid.uuid4().hex, 'method': method, **fields, 'timestamp': time.strftime("%Y-%m-%d %H:%M:%S")}
+    # Structured answers come from STRUCTURED_OUTPUT or the local food table
+    with get_metrics().span("parse", entry="analysis"):
+        structured = parse_nutrition_analysis(analysis)
+    if structured is not None:
+        entry['structured'] = asdict(structured)
+    else:
+        entry['analysis'] = analysis
+    with get_metrics().span("render", entry="analysis"):
+        ensure_entry_rendered(entry)
+    return entry
+
+
+# Fill in the rendered HTML of an entry that does not have it yet (e.g. stored before it was added)
+def ensure_entry_rendered(entry):
+    if 'cards_html' in entry:
+        return entry
+    entry.setdefault('id', uuid.uuid4().hex)
+    if 'structured' in entry:
+        entry['summary_html'], entry['cards_html'] = structured_analysis_html(NutritionAnalysis.from_dict(entry['structured']))
+    elif 'response' in entry:
+        entry['cards_html'] = build_recommendation_cards(entry.get('response') or "")
+    else:
+        entry['cards_html'] = build_analysis_cards(entry.get('analysis') or "")
+    return entry
+
+
+# Approximate memory held by a history entry (its text and rendered HTML)
+def entry_size(entry):
+    size = 0
+    for value in entry.values():
+        if isinstance(value, str):
+            size += len(value)
+        elif isinstance(value, (dict, list)):
+            size += len(json.dumps(value))
+    return size
+
+
+# A session's history, newest entries kept within HISTORY_MAX_ENTRIES / HISTORY_MAX_BYTES
+class SessionHistory:
+    def __init__(self, entries=None, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries or HISTORY_MAX_ENTRIES
+        self.max_bytes = max_bytes or HISTORY_MAX_BYTES
+        self._entries = []  # oldest first
+        self._sizes = []
+        self.total_bytes = 0
+        for entry in entries or []:
+            self.append(entry)
+
+    def append(self, entry):
+        size = entry_size(entry)
+        self._entries.append(entry)
+        self._sizes.append(size)
+        self.total_bytes += size
+        # Always keep the newest entry, even if it alone exceeds the byte budget
+        while len(self._entries) > 1 and (len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes):
+            self._entries.pop(0)
+            self.total_bytes -= self._sizes.pop(0)
+
+    def clear(self):
+        self._entries = []
+        self._sizes = []
+        self.total_bytes = 0
+
+    def newest(self, limit, offset=0):
+        end = len(self._entries) - offset
+        return list(reversed(self._entries[max(0, end - limit):max(0, end)]))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+
+# Persistent history shared by all sessions of a process (and all replicas using the same file).
+# Entries are stored with their rendered HTML, so reading a page needs no re-rendering.
+class HistoryStore:
+    COMPACT_INTERVAL_SECONDS = 3600
+
+    def __init__(self, db_path, retention_days=30, max_entries=50, max_bytes=2 * 1024 * 1024):
+        self.db_path = db_path
+        self.retention_days = retention_days
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._last_compacted = 0.0
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            # auto_vacuum only takes effect on a new database, before the first table is created
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS history ("
+                "id TEXT PRIMARY KEY, user_id TEXT NOT NULL, session_id TEXT NOT NULL, kind TEXT NOT NULL, "
+                "created_at REAL NOT NULL, size INTEGER NOT NULL, entry TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_history_user ON history (user_id, kind, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_history_session ON history (session_id, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_history_created ON history (created_at)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=5)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def add(self, user_id, session_id, kind, entry):
+        payload = json.dumps(entry, ensure_ascii=False)
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO history (id, user_id, session_id, kind, created_at, size, entry) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (entry['id'], user_id, session_id, kind, time.time(), len(payload), payload),
+            )
+            self._enforce_limits(conn, user_id, kind)
+        if time.time() - self._last_compacted > self.COMPACT_INTERVAL_SECONDS:
+            self.compact()
+
+    # Keep the newest entries of a user within max_entries and max_bytes
+    def _enforce_limits(self, conn, user_id, kind):
+        rows = conn.execute(
+            "SELECT id, size FROM history WHERE user_id = ? AND kind = ? ORDER BY created_at DESC LIMIT ?",
+            (user_id, kind, self.max_entries + 1),
+        ).fetchall()
+        total = 0
+        for position, (entry_id, size) in enumerate(rows):
+            total += size
+            if position > 0 and (position >= self.max_entries or total > self.max_bytes):
+                conn.execute(
+                    "DELETE FROM history WHERE user_id = ? AND kind = ? AND created_at <= "
+                    "(SELECT created_at FROM history WHERE id = ?)",
+                    (user_id, kind, entry_id),
+                )
+                break
+
+    # Drop entries past the retention period and give the space back to the file system
+    def compact(self):
+        self._last_compacted = time.time()
+        cutoff = time.time() - self.retention_days * 86400
+        with self._connect() as conn:
+            conn.execute("DELETE FROM history WHERE created_at < ?", (cutoff,))
+            conn.execute("PRAGMA incremental_vacuum")
+            conn.execute("PRAGMA optimize")
+        with self._connect() as conn:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def page(self, user_id, kind, limit, offset=0):
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT entry FROM history WHERE user_id = ? AND kind = ? ORDER BY created_at DESC LIMIT ? OFFSET ?",
+                (user_id, kind, limit, offset),
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def stats(self, user_id, kind):
+        with self._connect() as conn:
+            count, total = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM history WHERE user_id = ? AND kind = ?",
+                (user_id, kind),
+            ).fetchone()
+        return count, total
+
+    def clear(self, user_id, kind):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM history WHERE user_id = ? AND kind = ?", (user_id, kind))
+
+
+@st.cache_resource
+def get_history_store():
+    return HistoryStore(HISTORY_DB_PATH, HISTORY_RETENTION_DAYS, HISTORY_MAX_ENTRIES, HISTORY_MAX_BYTES)
+
+
+# A thin, paged view of one user's history in the HistoryStore, with the SessionHistory interface
+class StoredHistory:
+    def __init__(self, store, user_id, session_id, kind):
+        self.store = store
+        self.user_id = user_id
+        self.session_id = session_id
+        self.kind = kind
+        self.max_entries = store.max_entries
+
+    def append(self, entry):
+        self.store.add(self.user_id, self.session_id, self.kind, entry)
+
+    def clear(self):
+        self.store.clear(self.user_id, self.kind)
+
+    def newest(self, limit, offset=0):
+        return self.store.page(self.user_id, self.kind, limit, offset)
+
+    @property
+    def total_bytes(self):
+        return self.store.stats(self.user_id, self.kind)[1]
+
+    def __len__(self):
+        return self.store.stats(self.user_id, self.kind)[0]
+
+    def __iter__(self):
+        return iter(reversed(self.newest(self.max_entries)))
+
+
+# A session id kept in the URL, so history survives reconnects and page reloads
+def get_history_session_id():
+    session_id = st.query_params.get("sid", "")
+    if not re.fullmatch(r"[0-9a-f]{32}", session_id):
+        session_id = uuid.uuid4().hex
+        st.query_params["sid"] = session_id
+    return session_id
+
+
+# Signed-in users (when Streamlit authentication is configured) keep one history across devices.
+# Anonymous visitors are identified by the URL session id only with HISTORY_URL_SESSIONS; otherwise
+# there is no user id and their history stays in the session.
+def get_history_user_id():
+    try:
+        email = st.user.get("email") if st.user.get("is_logged_in") else None
+    except Exception:
+        email = None
+    if email:
+        return email
+    if HISTORY_URL_SESSIONS:
+        return get_history_session_id()
+    return None
+
+
+def open_history(kind):
+    user_id = get_history_user_id() if HISTORY_BACKEND == "sqlite" else None
+    if user_id is not None:
+        try:
+            store = get_history_store()
+        except (sqlite3.Error, OSError) as e:
+            st.warning(f"History is not saved: {str(e)}")
+        else:
+            session_id = get_history_session_id() if HISTORY_URL_SESSIONS else get_scheduler_session_id()
+            return StoredHistory(store, user_id, session_id, kind)
+    return SessionHistory()
+
+
+# Render a page of history entries, newest first, with a "load more" button for older ones.
+# Only the newest entry is rendered up front; an older entry's body is rendered once it is opened.
+def render_history_page(history, key, entry_label, render_entry):
+    shown_key = f"{key}_shown"
+    shown = st.session_state.get(shown_key, HISTORY_PAGE_SIZE)
+    entries = history.newest(shown)
+    total = len(history)
+    st.caption(f"{total} saved (up to {history.max_entries}) · {history.total_bytes / 1024:.0f} KB")
+    for idx, entry in enumerate(entries):
+        ensure_entry_rendered(entry)
+        with st.expander(entry_label(entry), expanded=(idx == 0)):
+            render_entry(entry, lazy=(idx > 0))
+    remaining = total - len(entries)
+    if remaining > 0:
+        # Updated in a callback so the click takes effect without a second rerun
+        st.button(
+            f"⬇️ Load {min(remaining, HISTORY_PAGE_SIZE)} older entries",
+            key=f"{key}_more",
+            on_click=st.session_state.__setitem__,
+            args=(shown_key, shown + HISTORY_PAGE_SIZE)
+        )
+
+
+def render_recommendation_entry(chat, lazy=False):
+    st.markdown(f"**Your Question:** {chat['query']}")
+    if lazy and not st.toggle("Show recommendations", key=f"rec_open_{chat['id']}"):
+        return
+    st.divider()
+    st.markdown(f'<div class="result-header">✨ AI Recommendations</div>', unsafe_allow_html=True)
+
+    st.markdown(chat['cards_html'], unsafe_allow_html=True)
+
+
+def render_analysis_entry(analysis_item, lazy=False):
+    if analysis_item['method'] == 'image':
+        if analysis_item.get('filename'):
+            st.markdown(f"**Photo:** {analysis_item['filename']}")
+        st.markdown(f"**Additional Information:** {analysis_item['context']}")
+    else:
+        st.markdown(f"**Food Description:** {analysis_item['description']}")
+    if lazy and not st.toggle("Show analysis", key=f"analysis_open_{analysis_item['id']}"):
+        return
+    st.divider()
+    st.markdown(f'<div class="result-header">🔬 Nutritional Analysis</div>', unsafe_allow_html=True)
 
-# Function to generate nutrition recommendations
-def get_nutrition_recommendations(client, query, health_goal, num_recommendations, meal_type, dietary_restrictions):
-    prompt = f"""You are a professional nutrition advisor. Based on the following information, provide {num_recommendations} specific food recommendations.
+    if analysis_item.get('structured'):
+        render_structured_analysis(
+            NutritionAnalysis.from_dict(analysis_item['structured']),
+            analysis_item['summary_html'],
+            analysis_item['cards_html']
+        )
+    else:
+        st.markdown(analysis_item['cards_html'], unsafe_allow_html=True)
+
+
+# Render result cards into `placeholder` while a completion streams in. Only sections that are
+# followed by another one are complete, so the last (still growing) section is held back.
+def make_streaming_renderer(placeholder, split_sections, card_html):
+    rendered = {"count": 0}
+
+    def on_delta(text):
+        complete = split_sections(text)[:-1]
+        if len(complete) > rendered["count"]:
+            rendered["count"] = len(complete)
+            placeholder.markdown("".join(card_html(part) for part in complete), unsafe_allow_html=True)
+
+    return on_delta
+
+
+# Show the caller's place in the request queue while it waits for quota; the streamed cards
+# replace the notice once the answer starts arriving
+def make_queue_notice(placeholder):
+    def show(position):
+        placeholder.info(f"⏳ Lots of requests right now. You are number {position} in the queue...")
+    return show
+
+
+def make_recommendation_cache_key(query, health_goal, num_recommendations, meal_type, dietary_restrictions):
+    return make_cache_key(
+        "recommendations",
+        query=query,
+        health_goal=health_goal,
+        num_recommendations=num_recommendations,
+        meal_type=meal_type,
+        dietary_restrictions=dietary_restrictions,
+    )
+
+
+# Function to generate nutrition recommendations. The pre-warmer's own requests pass
+# `record_coverage=False` so they do not count towards pill coverage.
+def get_nutrition_recommendations(client, query, health_goal, num_recommendations, meal_type, dietary_restrictions, on_delta=None, on_queue=None, refresh=False, record_coverage=True):
+    if PROMPT_STYLE == "compact":
+        system_prompt = "You are an evidence-based nutrition advisor."
+        prompt = f"""Recommend exactly {num_recommendations} foods or meals.
+
+Question: {query}
+Goal: {health_goal}; meal type: {', '.join(meal_type) if meal_type else 'any'}; dietary restrictions: {', '.join(dietary_restrictions) or 'none'}
+
+Number them, starting each with its name in bold ("1. **Name**"), then give briefly: a one-sentence description, key nutrients, approximate calories and why it fits the goal. No introduction."""
+    else:
+        system_prompt = "You are a knowledgeable nutrition advisor who provides evidence-based, practical food recommendations tailored to individual health goals and dietary needs."
+        prompt = f"""You are a professional nutrition advisor. Based on the following information, provide {num_recommendations} specific food recommendations.
 
 User's Question: {query}
 
@@ -726,26 +3084,85 @@ Please provide exactly {num_recommendations} food recommendations. For each reco
 
 Format your response in a clear, organized manner with numbered items."""
 
+    cache_key = make_recommendation_cache_key(query, health_goal, num_recommendations, meal_type, dietary_restrictions)
+    labels = {"helper": "recommendations", "goal": health_goal}
+    if PREWARM_ENABLED and record_coverage:
+        get_prewarmer().record_request(query, cache_key)
+
+    scope = None
+    if semantic_cache_enabled():
+        scope = make_semantic_scope(
+            "recommendations",
+            health_goal=health_goal,
+            num_recommendations=num_recommendations,
+            meal_type=meal_type,
+            dietary_restrictions=dietary_restrictions,
+        )
+        similar = None if refresh else find_semantic_response(cache_key, query, scope, labels)
+        if similar is not None:
+            return similar
+
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
+        recommendations = run_chat_completion(
+            client,
+            cache_key,
             messages=[
-                {"role": "system", "content": "You are a knowledgeable nutrition advisor who provides evidence-based, practical food recommendations tailored to individual health goals and dietary needs."},
+                {"role": "system", "content": system_prompt},
                 {"role": "user", "content": prompt}
             ],
-            temperature=0.7,
-            max_tokens=1500
+            shape=answer_shape(recommendations=num_recommendations),
+            on_delta=on_delta,
+            on_queue=on_queue,
+            refresh=refresh,
+            labels=labels
         )
-        return response.choices[0].message.content
+        if recommendations and scope is not None:
+            get_semantic_cache().add(query, scope, cache_key)
+        return recommendations
     except Exception as e:
-        st.error(f"Error getting recommendations: {str(e)}")
+        report_error(f"Error getting recommendations: {str(e)}")
         return None
 
 # Function to analyze food from image
-def analyze_food_from_image(client, image_bytes, additional_query=""):
-    base64_image = encode_image(image_bytes)
-
-    prompt = f"""Analyze this food image and provide a detailed nutritional breakdown. Include:
+def analyze_food_from_image(client, image_bytes, additional_query="", on_delta=None, on_queue=None):
+    cache_key = make_cache_key(
+        "image_analysis",
+        image_digest=hashlib.sha256(image_bytes).hexdigest(),
+        additional_query=additional_query,
+        structured=STRUCTURED_OUTPUT,
+    )
+    labels = {"helper": "image_analysis"}
+    # Misses are counted by run_chat_completion, which looks the key up again
+    cached = get_cached_response(cache_key)
+    if cached is not None:
+        get_metrics().inc("cache_lookups", cache="response", result="hit", **labels)
+        return cached
+
+    # Re-uploads of the same photo (recompressed or resized) share the earlier analysis, when it
+    # was asked for with the same question and the same output settings (the cache key without
+    # the image digest)
+    phash = None
+    if IMAGE_PHASH_ENABLED and response_cache_enabled():
+        phash = compute_image_phash(image_bytes)
+        phash_context = make_cache_key("image_analysis", additional_query=additional_query, structured=STRUCTURED_OUTPUT)
+        if phash is not None:
+            similar_key = get_image_hash_index().find(phash, phash_context, IMAGE_PHASH_MAX_DISTANCE)
+            cached = get_cached_response(similar_key) if similar_key else None
+            get_metrics().inc("cache_lookups", cache="image_phash", result="miss" if cached is None else "hit", **labels)
+            if cached is not None:
+                return cached
+
+    if PROMPT_STYLE == "compact":
+        prompt = f"""Analyze the food in this photo.{f' {additional_query}' if additional_query else ''}
+
+Answer briefly in these numbered sections, each title in bold:
+1. **Food Identification**
+2. **Estimated Portion Size**
+3. **Nutritional Information**: calories; protein, carbs and fat in grams; key vitamins and minerals
+4. **Health Assessment**
+5. **Recommendations**: how to improve it"""
+    else:
+        prompt = f"""Analyze this food image and provide a detailed nutritional breakdown. Include:
 
 1. **Food Identification**: What food items do you see?
 2. **Estimated Portion Size**: Approximate serving size
@@ -759,38 +3176,92 @@ def analyze_food_from_image(client, image_bytes, additional_query=""):
 {f'Additional Information: {additional_query}' if additional_query else ''}
 
 Provide your analysis in a clear, structured format."""
+    if STRUCTURED_OUTPUT:
+        prompt += "\n\n" + STRUCTURED_OUTPUT_INSTRUCTION
+
+    def build_messages():
+        prepared = preprocess_image(image_bytes)
+        base64_image = encode_image(prepared["bytes"])
+        return [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": prompt
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:{prepared['mime']};base64,{base64_image}"
+                        }
+                    }
+                ]
+            }
+        ]
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": prompt
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
-                            }
-                        }
-                    ]
-                }
-            ],
-            temperature=0.7,
-            max_tokens=1500
+        analysis = run_chat_completion(
+            client,
+            cache_key,
+            build_messages,
+            shape=answer_shape(sections=5, structured=STRUCTURED_OUTPUT),
+            on_delta=on_delta,
+            on_queue=on_queue,
+            response_format=NUTRITION_ANALYSIS_SCHEMA if STRUCTURED_OUTPUT else None,
+            labels=labels
         )
-        return response.choices[0].message.content
+        if analysis and phash is not None:
+            get_image_hash_index().add(phash, phash_context, cache_key)
+        return analysis
     except Exception as e:
-        st.error(f"Error analyzing image: {str(e)}")
+        report_error(f"Error analyzing image: {str(e)}")
         return None
 
+# Analyze several photos on a bounded thread pool; yields (index, analysis) as each one finishes
+def analyze_food_images_concurrently(client, images, additional_query="", max_workers=None):
+    ctx = get_script_run_ctx()
+
+    # Worker threads need the session's script context so st.error() still reaches the page
+    def attach_script_ctx():
+        if ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
+
+    workers = max(1, min(max_workers or MAX_CONCURRENT_ANALYSES, len(images)))
+    with ThreadPoolExecutor(max_workers=workers, initializer=attach_script_ctx) as pool:
+        futures = {
+            pool.submit(analyze_food_from_image, client, image_bytes, additional_query): idx
+            for idx, image_bytes in enumerate(images)
+        }
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
 # Function to analyze food from text description
-def analyze_food_from_text(client, food_description):
-    prompt = f"""Analyze the following food/meal description and provide a detailed nutritional breakdown:
+def analyze_food_from_text(client, food_description, on_delta=None, on_queue=None, estimate=None):
+    # Answered locally (as a structured analysis) when the food table knows every item; the
+    # caller can pass the estimate it already made
+    labels = {"helper": "text_analysis"}
+    local_hints = ""
+    if LOCAL_NUTRITION_ENABLED:
+        estimate = estimate or estimate_meal_locally(food_description)
+        get_metrics().inc("cache_lookups", cache="food_table", result="hit" if estimate.complete else "miss", **labels)
+        if estimate.complete:
+            return json.dumps(asdict(local_nutrition_analysis(estimate)))
+        local_hints = local_nutrition_hints(estimate)
+
+    if PROMPT_STYLE == "compact":
+        system_prompt = "You are a nutrition expert."
+        prompt = f"""Analyze this meal: {food_description}
+
+Answer briefly in these numbered sections, each title in bold:
+1. **Food/Meal Summary**
+2. **Estimated Nutritional Information**: calories; protein, carbs and fat in grams; key vitamins and minerals
+3. **Health Assessment**
+4. **Recommendations**: how to improve it
+5. **Suitable For**: health goals it supports"""
+    else:
+        system_prompt = "You are a nutrition expert who can analyze food descriptions and provide detailed nutritional information and health recommendations."
+        prompt = f"""Analyze the following food/meal description and provide a detailed nutritional breakdown:
 
 Food Description: {food_description}
 
@@ -805,27 +3276,164 @@ Please provide:
 5. **Suitable For**: What health goals does this meal support?
 
 Provide your analysis in a clear, structured format."""
+    if local_hints:
+        prompt += (
+            "\n\nReference values from a food-composition table for some of the items "
+            "(use them and estimate the rest):\n" + local_hints
+        )
+    if STRUCTURED_OUTPUT:
+        prompt += "\n\n" + STRUCTURED_OUTPUT_INSTRUCTION
+
+    cache_key = make_cache_key(
+        "text_analysis", food_description=food_description, structured=STRUCTURED_OUTPUT, local_hints=local_hints
+    )
+
+    scope = None
+    if semantic_cache_enabled():
+        scope = make_semantic_scope("text_analysis", structured=STRUCTURED_OUTPUT)
+        similar = find_semantic_response(cache_key, food_description, scope, labels)
+        if similar is not None:
+            return similar
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
+        analysis = run_chat_completion(
+            client,
+            cache_key,
             messages=[
-                {"role": "system", "content": "You are a nutrition expert who can analyze food descriptions and provide detailed nutritional information and health recommendations."},
+                {"role": "system", "content": system_prompt},
                 {"role": "user", "content": prompt}
             ],
-            temperature=0.7,
-            max_tokens=1500
+            shape=answer_shape(sections=5, structured=STRUCTURED_OUTPUT),
+            on_delta=on_delta,
+            on_queue=on_queue,
+            response_format=NUTRITION_ANALYSIS_SCHEMA if STRUCTURED_OUTPUT else None,
+            labels=labels
         )
-        return response.choices[0].message.content
+        if analysis and scope is not None:
+            get_semantic_cache().add(food_description, scope, cache_key)
+        return analysis
     except Exception as e:
-        st.error(f"Error analyzing food: {str(e)}")
+        report_error(f"Error analyzing food: {str(e)}")
         return None
 
-# Main tabs
-tab1, tab2 = st.tabs(["🍴 Get Food Recommendations", "🔍 Analyze Nutritional Content"])
+# Keeps the answers to every quick suggestion (asked with the default preferences) in the response
+# cache so the first click on a pill is served instantly. A background thread warms them on start
+# and then every PREWARM_INTERVAL_SECONDS, refreshing answers that would expire before its next
+# run. Its requests go through the request queue like everyone else's, as one more session.
+class Prewarmer:
+    def __init__(self, interval=PREWARM_INTERVAL_SECONDS, concurrency=PREWARM_CONCURRENCY):
+        self.interval = interval
+        self.concurrency = concurrency
+        self.lock = threading.Lock()
+        self.questions = {question for pills in get_quick_suggestions().values() for _, question in pills}
+        self.warm_keys = set()
+        self.total = 0
+        self.last_run = None
+        # Coverage: how many recommendation requests for a pill question hit a warmed answer
+        self.pill_requests = 0
+        self.pill_hits = 0
+
+    def start(self):
+        threading.Thread(target=self.loop, name="eatwise-prewarm", daemon=True).start()
+
+    def loop(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Pre-warming quick suggestions failed")
+            time.sleep(self.interval)
+
+    def run_once(self):
+        if not response_cache_enabled():
+            logger.info("Response cache is off; not pre-warming quick suggestions")
+            return
+        client = get_shared_openai_client()
+        cache = get_response_cache()
+        next_run = time.time() + self.interval
+        jobs = []
+        warm = set()
+        for goal, pills in get_quick_suggestions().items():
+            for _, question in pills:
+                key = make_recommendation_cache_key(question, goal, DEFAULT_NUM_RECOMMENDATIONS, [], [])
+                expires_at = cache.expires_at(key)
+                if expires_at is not None and expires_at > next_run:
+                    warm.add(key)
+                else:
+                    jobs.append((goal, question, key, expires_at is not None))
+        with self.lock:
+            self.warm_keys = set(warm)
+            self.total = len(warm) + len(jobs)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="eatwise-prewarm") as pool:
+            futures = {
+                pool.submit(
+                    get_nutrition_recommendations, client, question, goal, DEFAULT_NUM_RECOMMENDATIONS, [], [],
+                    refresh=stale, record_coverage=False
+                ): key
+                for goal, question, key, stale in jobs
+            }
+            for future in as_completed(futures):
+                if future.result():
+                    with self.lock:
+                        self.warm_keys.add(futures[future])
+        self.last_run = time.time()
+        stats = self.stats()
+        logger.info(
+            "Pre-warmed quick suggestions: %d/%d warm (%d fetched); pill coverage %s",
+            stats["warm"], stats["total"], len(jobs),
+            f"{stats['coverage']:.0%}" if stats["coverage"] is not None else "n/a"
+        )
+
+    def record_request(self, query, cache_key):
+        if query not in self.questions:
+            return
+        with self.lock:
+            self.pill_requests += 1
+            warm = cache_key in self.warm_keys
+            if warm:
+                self.pill_hits += 1
+        get_metrics().inc("cache_lookups", cache="prewarm", result="hit" if warm else "miss")
+
+    def stats(self):
+        with self.lock:
+            return {
+                "warm": len(self.warm_keys),
+                "total": self.total,
+                "last_run": self.last_run,
+                "pill_requests": self.pill_requests,
+                "pill_hits": self.pill_hits,
+                "coverage": self.pill_hits / self.pill_requests if self.pill_requests else None,
+            }
+
+
+# One pre-warming job per process, started by the first script run
+@st.cache_resource
+def get_prewarmer():
+    prewarmer = Prewarmer()
+    get_metrics().gauge("prewarm_warm_answers", lambda: prewarmer.stats()["warm"])
+    prewarmer.start()
+    return prewarmer
+
+
+if PREWARM_ENABLED:
+    get_prewarmer()
+if METRICS_ENABLED and (METRICS_PORT or METRICS_LOG_PATH):
+    start_metrics_exporters()
+
+# Initialize session state (views over the history store; entries are not loaded into memory)
+if 'recommendation_history' not in st.session_state:
+    st.session_state.recommendation_history = open_history("recommendation")
+if 'analysis_history' not in st.session_state:
+    st.session_state.analysis_history = open_history("analysis")
+
+# Each tab, and the history panel inside it, is a fragment: interacting with one only reruns
+# that region instead of the whole script. The sidebar preferences are passed in and only change
+# on a full rerun (when the preferences form is applied).
 
 # ===================== TAB 1: Food Recommendations =====================
-with tab1:
+@st.fragment
+def recommendation_tab(health_goal, num_recommendations, meal_type, dietary_restrictions):
     col1 = st.columns([1])[0]
 
     with col1:
@@ -835,66 +3443,8 @@ with tab1:
         st.markdown("#### 💡 Quick Suggestions")
 
         # Generate suggestions based on selected health goal
-        if health_goal == "Weight Loss":
-            quick_suggestions = [
-                ("🥗 Low-Cal Meals", "What are filling but low-calorie meals for weight loss?"),
-                ("🍎 Smart Snacks", "What snacks won't sabotage my weight loss goals?"),
-                ("🔥 Metabolism Boost", "What foods help boost metabolism for weight loss?"),
-            ]
-        elif health_goal == "Muscle Building":
-            quick_suggestions = [
-                ("💪 Protein Power", "What are the best high-protein meals for muscle gain?"),
-                ("🏋️ Post-Workout", "What's the ideal post-workout meal for recovery?"),
-                ("🥚 Breakfast Gains", "What's a protein-rich breakfast for muscle building?"),
-            ]
-        elif health_goal == "Keep Fit/Maintenance":
-            quick_suggestions = [
-                ("⚖️ Balanced Meals", "What are well-balanced meals for maintenance?"),
-                ("🏃 Active Lifestyle", "What should I eat to support an active lifestyle?"),
-                ("🍱 Meal Prep", "Suggest easy meal prep ideas for the week"),
-            ]
-        elif health_goal == "Heart Health":
-            quick_suggestions = [
-                ("❤️ Heart-Healthy Fats", "What are the best heart-healthy fats to include?"),
-                ("🧂 Low Sodium", "Suggest flavorful low-sodium meal options"),
-                ("🐟 Omega-3 Sources", "What are good omega-3 rich foods besides fish?"),
-            ]
-        elif health_goal == "Energy Boost":
-            quick_suggestions = [
-                ("⚡ Morning Energy", "What breakfast gives sustained energy all morning?"),
-                ("😴 Beat Afternoon Slump", "What should I eat to avoid the 3pm energy crash?"),
-                ("🔋 Pre-Workout Fuel", "What should I eat before a workout for energy?"),
-            ]
-        elif health_goal == "Diabetes Management":
-            quick_suggestions = [
-                ("📉 Blood Sugar Control", "What meals help stabilize blood sugar levels?"),
-                ("🍞 Low-GI Options", "What are good low-glycemic index food choices?"),
-                ("🥗 Balanced Carbs", "How should I balance carbs in my meals?"),
-            ]
-        elif health_goal == "High Protein Diet":
-            quick_suggestions = [
-                ("🥩 Protein Variety", "What are diverse protein sources beyond meat?"),
-                ("🌱 Plant Protein", "What are the best plant-based protein options?"),
-                ("🍳 High-Protein Breakfast", "What's a high-protein breakfast under 400 calories?"),
-            ]
-        elif health_goal == "Vegetarian/Vegan":
-            quick_suggestions = [
-                ("🌱 Protein Sources", "What are the best plant-based protein options?"),
-                ("💊 Nutrient Coverage", "How do I ensure I get B12, iron, and omega-3?"),
-                ("🥗 Complete Meals", "What are balanced vegan meal ideas?"),
-            ]
-        elif health_goal == "Low Carb Diet":
-            quick_suggestions = [
-                ("🥑 Keto-Friendly", "What are satisfying low-carb, high-fat meals?"),
-                ("🍞 Carb Substitutes", "What are good alternatives to bread, rice, and pasta?"),
-                ("🥗 Low-Carb Veggies", "What vegetables are lowest in carbs?"),
-            ]
-        else:  # General Healthy Eating (default)
-            quick_suggestions = [
-                ("🥞 Breakfast Ideas", "What are some nutritious breakfast options?"),
-                ("🍱 Quick Lunches", "Suggest quick and healthy lunch ideas"),
-                ("🍴 Dinner Recipes", "What are some balanced dinner recipes?"),
-            ]
+        suggestions_by_goal = get_quick_suggestions()
+        quick_suggestions = suggestions_by_goal.get(health_goal, suggestions_by_goal["General Healthy Eating"])
 
         cols_pills = st.columns(len(quick_suggestions))
         for idx, (pill_label, suggestion_text) in enumerate(quick_suggestions):
@@ -902,24 +3452,26 @@ with tab1:
                 if st.button(pill_label, use_container_width=True, key=f"pill_{idx}"):
                     st.session_state.recommendation_query = suggestion_text
 
-        user_query = st.text_area(
-            "What kind of food recommendations are you looking for?",
-            placeholder="E.g., 'What should I eat for breakfast to boost my energy?' or 'Suggest protein-rich snacks for muscle building'",
-            height=100,
-            key="recommendation_query"
-        )
-
-        # selection badges removed per user request
-
-        col_btn1, col_btn2 = st.columns([1, 1])
-        with col_btn1:
-            submit_button = st.button("🔍 Get Recommendations", type="primary", use_container_width=True)
-        with col_btn2:
-            clear_rec_button = st.button("🗑️ Clear History", use_container_width=True, key="clear_rec")
-
-        if clear_rec_button:
-            st.session_state.recommendation_history = []
-            st.rerun()
+        # The question is only sent on submit, not on every edit
+        with st.form("recommendation_form", border=False):
+            user_query = st.text_area(
+                "What kind of food recommendations are you looking for?",
+                placeholder="E.g., 'What should I eat for breakfast to boost my energy?' or 'Suggest protein-rich snacks for muscle building'",
+                height=100,
+                key="recommendation_query"
+            )
+
+            # selection badges removed per user request
+
+            col_btn1, col_btn2 = st.columns([1, 1])
+            with col_btn1:
+                submit_button = st.form_submit_button("🔍 Get Recommendations", type="primary", use_container_width=True)
+            with col_btn2:
+                st.form_submit_button(
+                    "🗑️ Clear History",
+                    use_container_width=True,
+                    on_click=st.session_state.recommendation_history.clear
+                )
 
     # Handle recommendation submission
     if submit_button:
@@ -928,6 +3480,7 @@ with tab1:
         else:
             client = create_openai_client()
             if client:
+                stream_placeholder = st.empty()
                 with st.spinner("🤔 Generating personalized recommendations..."):
                     recommendations = get_nutrition_recommendations(
                         client,
@@ -935,84 +3488,38 @@ with tab1:
                         health_goal,
                         num_recommendations,
                         meal_type,
-                        dietary_restrictions
+                        dietary_restrictions,
+                        on_delta=make_streaming_renderer(stream_placeholder, split_recommendation_parts, recommendation_card_html),
+                        on_queue=make_queue_notice(stream_placeholder)
                     )
+                    # The finished answer is shown in the history below
+                    stream_placeholder.empty()
 
                     if recommendations:
-                        st.session_state.recommendation_history.append({
-                            'query': user_query,
-                            'goal': health_goal,
-                            'response': recommendations,
-                            'timestamp': time.strftime("%Y-%m-%d %H:%M:%S")
-                        })
+                        st.session_state.recommendation_history.append(
+                            make_recommendation_entry(user_query, health_goal, recommendations)
+                        )
                         st.success("✅ Recommendations generated successfully!")
 
+    recommendation_history_panel()
+
+
 # Display recommendation history (each AI suggestion rendered as a separate card)
+@st.fragment
+def recommendation_history_panel():
     if st.session_state.recommendation_history:
         st.header("📜 Recommendation History")
-        for idx, chat in enumerate(reversed(st.session_state.recommendation_history)):
-            with st.expander(f"🕒 {chat['timestamp']} - {chat['goal']}", expanded=(idx==0)):
-                st.markdown(f"**Your Question:** {chat['query']}")
-                st.divider()
-                st.markdown(f'<div class="result-header">✨ AI Recommendations</div>', unsafe_allow_html=True)
-
-                resp_text = chat.get("response", "") or ""
-                
-                # Split by numbered items (1. 2. 3. etc.)
-                parts = re.split(r'\n(?=\d+\.\s+\*\*)', resp_text)
-                parts = [p.strip() for p in parts if p.strip()]
-
-                # Filter out only the INTRO sentence (not "Why it fits")
-                intro_keywords = ['certainly', 'here are', 'sure thing', 'of course', 
-                                'glad to help', "i'd be happy", 'let me suggest']
-                
-                filtered_parts = []
-                for part in parts:
-                    # Skip only if it's a short intro sentence at the start
-                    is_intro = (
-                        len(part.split()) < 30 and
-                        any(kw in part.lower() for kw in intro_keywords) and
-                        not part.strip().startswith('**') and  # Not a titled section
-                        not re.match(r'^\d+\.', part.strip())  # Not a numbered item
-                    )
-                    if not is_intro:
-                        filtered_parts.append(part)
-
-                # Fallback if everything was filtered
-                if not filtered_parts:
-                    filtered_parts = parts
-
-                # Display recommendations
-                if not filtered_parts:
-                    # Absolute fallback: show whole response
-                    html_body = md_to_html(resp_text)
-                    st.markdown(f'<div class="recommendation-box"><div class="result-value">{html_body}</div></div>', 
-                              unsafe_allow_html=True)
-                else:
-                    for part in filtered_parts:
-                        lines = part.splitlines()
-                        
-                        # Extract title (first line, remove numbering)
-                        title = lines[0].strip() if lines else "Recommendation"
-                        title_clean = re.sub(r'^\d+\.\s*', '', title)  # Remove "1. "
-                        title_clean = title_clean.strip('*').strip()   # Remove markdown stars
-                        
-                        # Extract body (everything after first line)
-                        body = "\n".join(lines[1:]).strip() if len(lines) > 1 else ""
-                        
-                        # Convert to HTML (preserves "Why it fits" since it's in the body)
-                        body_html = md_to_html(body)
-                        
-                        st.markdown(
-                            f'''<div class="recommendation-box">
-                                <div class="result-label">{title_clean}</div>
-                                <div class="result-value">{body_html}</div>
-                            </div>''',
-                            unsafe_allow_html=True
-                        )
+        render_history_page(
+            st.session_state.recommendation_history,
+            "rec_history",
+            lambda chat: f"🕒 {chat['timestamp']} - {chat['goal']}",
+            render_recommendation_entry
+        )
+
 
 # ===================== TAB 2: Nutritional Analysis =====================
-with tab2:
+@st.fragment
+def analysis_tab(dietary_restrictions):
     st.markdown("<div class='pill-header'>🔍 Analyze Nutritional Content</div>", unsafe_allow_html=True)
 
     analysis_method = st.radio(
@@ -1022,12 +3529,14 @@ with tab2:
     )
 
     if analysis_method == "📸 Upload Food Photo":
-        st.subheader("Upload a photo of your food")
+        st.subheader("Upload photos of your food")
 
-        uploaded_file = st.file_uploader(
-            "Choose an image...",
+        # Left outside a form so the previews and upload sizes show as soon as files are picked
+        uploaded_files = st.file_uploader(
+            "Choose one or more images...",
             type=["jpg", "jpeg", "png"],
-            help="Upload a clear photo of your food for nutritional analysis"
+            accept_multiple_files=True,
+            help="Upload clear photos of your food for nutritional analysis, e.g. all of today's meals"
         )
 
         additional_context = st.text_input(
@@ -1036,103 +3545,186 @@ with tab2:
             key="image_context"
         )
 
-        if uploaded_file is not None:
+        if len(uploaded_files) == 1:
+            uploaded_file = uploaded_files[0]
             col1, col2 = st.columns([1, 1])
 
             with col1:
                 st.image(uploaded_file, caption="Uploaded Food Image", use_container_width=True)
+                prepared = preprocess_image(uploaded_file.getvalue())
+                if prepared["bytes_saved"] > 0:
+                    st.caption(
+                        f"📉 Optimized for upload: {prepared['original_size'] / 1024:.0f} KB → "
+                        f"{prepared['size'] / 1024:.0f} KB ({prepared['bytes_saved'] / prepared['original_size']:.0%} smaller)"
+                    )
 
             with col2:
                 if st.button("🔬 Analyze Food", type="primary", use_container_width=True, key="analyze_image"):
                     client = create_openai_client()
                     if client:
+                        stream_placeholder = st.empty()
                         with st.spinner("🧠 Analyzing nutritional content..."):
                             image_bytes = uploaded_file.getvalue()
-                            analysis = analyze_food_from_image(client, image_bytes, additional_context)
+                            analysis = analyze_food_from_image(
+                                client,
+                                image_bytes,
+                                additional_context,
+                                on_delta=make_streaming_renderer(stream_placeholder, split_analysis_sections, analysis_card_html),
+                                on_queue=make_queue_notice(stream_placeholder)
+                            )
+                            stream_placeholder.empty()
 
                             if analysis:
-                                st.session_state.analysis_history.append({
-                                    'method': 'image',
-                                    'context': additional_context if additional_context else 'No additional context',
-                                    'analysis': analysis,
-                                    'timestamp': time.strftime("%Y-%m-%d %H:%M:%S")
-                                })
+                                st.session_state.analysis_history.append(make_analysis_entry(
+                                    'image',
+                                    analysis,
+                                    filename=uploaded_file.name,
+                                    context=additional_context if additional_context else 'No additional context'
+                                ))
                                 st.success("✅ Analysis complete!")
 
+        elif uploaded_files:
+            thumb_cols = st.columns(min(len(uploaded_files), 4))
+            for idx, photo in enumerate(uploaded_files):
+                with thumb_cols[idx % len(thumb_cols)]:
+                    st.image(photo, caption=photo.name, use_container_width=True)
+
+            if st.button(f"🔬 Analyze {len(uploaded_files)} Photos", type="primary", key="analyze_images"):
+                client = create_openai_client()
+                if client:
+                    progress = st.progress(0.0, text=f"🧠 Analyzing {len(uploaded_files)} photos...")
+                    completed = 0
+                    images = [photo.getvalue() for photo in uploaded_files]
+                    # Results are added to the history in the order they finish
+                    for photo_idx, analysis in analyze_food_images_concurrently(client, images, additional_context):
+                        completed += 1
+                        progress.progress(completed / len(images), text=f"🧠 Analyzed {completed} of {len(images)} photos...")
+                        if analysis:
+                            st.session_state.analysis_history.append(make_analysis_entry(
+                                'image',
+                                analysis,
+                                filename=uploaded_files[photo_idx].name,
+                                context=additional_context if additional_context else 'No additional context'
+                            ))
+                    progress.empty()
+                    st.success(f"✅ Analyzed {completed} photos!")
+
     else:  # Text description
         st.subheader("Describe the food you want to analyze")
 
-        food_description = st.text_area(
-            "Describe your food/meal:",
-            placeholder="E.g., 'One bowl of brown rice with grilled salmon, steamed broccoli, and avocado' or 'Two slices of whole wheat toast with peanut butter and banana'",
-            height=100,
-            key="food_description"
-        )
+        with st.form("analysis_text_form", border=False):
+            food_description = st.text_area(
+                "Describe your food/meal:",
+                placeholder="E.g., 'One bowl of brown rice with grilled salmon, steamed broccoli, and avocado' or 'Two slices of whole wheat toast with peanut butter and banana'",
+                height=100,
+                key="food_description"
+            )
+
+            analyze_text_button = st.form_submit_button("🔬 Analyze Food", type="primary")
 
-        if st.button("🔬 Analyze Food", type="primary", key="analyze_text"):
+        if analyze_text_button:
             if not food_description:
                 st.warning("⚠️ Please describe the food you want to analyze.")
             else:
+                # Made once, for both the local answer and the restriction check
+                estimate = estimate_meal_locally(food_description)
                 client = create_openai_client()
                 if client:
+                    stream_placeholder = st.empty()
                     with st.spinner("🧠 Analyzing nutritional content..."):
-                        analysis = analyze_food_from_text(client, food_description)
+                        analysis = analyze_food_from_text(
+                            client,
+                            food_description,
+                            on_delta=make_streaming_renderer(stream_placeholder, split_analysis_sections, analysis_card_html),
+                            on_queue=make_queue_notice(stream_placeholder),
+                            estimate=estimate
+                        )
+                        stream_placeholder.empty()
 
                         if analysis:
-                            st.session_state.analysis_history.append({
-                                'method': 'text',
-                                'description': food_description,
-                                'analysis': analysis,
-                                'timestamp': time.strftime("%Y-%m-%d %H:%M:%S")
-                            })
+                            st.session_state.analysis_history.append(make_analysis_entry(
+                                'text',
+                                analysis,
+                                description=food_description
+                            ))
                             st.success("✅ Analysis complete!")
 
+                # Checked against the food table, so it needs no model call
+                conflicts = find_restriction_conflicts(estimate, dietary_restrictions)
+                if conflicts:
+                    st.warning("⚠️ " + "; ".join(
+                        f"**{food}** doesn't fit your {restriction} preference" for restriction, food in conflicts
+                    ))
+
+    analysis_history_panel()
+
+
+@st.fragment
+def analysis_history_panel():
     # Clear analysis history button
     if st.session_state.analysis_history:
-        if st.button("🗑️ Clear Analysis History", key="clear_analysis"):
-            st.session_state.analysis_history = []
-            st.rerun()
+        st.button(
+            "🗑️ Clear Analysis History",
+            key="clear_analysis",
+            on_click=st.session_state.analysis_history.clear
+        )
 
     # Display analysis history
     if st.session_state.analysis_history:
         st.header("📊 Analysis History")
-        for idx, analysis_item in enumerate(reversed(st.session_state.analysis_history)):
-            with st.expander(f"🕒 {analysis_item['timestamp']} - {analysis_item['method'].upper()} Analysis", expanded=(idx==0)):
-                if analysis_item['method'] == 'image':
-                    st.markdown(f"**Additional Information:** {analysis_item['context']}")
-                else:
-                    st.markdown(f"**Food Description:** {analysis_item['description']}")
-                st.divider()
-                st.markdown(f'<div class="result-header">🔬 Nutritional Analysis</div>', unsafe_allow_html=True)
-
-                analysis_text = analysis_item.get('analysis', '') or ''
-                # Split analysis into sections by numbered headings or markdown headings (e.g., '1.' or '###')
-                sections = re.split(r"\n(?=\s*(?:\d+\.|#{1,6}\s))", "\n" + analysis_text)
-                sections = [s.strip() for s in sections if s and s.strip()]
-
-                if not sections:
-                    # fallback: show whole analysis
-                    html_body = md_to_html(analysis_text)
-                    st.markdown(f'<div class="nutrition-analysis-box"><div class="result-value">{html_body}</div></div>', unsafe_allow_html=True)
-                else:
-                    for s in sections:
-                        # determine title and body
-                        lines = s.splitlines()
-                        first = lines[0].strip() if lines else ''
-                        # if first line looks like a heading (starts with digits or #), extract label
-                        m = re.match(r'^(?:#{1,6}\s*)?(\d+\.?\s*)(.*)', first)
-                        if m:
-                            title = m.group(2).strip() if m.group(2) else f"Section {m.group(1).strip()}"
-                        else:
-                            # remove leading markdown hashes if present
-                            title = re.sub(r'^#{1,6}\s*', '', first).strip()
-                        title_clean = title.strip().strip('*').strip()
-                        body = '\n'.join(lines[1:]).strip() if len(lines) > 1 else ''
-                        body_html = md_to_html(body)
-                        st.markdown(
-                            f'<div class="nutrition-analysis-box"><div class="result-label">{title_clean}</div><div class="result-value">{body_html}</div></div>',
-                            unsafe_allow_html=True
-                        )
+        render_history_page(
+            st.session_state.analysis_history,
+            "analysis_history",
+            lambda item: f"🕒 {item['timestamp']} - {item['method'].upper()} Analysis",
+            render_analysis_entry
+        )
+
+
+# Operator view of this process's metrics; refreshes itself while the page is open
+@st.fragment(run_every=10)
+def metrics_panel():
+    snapshot = get_metrics().snapshot()
+    timings = [
+        {
+            "span": timing["name"],
+            "labels": ", ".join(f"{k}={v}" for k, v in sorted(timing["labels"].items())),
+            "calls": timing["count"],
+            "p50 ms": timing["p50"] * 1000,
+            "p95 ms": timing["p95"] * 1000,
+            "p99 ms": timing["p99"] * 1000,
+        }
+        for timing in sorted(snapshot["timings"], key=lambda t: (t["name"], sorted(t["labels"].items())))
+    ]
+    counters = [
+        {
+            "counter": counter["name"],
+            "labels": ", ".join(f"{k}={v}" for k, v in sorted(counter["labels"].items())),
+            "value": round(counter["value"], 4),
+        }
+        for counter in sorted(snapshot["counters"], key=lambda c: (c["name"], sorted(c["labels"].items())))
+    ]
+    if not timings and not counters:
+        st.caption("No calls yet.")
+        return
+    st.dataframe(timings, hide_index=True, use_container_width=True)
+    st.dataframe(counters, hide_index=True, use_container_width=True)
+    for gauge in snapshot["gauges"]:
+        st.caption(f"{gauge['name']}: {gauge['value']:g}")
+
+
+if METRICS_PANEL_ENABLED:
+    with st.sidebar:
+        with st.expander("📈 Metrics"):
+            metrics_panel()
+
+# Main tabs
+tab1, tab2 = st.tabs(["🍴 Get Food Recommendations", "🔍 Analyze Nutritional Content"])
+
+with tab1:
+    recommendation_tab(health_goal, num_recommendations, meal_type, dietary_restrictions)
+
+with tab2:
+    analysis_tab(dietary_restrictions)
 
 # Footer: App disclaimer
 st.divider()
@@ -0,0 +1,43 @@
+"""Import app.py outside `streamlit run` so benchmarks can call its helpers directly.
+
+Streamlit runs the script in "bare mode": widgets return their defaults and nothing is
+rendered, which is enough to exercise the helper functions.
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_app(**settings):
+    """Import app.py with the given settings applied as environment variables."""
+    os.environ.setdefault("AZURE_API_KEY", "benchmark")
+    for name, value in settings.items():
+        os.environ[name] = str(value)
+    # Bare mode logs a warning for every Streamlit call; keep benchmark output readable.
+    # Parsing the config resets the log level, so parse it first.
+    import streamlit.logger
+    from streamlit import config
+
+    config.get_config_options()
+    streamlit.logger.set_log_level("error")
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    import app
+
+    return app
+
+
+def share_script_cache():
+    """Make every AppTest run in this process reuse one compiled app.py, as the server does.
+
+    AppTest and its script runner each create a new ScriptCache per run, so without this
+    every rerun compiles the script again, which a real session never pays for.
+    """
+    import streamlit.testing.v1.app_test as app_test
+    import streamlit.testing.v1.local_script_runner as local_script_runner
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+
+    cache = ScriptCache()
+    app_test.ScriptCache = local_script_runner.ScriptCache = lambda: cache
+    return cache
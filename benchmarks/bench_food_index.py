@@ -0,0 +1,54 @@
+"""Benchmark fuzzy food-name lookups in FoodNameIndex at increasing table sizes.
+
+Builds indexes over synthetic food names (random combinations of words from data/foods.csv
+plus made-up brand words, the shape of a large branded-foods database) and times lookups of
+misspelled names, plus the build time.
+
+    python benchmarks/bench_food_index.py [--sizes 1000 100000 300000]
+"""
+import argparse
+import random
+import statistics
+import time
+import timeit
+
+from _app import load_app
+
+QUERIES = ["brocoli", "chickn breast", "peanut buter", "sweet potatoe", "strawbery", "whole weat bread"]
+
+
+def synthetic_names(app, size, seed=0):
+    rng = random.Random(seed)
+    table = app.get_food_table()
+    words = sorted({w for name in table.lookup for w in name.split()})
+    brands = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(4, 9))) for _ in range(2000)]
+    names = list(table.lookup)
+    while len(names) < size:
+        names.append(" ".join([rng.choice(brands)] + rng.sample(words, rng.randint(1, 3))))
+    return names[:size]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 300000])
+    parser.add_argument("--repeat", type=int, default=20, help="timing repetitions per case")
+    args = parser.parse_args()
+
+    app = load_app()
+    print(f"{'names':>8} {'build s':>8} {'median µs':>10} {'p max µs':>9}  best match of '{QUERIES[0]}'")
+    for size in args.sizes:
+        names = synthetic_names(app, size)
+        started = time.perf_counter()
+        index = app.FoodNameIndex(names, range(len(names)))
+        build = time.perf_counter() - started
+        per_query = []
+        for query in QUERIES:
+            timer = timeit.Timer(lambda: index.search(query, k=5, min_score=app.FOOD_MATCH_MIN_SCORE))
+            number, _ = timer.autorange()
+            per_query.append(statistics.median(t / number for t in timer.repeat(repeat=args.repeat, number=number)))
+        best = index.search(QUERIES[0], k=1, min_score=app.FOOD_MATCH_MIN_SCORE)
+        print(f"{size:>8} {build:>8.2f} {statistics.median(per_query) * 1e6:>10.1f} {max(per_query) * 1e6:>9.1f}  {best[0][1] if best else '-'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""Throughput and latency of the three LLM helpers against a local mock Azure OpenAI server.
+
+Starts benchmarks/mock_azure_server.py in a subprocess (or uses --url), points the app at it
+and calls get_nutrition_recommendations, analyze_food_from_text and analyze_food_from_image
+from a thread pool at increasing concurrency. Every call has a distinct input, so the caches
+and single-flight do not absorb any of them and each one reaches the server.
+
+    python benchmarks/bench_llm_helpers.py [--concurrency 1 4 16 64] [--requests 64] [--no-stream]
+        [--latency 0.2] [--tokens-per-second 200] [--error-rate 0.02] [--throttle-rate 0.02]
+
+Per helper and concurrency it reports calls/s, p50/p95/p99 latency, time to first streamed
+text, failed calls, and the process RSS after the run (current and peak). Compare two runs of
+the same command before and after a change to spot regressions.
+"""
+import argparse
+import os
+import random
+import resource
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import mock_azure_server
+from _app import load_app
+
+GOALS = ["Weight Loss", "Muscle Building", "Heart Health", "Energy Boost", "General Healthy Eating"]
+DISHES = ["stew", "curry", "casserole", "noodle soup", "grain bowl", "wrap", "risotto", "pie"]
+
+
+def rss_mb():
+    """Current and peak resident memory of this process, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    try:
+        with open("/proc/self/statm") as f:
+            current = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        current = float("nan")
+    return current, peak
+
+
+def make_images(count, seed):
+    """Distinct JPEG photos (random colour blocks), so no two share a cache entry."""
+    from PIL import Image
+
+    rng = random.Random(seed)
+    images = []
+    for _ in range(count):
+        image = Image.new("RGB", (640, 480))
+        for y in range(0, 480, 40):
+            for x in range(0, 640, 40):
+                image.paste((rng.randrange(256), rng.randrange(256), rng.randrange(256)), (x, y, x + 40, y + 40))
+        buffer = BytesIO()
+        image.save(buffer, format="JPEG", quality=85)
+        images.append(buffer.getvalue())
+    return images
+
+
+def make_calls(app, client, helper, count, run_id):
+    """`count` zero-argument callables, each a distinct request to `helper`."""
+    calls = []
+    if helper == "recommendations":
+        for i in range(count):
+            goal = GOALS[i % len(GOALS)]
+            calls.append(lambda i=i, goal=goal, on_delta=None: app.get_nutrition_recommendations(
+                client, f"Ideas for a {DISHES[i % len(DISHES)]} ({run_id}-{i})", goal, 5, [], [], on_delta=on_delta
+            ))
+    elif helper == "text_analysis":
+        for i in range(count):
+            calls.append(lambda i=i, on_delta=None: app.analyze_food_from_text(
+                client, f"a bowl of homemade {DISHES[i % len(DISHES)]} number {run_id}-{i}", on_delta=on_delta
+            ))
+    else:
+        for image in make_images(count, run_id):
+            calls.append(lambda image=image, on_delta=None: app.analyze_food_from_image(client, image, on_delta=on_delta))
+    return calls
+
+
+def timed(call, stream):
+    """Run one call; returns (seconds, seconds to first streamed text or None, succeeded)."""
+    started = time.perf_counter()
+    first = []
+
+    def on_delta(text):
+        if not first:
+            first.append(time.perf_counter() - started)
+
+    result = call(on_delta=on_delta if stream else None)
+    return time.perf_counter() - started, first[0] if first else None, bool(result)
+
+
+def percentile_ms(values, pct):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--requests", type=int, default=64, help="calls per helper and concurrency level (at least 2x the concurrency)")
+    parser.add_argument("--helpers", nargs="+", default=["recommendations", "text_analysis", "image_analysis"])
+    parser.add_argument("--no-stream", action="store_true", help="call the helpers without on_delta")
+    parser.add_argument("--url", help="use an already running mock (or real) endpoint instead of starting one")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--completion-tokens", type=int, default=250)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if url is None:
+        server, url = mock_azure_server.spawn(
+            args.port, latency=args.latency, tokens_per_second=args.tokens_per_second,
+            completion_tokens=args.completion_tokens, error_rate=args.error_rate,
+            throttle_rate=args.throttle_rate, retry_after=0.2
+        )
+    try:
+        app = load_app(
+            AZURE_ENDPOINT=url,
+            EATWISE_DATA_DIR=tempfile.mkdtemp(prefix="eatwise-bench-"),
+            OPENAI_MAX_CONNECTIONS=max(args.concurrency),
+            OPENAI_MAX_KEEPALIVE_CONNECTIONS=max(args.concurrency),
+        )
+        client = app.get_shared_openai_client()
+        stream = not args.no_stream
+        run_id = f"{time.time():.0f}"
+        print(f"endpoint {url}, {'streamed' if stream else 'not streamed'}, RSS at start {rss_mb()[0]:.0f} MB\n")
+        print(f"{'helper':<16} {'conc':>4} {'calls':>5} {'failed':>6} {'calls/s':>8} "
+              f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'first ms':>8} {'RSS MB':>7} {'peak MB':>7}")
+        for helper in args.helpers:
+            for concurrency in args.concurrency:
+                count = max(args.requests, 2 * concurrency)
+                calls = make_calls(app, client, helper, count, f"{run_id}-{concurrency}")
+                started = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                    results = list(pool.map(lambda call: timed(call, stream), calls))
+                elapsed = time.perf_counter() - started
+                latencies = [seconds for seconds, _, ok in results if ok]
+                first = [seconds for _, seconds, ok in results if ok and seconds is not None]
+                failed = sum(1 for _, _, ok in results if not ok)
+                current, peak = rss_mb()
+                print(
+                    f"{helper:<16} {concurrency:>4} {count:>5} {failed:>6} {count / elapsed:>8.1f} "
+                    f"{percentile_ms(latencies, 50):>8.0f} {percentile_ms(latencies, 95):>8.0f} "
+                    f"{percentile_ms(latencies, 99):>8.0f} "
+                    f"{(statistics.median(first) * 1000 if first else float('nan')):>8.0f} "
+                    f"{current:>7.0f} {peak:>7.0f}"
+                )
+        if server is not None:
+            print(f"\nmock server: {mock_azure_server.stats(url)}")
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""Benchmark md_to_html on realistic ~1500-token model answers.
+
+Compares the current converter with the previous line-by-line implementation (kept here
+as the baseline) on recommendation and analysis answers of the size gpt-4o returns with
+max_tokens=1500.
+
+    python benchmarks/bench_md_to_html.py [--repeat 200]
+"""
+import argparse
+import re
+import statistics
+import timeit
+
+from _app import load_app
+
+
+# The converter md_to_html replaced, kept as the baseline for comparison
+def legacy_md_to_html(md_text: str) -> str:
+    if not md_text:
+        return ""
+    lines = md_text.splitlines()
+    out = []
+    in_ul = False
+    for raw in lines:
+        line = raw.rstrip()
+        stripped = line.strip()
+        if stripped.startswith('- '):
+            if not in_ul:
+                in_ul = True
+                out.append('<ul>')
+            item = stripped[2:].strip()
+            item = re.sub(r'\*\*(.+?)\*\*', r'<strong>\1</strong>', item)
+            item = re.sub(r'\*(.+?)\*', r'<em>\1</em>', item)
+            out.append(f'<li>{item}</li>')
+        else:
+            if in_ul:
+                out.append('</ul>')
+                in_ul = False
+            if stripped == '':
+                out.append('')
+            else:
+                line_html = re.sub(r'\*\*(.+?)\*\*', r'<strong>\1</strong>', line)
+                line_html = re.sub(r'\*(.+?)\*', r'<em>\1</em>', line_html)
+                out.append(f'<p>{line_html}</p>')
+    if in_ul:
+        out.append('</ul>')
+    return '\n'.join([o for o in out if o is not None])
+
+
+FOODS = [
+    ("Overnight Oats with Berries", 320, "rolled oats, chia seeds and mixed berries soaked in almond milk"),
+    ("Grilled Salmon Bowl", 520, "salmon over brown rice with edamame, cucumber and a miso dressing"),
+    ("Greek Yogurt Parfait", 250, "plain Greek yogurt layered with walnuts, honey and sliced peaches"),
+    ("Chickpea & Spinach Curry", 430, "chickpeas simmered in a tomato-coconut sauce with baby spinach"),
+    ("Turkey Lettuce Wraps", 290, "lean ground turkey, water chestnuts and ginger in butter lettuce cups"),
+    ("Quinoa Power Salad", 410, "quinoa, roasted sweet potato, black beans, avocado and lime"),
+    ("Egg White Veggie Omelette", 210, "egg whites folded with peppers, mushrooms and feta"),
+    ("Lentil Soup", 340, "red lentils, carrots, celery and cumin in a vegetable broth"),
+    ("Tofu Stir-Fry", 380, "firm tofu with broccoli, snap peas and a light soy-garlic sauce"),
+    ("Cottage Cheese & Pineapple", 180, "low-fat cottage cheese topped with pineapple and pumpkin seeds"),
+]
+
+
+def recommendation_answer(num_items=10):
+    parts = ["Certainly! Here are some nutritious options tailored to your goal:\n"]
+    for idx, (name, kcal, description) in enumerate(FOODS[:num_items], start=1):
+        parts.append(
+            f"{idx}. **{name}**\n"
+            f"   - **Description**: A satisfying dish of {description}. It is easy to prepare "
+            f"ahead and keeps well for *two to three days* in the fridge.\n"
+            f"   - **Key Nutritional Benefits**:\n"
+            f"     - High in *fiber* and complex carbohydrates for steady energy\n"
+            f"     - Provides **{kcal // 20} g protein** to support satiety and muscle repair\n"
+            f"     - Rich in potassium, magnesium & B vitamins\n"
+            f"   - **Approximate Calories**: ~{kcal} kcal per serving\n"
+            f"   - **Why it fits your goal**: Balanced macros (protein < carbs) keep blood sugar stable "
+            f"and you full for longer, which makes it easier to stay within your daily targets.\n"
+        )
+    parts.append("Enjoy experimenting with these, and adjust portions to your needs!")
+    return "\n".join(parts)
+
+
+def analysis_answer():
+    return """### 1. **Food Identification**
+The plate contains grilled chicken breast, a portion of brown rice, steamed broccoli, sliced avocado and a small side salad with vinaigrette.
+
+### 2. **Estimated Portion Size**
+- Chicken breast: ~150 g
+- Brown rice: ~1 cup cooked (195 g)
+- Broccoli: ~1 cup (90 g)
+- Avocado: ~1/2 medium (70 g)
+- Side salad: ~1 cup mixed greens with 1 tbsp dressing
+
+### 3. **Nutritional Information**
+- **Calories**: approximately 780 kcal
+- **Macronutrients**:
+  - *Protein*: ~55 g
+  - *Carbohydrates*: ~70 g (fiber ~14 g)
+  - *Fats*: ~30 g (mostly monounsaturated)
+- **Key Vitamins and Minerals**:
+  - Vitamin C & K from broccoli
+  - Potassium and folate from avocado
+  - Niacin, B6 and selenium from chicken
+  - Magnesium and manganese from brown rice
+
+### 4. **Health Assessment**
+Overall this is a **well-balanced** meal: lean protein, whole grains, vegetables and healthy fats. Sodium is moderate if the chicken was seasoned lightly. The dressing adds ~80 kcal; choose an olive-oil based one to keep the fat profile favourable.
+
+Potential concerns:
+- Portion of rice may be large for a weight-loss goal (> 200 kcal)
+- If the avocado is a full fruit, fat and calories increase by ~120 kcal
+
+### 5. **Recommendations**
+1. Swap half of the rice for extra vegetables to lower the energy density.
+2. Add a colourful vegetable (peppers, carrots) for more antioxidants.
+3. Use lemon juice and herbs instead of a creamy dressing.
+4. Drink water or unsweetened tea with the meal.
+
+---
+*Note: values are estimates based on typical portion sizes.*
+""" * 2
+
+
+def time_call(fn, text, repeat):
+    timer = timeit.Timer(lambda: fn(text))
+    number = 20
+    samples = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    return statistics.median(samples), min(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=50, help="timing repetitions per case")
+    args = parser.parse_args()
+
+    app = load_app()
+    cases = {
+        "recommendations (10 items)": recommendation_answer(10),
+        "analysis (5 sections x2)": analysis_answer(),
+    }
+    print(f"{'case':<30} {'chars':>6} {'impl':<8} {'median µs':>10} {'best µs':>9}")
+    for label, text in cases.items():
+        for impl_name, fn in (("legacy", legacy_md_to_html), ("current", app.md_to_html)):
+            median, best = time_call(fn, text, args.repeat)
+            print(f"{label:<30} {len(text):>6} {impl_name:<8} {median * 1e6:>10.1f} {best * 1e6:>9.1f}")
+
+        # Per-card cost is what a rerun pays for each history card
+        parts = app.split_recommendation_parts(text) if "recommendation" in label else app.split_analysis_sections(text)
+        card = app.recommendation_card_html if "recommendation" in label else app.analysis_card_html
+        median, best = time_call(lambda t: [card(p) for p in parts], text, args.repeat)
+        print(f"{label:<30} {len(text):>6} {'cards':<8} {median * 1e6:>10.1f} {best * 1e6:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
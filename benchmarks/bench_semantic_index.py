@@ -0,0 +1,69 @@
+"""Benchmark the semantic cache's vector index at increasing sizes.
+
+Fills a SemanticIndex (in a temporary directory) with random unit vectors spread over a
+few scopes, then times top-k lookups for a single scope and for a scope holding most rows,
+plus embedding a query with the local hashing vectorizer.
+
+    python benchmarks/bench_semantic_index.py [--sizes 1000 10000 100000] [--dim 256]
+"""
+import argparse
+import statistics
+import tempfile
+import timeit
+
+import numpy as np
+
+from _app import load_app
+
+
+def time_call(fn, repeat):
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    times = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    return statistics.median(times), min(times)
+
+
+def fill_index(app, path, size, dim, scopes):
+    index = app.SemanticIndex(path, dim, f"bench-{dim}", max_entries=size)
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((size, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    # One large scope (70%) and the rest spread over smaller ones, like popular vs rare goals
+    row_scopes = np.where(rng.random(size) < 0.7, 0, rng.integers(1, scopes, size)).astype(np.uint64)
+    # Bulk-load the memory-mapped arrays directly; add() writes metadata per row
+    index._open(size)
+    index.vectors[:] = vectors
+    index.scopes[:] = row_scopes
+    index.keys[:] = [f"{i:064x}".encode("ascii") for i in range(size)]
+    index.count = index.next_row = size
+    index._write_meta()
+    return index, vectors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 200000])
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--scopes", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=20, help="timing repetitions per case")
+    args = parser.parse_args()
+
+    app = load_app()
+    vectorizer = app.HashingVectorizer(args.dim)
+    median, best = time_call(lambda: vectorizer.embed("What should I eat before a workout for energy?"), args.repeat)
+    print(f"hashing vectorizer embed: median {median * 1e6:.1f} µs, best {best * 1e6:.1f} µs\n")
+
+    print(f"{'rows':>8} {'scope':<8} {'matches':>8} {'median ms':>10} {'best ms':>8}")
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as path:
+            index, vectors = fill_index(app, path, size, args.dim, args.scopes)
+            query = vectors[size // 2]
+            for label, scope in (("popular", 0), ("rare", 1)):
+                matches = int((index.scopes[:size] == np.uint64(scope)).sum())
+                median, best = time_call(lambda: index.search(query, scope, k=3), args.repeat)
+                print(f"{size:>8} {label:<8} {matches:>8} {median * 1e3:>10.2f} {best * 1e3:>8.2f}")
+            del index
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Measure cold-start cost: module import times and time to first render of app.py.
+
+Every measurement runs in a fresh interpreter, so nothing is cached between them.
+
+    python benchmarks/bench_startup.py [--runs 5]
+
+- import: wall time of `import <module>` on its own
+- first render: AppTest's first run of app.py (what a new session waits for after a cold start)
+- warm rerun: a second run in the same process (cached resources already built, and app.py's
+  compiled code reused from a ScriptCache shared by both runs, as the server shares one)
+- app import chain: modules app.py pulls in before the first render, from `python -X importtime`
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SNIPPET = "import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+
+RENDER_SNIPPET = """
+import os, sys, time
+os.environ.setdefault("AZURE_API_KEY", "benchmark")
+t = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+t_import = time.perf_counter() - t
+sys.path.insert(0, {benchmarks!r})
+from _app import share_script_cache
+share_script_cache()
+at = AppTest.from_file({app!r}, default_timeout=120)
+t = time.perf_counter(); at.run(); first = time.perf_counter() - t
+t = time.perf_counter(); at.run(); warm = time.perf_counter() - t
+assert not at.exception, at.exception
+print(t_import, first, warm)
+"""
+
+HEAVY_MODULES = ["streamlit", "openai", "httpx", "pandas", "numpy", "PIL.Image"]
+
+
+def run_python(code, env=None):
+    result = subprocess.run(
+        [sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, env=env, check=True
+    )
+    return result.stdout.strip().splitlines()[-1]
+
+
+def median_ms(values):
+    return statistics.median(values) * 1000
+
+
+def app_import_chain():
+    """Top-level packages imported while app.py runs in bare mode, with cumulative import time."""
+    env = dict(os.environ, AZURE_API_KEY="benchmark", STREAMLIT_LOGGER_LEVEL="error")
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=ROOT, capture_output=True, text=True, env=env,
+    )
+    totals = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = (part.strip() for part in line[len("import time:"):].split("|"))
+        if not cumulative.isdigit() or name.startswith(" "):
+            continue
+        top = name.strip()
+        if "." not in top:
+            totals[top] = max(totals.get(top, 0), int(cumulative))
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3, help="fresh interpreters per measurement")
+    args = parser.parse_args()
+
+    print("module import (cold, median of runs)")
+    for module in HEAVY_MODULES:
+        times = [float(run_python(IMPORT_SNIPPET.format(module=module))) for _ in range(args.runs)]
+        print(f"  {module:<12} {median_ms(times):8.1f} ms")
+
+    print("\napp.py")
+    samples = [
+        [float(v) for v in run_python(RENDER_SNIPPET.format(app=os.path.join(ROOT, "app.py"), benchmarks=os.path.join(ROOT, "benchmarks"))).split()]
+        for _ in range(args.runs)
+    ]
+    imports, first, warm = zip(*samples)
+    print(f"  {'streamlit testing import':<26} {median_ms(imports):8.1f} ms")
+    print(f"  {'first render':<26} {median_ms(first):8.1f} ms")
+    print(f"  {'warm rerun':<26} {median_ms(warm):8.1f} ms")
+
+    chain = app_import_chain()
+    print("\nheavy packages imported by app.py before first render")
+    for module in HEAVY_MODULES:
+        top = module.split(".")[0]
+        status = f"{chain[top] / 1000:8.1f} ms" if top in chain else "  not imported"
+        print(f"  {top:<12} {status}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""Multi-session load test of app.py with Streamlit's AppTest and the mock Azure OpenAI server.
+
+Simulates many users clicking quick-suggestion pills, getting recommendations and analysing
+meal descriptions, then reports what a Streamlit replica needs per session:
+
+- script time per rerun (p50/p95/p99) for each kind of interaction, and the CPU time it used
+- RSS per session: how much a worker process grows for every open session
+- how an idle rerun's time grows with the length of the session's history
+
+    python benchmarks/load_test.py [--sessions 200] [--workers 4] [--rounds 2]
+        [--history-lengths 0 10 25 50] [--latency 0.2] [--tokens-per-second 200] [--cacheable]
+
+AppTest is not thread-safe, so sessions are spread over worker processes. Each worker keeps
+its sessions open and steps through them in turn, like one replica serving them (reruns
+that wait on the model are not overlapped, so reruns/s here is a lower bound). The mock server
+runs in a process of its own. Like the server, each worker compiles app.py once and reuses it
+for every rerun. RSS per session includes the element tree AppTest keeps for each session, so
+it somewhat overstates a real browser session.
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import statistics
+import tempfile
+import time
+
+import mock_azure_server
+from _app import share_script_cache
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+DISHES = ["chicken stew", "lentil curry", "tuna casserole", "beef noodle soup", "quinoa bowl", "bean wrap"]
+ACTIONS = ["open", "pill", "recommend", "idle", "switch_tab", "analyze"]
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class TimedSession:
+    """One simulated user: an AppTest whose reruns are timed (wall and CPU) per action."""
+
+    def __init__(self, samples):
+        from streamlit.testing.v1 import AppTest
+
+        self.at = AppTest.from_file(APP_PATH, default_timeout=120)
+        self.samples = samples
+
+    def run(self, action):
+        started, cpu_started = time.perf_counter(), time.process_time()
+        self.at.run()
+        self.samples.setdefault(action, []).append(
+            (time.perf_counter() - started, time.process_time() - cpu_started)
+        )
+        if self.at.exception:
+            raise RuntimeError(f"{action}: {self.at.exception[0].value}")
+
+    def click(self, label):
+        next(b for b in self.at.button if label in b.label).click()
+
+    def recommend(self, pill):
+        self.at.button(key=f"pill_{pill}").click()
+        self.run("pill")
+        self.click("Get Recommendations")
+        self.run("recommend")
+
+    def analyze(self, description):
+        radio = self.at.radio[0]
+        if radio.value != "📝 Describe Food in Text":
+            radio.set_value("📝 Describe Food in Text")
+            self.run("switch_tab")
+        self.at.text_area(key="food_description").input(description)
+        self.click("Analyze Food")
+        self.run("analyze")
+
+
+def run_worker(worker, sessions, rounds):
+    """Open `sessions` sessions and put each through `rounds` rounds of interactions."""
+    share_script_cache()
+    samples = {}
+    # A first session pays for imports, compiling app.py and shared resources; it is not counted
+    warm_up = TimedSession({})
+    warm_up.run("open")
+    rss_start = rss_mb()
+    open_sessions = []
+    for index in range(sessions):
+        session = TimedSession(samples)
+        session.run("open")
+        open_sessions.append(session)
+    for round_index in range(rounds):
+        for index, session in enumerate(open_sessions):
+            # Quick suggestions are shared, so with --cacheable most of these are answered from the cache
+            session.recommend(pill=(worker + index + round_index) % 3)
+            session.run("idle")
+            session.analyze(f"a bowl of {DISHES[index % len(DISHES)]} ({worker}-{index}-{round_index})")
+    return {"samples": samples, "rss_start": rss_start, "rss_end": rss_mb(), "sessions": sessions}
+
+
+def run_history_growth(lengths, reruns=5):
+    """Idle rerun time of one session as its analysis history grows to each of `lengths`."""
+    share_script_cache()
+    samples = {}
+    session = TimedSession(samples)
+    session.run("open")
+    results = []
+    entries = 0
+    for length in sorted(lengths):
+        while entries < length:
+            session.analyze(f"a plate of {DISHES[entries % len(DISHES)]} (history {entries})")
+            entries += 1
+        samples.pop("idle", None)
+        for _ in range(reruns):
+            session.run("idle")
+        wall, cpu = zip(*samples["idle"])
+        results.append((length, statistics.median(wall), statistics.median(cpu)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=200, help="simulated users in total")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument("--rounds", type=int, default=2, help="interaction rounds per session")
+    parser.add_argument("--history-lengths", type=int, nargs="*", default=[0, 10, 25, 50])
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--cacheable", action="store_true", help="run with CACHEABLE_MODE (response caching) on")
+    args = parser.parse_args()
+
+    server, url = mock_azure_server.spawn(args.port, latency=args.latency, tokens_per_second=args.tokens_per_second)
+    # Workers inherit these; every session of a run shares one data directory like replicas would
+    os.environ.update(
+        AZURE_API_KEY="load-test",
+        AZURE_ENDPOINT=url,
+        EATWISE_DATA_DIR=tempfile.mkdtemp(prefix="eatwise-load-"),
+        STREAMLIT_LOGGER_LEVEL="error",
+        CACHEABLE_MODE=str(args.cacheable),
+    )
+    try:
+        per_worker = [args.sessions // args.workers + (i < args.sessions % args.workers) for i in range(args.workers)]
+        started = time.perf_counter()
+        with multiprocessing.get_context("spawn").Pool(args.workers) as pool:
+            results = pool.starmap(run_worker, [(i, n, args.rounds) for i, n in enumerate(per_worker) if n])
+        elapsed = time.perf_counter() - started
+
+        samples = {}
+        for result in results:
+            for action, values in result["samples"].items():
+                samples.setdefault(action, []).extend(values)
+        reruns = sum(len(values) for values in samples.values())
+        print(f"{args.sessions} sessions in {len(results)} worker processes, {args.rounds} rounds each: "
+              f"{reruns} reruns in {elapsed:.0f} s ({reruns / elapsed:.1f} reruns/s)\n")
+        print(f"{'action':<12} {'reruns':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'CPU ms p50':>11}")
+        for action in ACTIONS:
+            if action not in samples:
+                continue
+            wall = [w for w, _ in samples[action]]
+            cpu = [c for _, c in samples[action]]
+            print(f"{action:<12} {len(wall):>7} {percentile(wall, 50) * 1000:>8.0f} {percentile(wall, 95) * 1000:>8.0f} "
+                  f"{percentile(wall, 99) * 1000:>8.0f} {statistics.median(cpu) * 1000:>11.0f}")
+
+        growth = [(r["rss_end"] - r["rss_start"]) / r["sessions"] for r in results]
+        print(f"\nRSS per session: {statistics.mean(growth):.2f} MB "
+              f"(workers grew from {statistics.mean(r['rss_start'] for r in results):.0f} MB "
+              f"to {statistics.mean(r['rss_end'] for r in results):.0f} MB)")
+        idle_cpu = statistics.median(c for _, c in samples["idle"])
+        if idle_cpu > 0:
+            print(f"One core sustains about {1 / idle_cpu:.0f} idle reruns/s")
+
+        if args.history_lengths:
+            print(f"\n{'history':>7} {'idle rerun ms':>14} {'CPU ms':>7}")
+            for length, wall, cpu in run_history_growth(args.history_lengths):
+                print(f"{length:>7} {wall * 1000:>14.0f} {cpu * 1000:>7.0f}")
+        print(f"\nmock server: {mock_azure_server.stats(url)}")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+"""Local stand-in for the Azure OpenAI chat-completions API, for offline benchmarks.
+
+Answers POST /openai/deployments/<deployment>/chat/completions the way Azure does, streamed
+(server-sent events) or not, with canned nutrition answers shaped like the app's prompts ask
+for: numbered recommendations, analysis sections, or JSON when a json_schema response format
+is requested. Latency, token rate and errors are configurable:
+
+    python benchmarks/mock_azure_server.py [--port 8765] [--latency 0.2] [--tokens-per-second 200]
+        [--completion-tokens 250] [--error-rate 0.02] [--throttle-rate 0.02]
+
+Point the app at it with AZURE_ENDPOINT=http://127.0.0.1:8765 and any AZURE_API_KEY.
+GET /stats returns the request and error counts so far.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RECOMMENDATION = (
+    "{n}. **{food}**\n"
+    "- Description: A simple, balanced option that is easy to prepare and keeps well.\n"
+    "- Key nutritional benefits: protein, fiber, potassium and slow-release carbohydrates.\n"
+    "- Approximate calories: about {kcal} kcal per serving.\n"
+    "- Why it fits: it supports steady energy and fullness for the goal you selected.\n\n"
+)
+ANALYSIS = (
+    "1. **Food/Meal Summary**: A mixed meal with a starch, a protein source and some vegetables.\n\n"
+    "2. **Estimated Nutritional Information**:\n"
+    "   - Calories: about 520 kcal\n"
+    "   - Macronutrients: 28 g protein, 61 g carbohydrates, 17 g fat\n"
+    "   - Key vitamins and minerals: vitamin C, iron, potassium, B vitamins\n\n"
+    "3. **Health Assessment**: A reasonably balanced meal; the sodium is on the high side.\n\n"
+    "4. **Recommendations**: Add a side of leafy greens and choose a lower-sodium sauce.\n\n"
+    "5. **Suitable For**: General Healthy Eating, Energy Boost, Keep Fit/Maintenance\n\n"
+)
+FOODS = ["Greek yogurt with berries", "Oatmeal with banana", "Grilled chicken salad", "Lentil soup",
+         "Salmon with quinoa", "Vegetable omelette", "Hummus and carrots", "Brown rice bowl",
+         "Tofu stir-fry", "Cottage cheese with fruit"]
+STRUCTURED = {
+    "summary": "A mixed meal with a starch, a protein source and vegetables.",
+    "items": [
+        {"name": "Rice", "portion": "1 cup", "calories": 205, "protein_g": 4.3, "carbs_g": 45, "fat_g": 0.4},
+        {"name": "Chicken breast", "portion": "120 g", "calories": 198, "protein_g": 37, "carbs_g": 0, "fat_g": 4.3},
+        {"name": "Broccoli", "portion": "1 cup", "calories": 31, "protein_g": 2.5, "carbs_g": 6, "fat_g": 0.3},
+    ],
+    "key_nutrients": ["Vitamin C", "Niacin", "Potassium"],
+    "health_assessment": "Balanced and high in protein.",
+    "recommendations": ["Add a healthy fat such as olive oil or avocado."],
+    "suitable_for": ["Muscle Building", "Weight Loss"],
+}
+
+
+class MockStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {"requests": 0, "streamed": 0, "errors": 0, "throttled": 0, "completion_tokens": 0}
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counts[name] += value
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+def prompt_text(messages):
+    parts = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            parts.append(content)
+        else:
+            parts.extend(part.get("text", "") for part in content or [] if part.get("type") == "text")
+    return "\n".join(parts)
+
+
+def count_tokens(text):
+    return max(1, len(text) // 4)
+
+
+def make_answer(body, target_tokens):
+    """Answer text for a request, at most `target_tokens` long (JSON answers are only cut by
+    max_tokens), and its finish reason: "length" when max_tokens cut it short."""
+    format_type = (body.get("response_format") or {}).get("type")
+    if format_type in ("json_schema", "json_object"):
+        text = json.dumps(STRUCTURED)
+        limit = 4 * (body.get("max_tokens") or len(text))
+        return text[:limit], "length" if limit < len(text) else "stop"
+    prompt = prompt_text(body.get("messages", []))
+    # Recommendation prompts (full or compact) ask for "exactly N" of them
+    match = re.search(r"exactly (\d+)", prompt)
+    if match:
+        count = int(match.group(1))
+        text = "Here are some options that fit your goal.\n\n" + "".join(
+            RECOMMENDATION.format(n=n + 1, food=FOODS[n % len(FOODS)], kcal=250 + 40 * n) for n in range(count)
+        )
+    else:
+        text = ANALYSIS
+    words = re.findall(r"\S+\s*", text)
+    # Roughly 0.75 words per token
+    max_tokens = body.get("max_tokens") or target_tokens
+    kept = words[:max(1, int(min(target_tokens, max_tokens) * 0.75))]
+    return "".join(kept), "length" if len(kept) < len(words) and max_tokens < target_tokens else "stop"
+
+
+def make_handler(settings, stats):
+    class MockAzureHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, status, payload, headers=None):
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def write_chunk(self, data):
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        def send_event(self, payload):
+            self.write_chunk(f"data: {payload if isinstance(payload, str) else json.dumps(payload)}\n\n".encode("utf-8"))
+
+        def do_GET(self):
+            if self.path.startswith("/stats"):
+                self.send_json(200, stats.snapshot())
+            else:
+                self.send_json(404, {"error": {"code": "NotFound", "message": "Not found"}})
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            if "/chat/completions" not in self.path:
+                self.send_json(404, {"error": {"code": "NotFound", "message": "Only chat completions are mocked"}})
+                return
+            stats.add("requests")
+            roll = random.random()
+            if roll < settings.throttle_rate:
+                stats.add("throttled")
+                self.send_json(
+                    429,
+                    {"error": {"code": "429", "message": "Rate limit is exceeded. Try again later."}},
+                    {"Retry-After": str(settings.retry_after), "retry-after-ms": str(int(settings.retry_after * 1000))},
+                )
+                return
+            if roll < settings.throttle_rate + settings.error_rate:
+                stats.add("errors")
+                self.send_json(500, {"error": {"code": "InternalServerError", "message": "Injected failure"}})
+                return
+
+            time.sleep(max(0.0, random.uniform(1 - settings.jitter, 1 + settings.jitter) * settings.latency))
+            answer, finish_reason = make_answer(body, settings.completion_tokens)
+            prompt_tokens = count_tokens(prompt_text(body.get("messages", [])))
+            completion_tokens = count_tokens(answer)
+            stats.add("completion_tokens", completion_tokens)
+            usage = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            }
+            completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+            common = {"id": completion_id, "created": int(time.time()), "model": "gpt-4o"}
+            delay = 1.0 / settings.tokens_per_second if settings.tokens_per_second > 0 else 0.0
+
+            if not body.get("stream"):
+                time.sleep(delay * completion_tokens)
+                self.send_json(200, {
+                    **common,
+                    "object": "chat.completion",
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": answer},
+                        "finish_reason": finish_reason,
+                    }],
+                    "usage": usage,
+                })
+                return
+
+            stats.add("streamed")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            chunk = {**common, "object": "chat.completion.chunk"}
+            # Azure opens with a chunk that has no choices (prompt filter results)
+            self.send_event({**chunk, "choices": [], "prompt_filter_results": []})
+            pieces = re.findall(r"\S+\s*", answer)
+            # About one token per event, like the real service
+            for piece in pieces:
+                time.sleep(delay * count_tokens(piece))
+                self.send_event({**chunk, "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]})
+            self.send_event({**chunk, "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}]})
+            if (body.get("stream_options") or {}).get("include_usage"):
+                self.send_event({**chunk, "choices": [], "usage": usage})
+            self.send_event("[DONE]")
+            self.write_chunk(b"")
+
+    return MockAzureHandler
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Benchmarks open many connections at once
+    request_queue_size = 256
+
+    # Clients closing idle keep-alive connections are not errors
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def make_server(host="127.0.0.1", port=8765, **overrides):
+    """A mock server with the command-line defaults, overridden by keyword (e.g. latency=0.5)."""
+    settings = build_parser().parse_args([])
+    for name, value in overrides.items():
+        setattr(settings, name, value)
+    return MockServer((host, port), make_handler(settings, MockStats()))
+
+
+def spawn(port=8765, **options):
+    """Run the mock in a subprocess (so it does not share the GIL with the code under test).
+
+    Options are command-line flags without the dashes, e.g. spawn(latency=0.5, error_rate=0.1).
+    Returns the process and the endpoint URL once it is listening.
+    """
+    command = [sys.executable, os.path.abspath(__file__), "--port", str(port)]
+    for name, value in options.items():
+        command += [f"--{name.replace('_', '-')}", str(value)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if "listening" not in line:
+        process.kill()
+        raise RuntimeError(f"Mock server did not start: {line!r}")
+    return process, f"http://127.0.0.1:{port}"
+
+
+def stats(url):
+    """Request counts of a running mock."""
+    with urllib.request.urlopen(f"{url}/stats", timeout=5) as response:
+        return json.load(response)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds before the first token")
+    parser.add_argument("--jitter", type=float, default=0.25, help="latency varies by up to this fraction")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0, help="generation speed (0 = instant)")
+    parser.add_argument("--completion-tokens", type=int, default=250, help="answer length (capped by max_tokens)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests failing with 500")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of requests rejected with 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with a 429")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    server = make_server(**vars(args))
+    # Benchmarks wait for this line before sending requests
+    print(f"Mock Azure OpenAI listening on http://{args.host}:{server.server_port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
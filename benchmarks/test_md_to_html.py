@@ -0,0 +1,80 @@
+"""Output checks and pytest-benchmark timings for md_to_html.
+
+    python -m pytest benchmarks/test_md_to_html.py               # output checks (and timings)
+    python -m pytest benchmarks/test_md_to_html.py --benchmark-only
+
+The timings use the same ~1500-token answers as bench_md_to_html.py and are skipped when
+pytest-benchmark is not installed; the output checks always run.
+"""
+import pytest
+
+from _app import load_app
+from bench_md_to_html import analysis_answer, recommendation_answer
+
+
+@pytest.fixture(scope="module")
+def app():
+    return load_app()
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("**bold** and *italic*", "<strong>bold</strong> and <em>italic</em>"),
+    ("**bold *nested* text**", "<strong>bold <em>nested</em> text</strong>"),
+    ("***bold italic***", "<strong><em>bold italic</em></strong>"),
+    ("__bold__ and _italic_ and `code`", "<strong>bold</strong> and <em>italic</em> and <code>code</code>"),
+    ("5*3 = 15 and 2*4", "5*3 = 15 and 2*4"),
+    ("2 * 3 * 4", "2 * 3 * 4"),
+    ("2**10 is 1024**", "2**10 is 1024**"),
+    ("about *520* kcal", "about <em>520</em> kcal"),
+    ("snake_case_name", "snake_case_name"),
+    ("`a*b*c`", "<code>a*b*c</code>"),
+    ("<script>alert(1)</script> & **x**", "&lt;script&gt;alert(1)&lt;/script&gt; &amp; <strong>x</strong>"),
+])
+def test_inline_formatting(app, text, expected):
+    assert app.md_inline_to_html(text) == expected
+
+
+# Headings are shifted down two levels so they fit inside a card ("###" becomes <h5>)
+def test_blocks(app):
+    html = app.md_to_html("### 1. **Title**\nIntro line\n- one\n  - nested *two*\n1. first\n2. second\n---")
+    assert html == (
+        "<h5>1. <strong>Title</strong></h5>\n"
+        "<p>Intro line</p>\n"
+        "<ul><li>one\n"
+        "<ul><li>nested <em>two</em>\n"
+        "</li></ul>\n"
+        "</li></ul>\n"
+        "<ol><li>first\n"
+        "</li><li>second\n"
+        "</li></ol>\n"
+        "<hr>"
+    )
+
+
+def test_empty(app):
+    assert app.md_to_html("") == ""
+
+
+def test_recommendation_answer(app):
+    html = app.md_to_html(recommendation_answer(10))
+    assert html.count("<ol>") == 1 and html.count("</ol>") == 1
+    assert html.count("<strong>") == html.count("</strong>") == 10 * 6
+    assert "**" not in html and "~320 kcal" in html and "protein &lt; carbs" in html
+
+
+def test_analysis_answer(app):
+    html = app.md_to_html(analysis_answer())
+    assert html.count("<h5>") == 10
+    assert html.count("<em>") == html.count("</em>") == 2 * 4
+    assert "*" not in html.replace("&gt;", "")
+
+
+@pytest.mark.parametrize("name, make_text", [
+    ("recommendations", lambda: recommendation_answer(10)),
+    ("analysis", analysis_answer),
+])
+def test_benchmark(app, name, make_text, request):
+    pytest.importorskip("pytest_benchmark")
+    benchmark = request.getfixturevalue("benchmark")
+    text = make_text()
+    assert benchmark(app.md_to_html, text) == app.md_to_html(text)
@@ -0,0 +1,37 @@
+"""Download the Inter and Poppins web fonts into static/fonts/ so the app needs no font CDN.
+
+The files come from Fontsource (https://fontsource.org), which repackages the Google Fonts
+releases; both families are licensed under the SIL Open Font License 1.1.
+
+    python scripts/fetch_fonts.py
+"""
+import os
+import urllib.request
+
+FONTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "static", "fonts")
+CDN_URL = "https://cdn.jsdelivr.net/fontsource/fonts/{family}@latest/latin-{weight}-normal.woff2"
+
+# Weights referenced by static/eatwise.css
+FONTS = {
+    "inter": (300, 400, 600, 700),
+    "poppins": (600, 700, 800),
+}
+
+
+def main():
+    os.makedirs(FONTS_DIR, exist_ok=True)
+    for family, weights in FONTS.items():
+        for weight in weights:
+            path = os.path.join(FONTS_DIR, f"{family}-latin-{weight}-normal.woff2")
+            if os.path.exists(path):
+                print(f"exists      {os.path.relpath(path)}")
+                continue
+            with urllib.request.urlopen(CDN_URL.format(family=family, weight=weight), timeout=30) as response:
+                data = response.read()
+            with open(path, "wb") as f:
+                f.write(data)
+            print(f"downloaded  {os.path.relpath(path)} ({len(data) / 1024:.0f} KB)")
+
+
+if __name__ == "__main__":
+    main()